@@ -4,6 +4,7 @@
 # Ex. Searching EColi for 10 sequences per coding regions
 # at 5 mismatch threshold takes ~3 minutes on a normal PC with allow_gaps = True
 # Not recommended for values of 8 or higher at the moment
+# Up to 3 (for 32bp spacers, 2 or 3 for shorter ones) most candidates skip bowtie2 entirely, see src/prefilter.py
 mismatch_threshold = 4
 
 # Only relevant for noncoding spacer generation
@@ -18,7 +19,8 @@ SPACER_LENGTH = 32
 
 # PAM Sequence to use to identify candidates
 # CC is known to be a good PAM for VchINTEGRATE
-# Does not currently tolerate 'N'
+# IUPAC codes are allowed (e.g. 'CN'), and a list of PAMs finds candidates for all of them in one run
+# Ex. PAM_SEQ = ['CC', 'CT', 'CNG']
 PAM_SEQ = 'CC'
 
 # The distance from the spacer at which transposition occurs
@@ -44,4 +46,13 @@ allow_gaps = False
 restriction_enzymes = []
 
 # homopolymer length: length of consecutive bp to count as a homopolymer for filtering
-homopolymer_length = 5
\ No newline at end of file
+homopolymer_length = 5
+
+# Off-target risk in spacer_eval: every hit's risk starts at 1 (an identical site) and is multiplied by
+# seed_mismatch_weight for each mismatch in the seed, the seed_length PAM-proximal bases of the spacer,
+# and by distal_mismatch_weight for each mismatch further from the PAM. Mismatches in the seed disrupt
+# targeting more, so they lower the risk more. A spacer's off-target risk is the sum over its hits,
+# not counting its target site (one identical hit per genome), and spacer_eval_output.csv ranks spacers by it
+seed_length = 8
+seed_mismatch_weight = 0.1
+distal_mismatch_weight = 0.5
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from pathlib import Path
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+import instrument
+from genbank import get_regions, save_to_cache, unload_genome_file
+from finder import candidates_for_seq, get_candidates_for_region, get_target_region_for_gene, remove_offtarget_matches
+from filters import filter_re_sites, filter_homopolymers, filter_non_unique_fingerprints
+from bowtie import find_offtargets
+from outputs import make_eval_outputs
+from main import spacer_gen, spacer_eval
+from config import DEFAULT_CONFIG
+
+# Reproducible benchmarks of every pipeline stage on synthetic genomes (random sequence with copies of a few
+# repeat elements, and annotated genes). Stages are timed at each genome scale, and their peak Python memory
+# is measured in a separate run. --compare reports the stages that got slower than a baseline results file,
+# --startup checks the time to start python and import main. Stages that need bowtie2 are skipped without it
+# Ex. python benchmark.py --scales 100000 1000000 --output bench.json
+#     python benchmark.py --compare bench.json --output bench-new.json
+
+DEFAULT_SCALES = [100000, 1000000, 5000000]
+EMAIL = 'benchmark@example.com'
+STARTUP_BUDGET_SECONDS = 0.75
+# loaded only by the runs that use them, see main.py
+LAZY_MODULES = ['boto3', 'botocore', 'Bio.pairwise2', 'Bio.Restriction', 'Bio.Entrez',
+				'sweep', 'pipeline', 'tiling', 'catalog', 'shards', 'pangenome', 'conserved']
+
+def synthetic_genome(length, repeat_fraction=0.02, repeat_length=1200, gene_length=900, seed=0):
+	# A random genome with repeat_fraction of its sequence made of copies of 3 repeat elements
+	# (in either orientation), and a gene annotated every ~1kb on alternating-ish strands
+	rng = random.Random(seed)
+	bases = rng.choices('ACGT', k=length)
+	repeats = [''.join(rng.choices('ACGT', k=repeat_length)) for _ in range(3)]
+	copies = int(length * repeat_fraction / repeat_length)
+	for _ in range(copies):
+		element = rng.choice(repeats)
+		if rng.random() < 0.5:
+			element = str(Seq(element).reverse_complement())
+		position = rng.randrange(0, length - repeat_length)
+		bases[position:position+repeat_length] = element
+
+	genome_id = f'SYNTH_{length}_{int(repeat_fraction*1000)}_{seed}'
+	record = SeqRecord(Seq(''.join(bases)), id=genome_id, name=genome_id[:16], description=f'synthetic benchmark genome {genome_id}')
+	record.annotations['molecule_type'] = 'DNA'
+	gene_start = 100
+	gene_index = 1
+	while gene_start + gene_length < length - 100:
+		strand = 1 if rng.random() < 0.5 else -1
+		this_length = gene_length + rng.randrange(-300, 300)
+		feature = SeqFeature(FeatureLocation(gene_start, gene_start + this_length, strand=strand), type='gene',
+							 qualifiers={'locus_tag': [f'SYN_{gene_index:05d}']})
+		record.features.append(feature)
+		gene_start += this_length + rng.randrange(20, 250)
+		gene_index += 1
+	return record
+
+def measure(name, scale, func, repeat=1):
+	# Best-of-repeat wall time, and the peak traced Python memory of one more run
+	# tracemalloc slows down every allocation, so the timed runs are made without it
+	best = None
+	for _ in range(repeat):
+		instrument.new_trace()
+		start = time.perf_counter()
+		result = func()
+		wall_time = time.perf_counter() - start
+		if best is None or wall_time < best['wall_time']:
+			best = {'stage': name, 'scale': scale, 'wall_time': wall_time, 'stages': instrument.summary()}
+	instrument.new_trace()
+	tracemalloc.start()
+	try:
+		func()
+		best['peak_memory'] = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	print(f"{name} @ {scale}bp: {round(best['wall_time'], 4)} seconds, peak {round(best['peak_memory']/1e6, 2)} MB")
+	return [best, result]
+
+def skipped(name, scale, reason):
+	print(f"{name} @ {scale}bp: skipped ({reason})")
+	return {'stage': name, 'scale': scale, 'skipped': reason}
+
+def run_benchmarks(scales, repeat_fraction, repeat, work_dir):
+	results = []
+	has_bowtie = shutil.which('bowtie2') is not None
+	for scale in scales:
+		record = synthetic_genome(scale, repeat_fraction)
+		genome = record.seq.upper()
+		genes = get_regions(record, region='coding')[:20]
+
+		# candidates_for_seq is run on (at most) the first 100kb, the way it is used on region windows
+		scan_seq = genome[:100000]
+		[r, _] = measure('candidates_for_seq', scale, lambda: candidates_for_seq(scan_seq, 'bench--fw', [35, 65]), repeat)
+		r['scanned_length'] = len(scan_seq)
+		results.append(r)
+
+		def all_region_candidates():
+			candidates = []
+			for gene in genes:
+				[start_mark, end_mark] = get_target_region_for_gene(gene, 10, 50)
+				candidates += get_candidates_for_region(genome, start_mark, end_mark, gene['name'], [35, 65])
+			return candidates
+		[r, candidates] = measure('get_candidates_for_region', scale, all_region_candidates, repeat)
+		results.append(r)
+
+		[r, filtered] = measure('filter_re_sites', scale, lambda: filter_re_sites(candidates), repeat)
+		results.append(r)
+		[r, filtered] = measure('filter_homopolymers', scale, lambda: filter_homopolymers(filtered), repeat)
+		results.append(r)
+
+		bowtie_stages = ['filter_non_unique_fingerprints', 'remove_offtarget_matches', 'make_eval_outputs', 'spacer_gen', 'spacer_eval']
+		if not has_bowtie:
+			results += [skipped(name, scale, 'bowtie2 not found') for name in bowtie_stages]
+			continue
+
+		# Put the genome in the genbank cache, which also builds its bowtie2 index, and take it out again afterwards
+		save_to_cache(record.id, record)
+		try:
+			results += run_bowtie_benchmarks(record, genes, filtered, scale, repeat, work_dir)
+		finally:
+			remove_from_cache(record.id)
+	return results
+
+def run_bowtie_benchmarks(record, genes, filtered, scale, repeat, work_dir):
+	results = []
+
+	[r, filtered] = measure('filter_non_unique_fingerprints', scale, lambda: filter_non_unique_fingerprints(filtered, record.id), repeat)
+	results.append(r)
+	[r, _] = measure('remove_offtarget_matches', scale, lambda: remove_offtarget_matches(record.id, 'bench', filtered, 10, 'avoid'), repeat)
+	results.append(r)
+
+	spacers = [str(c['seqrec'].seq) for c in filtered[:50]]
+	spacer_records = [SeqRecord(Seq(s), id=f'spacer_{i+1}', description=f'spacer_{i+1}') for (i, s) in enumerate(spacers)]
+	fasta_name = os.path.join(work_dir, 'bench-spacers.fasta')
+	with open(fasta_name, 'w') as f:
+		SeqIO.write(spacer_records, f, 'fasta')
+	sam_location = find_offtargets(record.id, fasta_name)
+	[r, _] = measure('make_eval_outputs', scale, lambda: make_eval_outputs(spacer_records, [(record.id, sam_location)], EMAIL, work_dir, spacers, 'jsonl'), repeat)
+	results.append(r)
+	os.remove(sam_location)
+
+	locus_tags_csv = os.path.join(work_dir, 'locus_tags.csv')
+	with open(locus_tags_csv, 'w') as f:
+		f.write('locus_tags\n' + '\n'.join([g['name'] for g in genes[:5]]) + '\n')
+	gen_args = {'email': EMAIL, 'nonessential_only': False, 'output_path': work_dir, 'genbank_ids': [record.id],
+				'genbank_files': [], 'genome_fasta_files': [], 'start_pct': 10, 'end_pct': 50, 'spacers_per_region': 10,
+				'GC_requirement': [35, 65], 'overlapping_spacers': 'avoid', 'target_locus_tags_csv': locus_tags_csv,
+				'coding_spacer_direction': 'N_to_C', 'region_type': 'coding', 'noncoding_boundary': [0, scale],
+				'custom_regions_csv': '', 'custom_sequences': []}
+	[r, _] = measure('spacer_gen', scale, lambda: spacer_gen(gen_args), repeat)
+	results.append(r)
+	eval_args = {'genbank_ids': [record.id], 'fasta_files': [], 'output_path': work_dir, 'email': EMAIL,
+				 'spacers': spacers[:20], 'off_target_report': 'jsonl'}
+	[r, _] = measure('spacer_eval', scale, lambda: spacer_eval(eval_args), repeat)
+	results.append(r)
+	return results
+
+def remove_from_cache(genome_id):
+	# Removes a synthetic genome, its bowtie2 index and everything built next to it from the assets caches
+	root_dir = Path(__file__).parent.parent
+	for extension in ['gb', 'fasta']:
+		path = os.path.join(root_dir, 'assets', 'genbank', f'{genome_id}.{extension}')
+		if os.path.exists(path):
+			os.remove(path)
+	shutil.rmtree(os.path.join(root_dir, 'assets', 'bowtie', genome_id), ignore_errors=True)
+	# and the parsed record, see genbank.load_genome_file
+	unload_genome_file(os.path.join(root_dir, 'assets', 'genbank', f'{genome_id}.gb'))
+
+def measure_startup(repeat=5):
+	# [median seconds to start python and import main, lazy modules it loaded], each run in a new interpreter
+	script = f'import sys, main; print(",".join([m for m in {LAZY_MODULES!r} if m in sys.modules]))'
+	times = []
+	loaded = set()
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = subprocess.run([sys.executable, '-c', script], cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+		times.append(time.perf_counter() - start)
+		loaded.update([m for m in result.stdout.strip().split(',') if m])
+	return [sorted(times)[len(times) // 2], sorted(loaded)]
+
+def check_startup(budget, repeat):
+	[startup_time, loaded] = measure_startup(repeat)
+	print(f"Startup (python + import main): {round(startup_time, 3)} seconds, budget {budget} seconds")
+	if loaded:
+		print(f"REGRESSION main imports {', '.join(loaded)} at startup, import them where they're used")
+	if startup_time > budget:
+		print(f"REGRESSION startup is over the {budget} second budget")
+	return 1 if loaded or startup_time > budget else 0
+
+def compare_results(results, baseline, tolerance):
+	# Returns the stages that are more than tolerance (a fraction) slower than in the baseline
+	baseline_times = {(b['stage'], b['scale']): b['wall_time'] for b in baseline['results'] if 'wall_time' in b}
+	regressions = []
+	for r in results:
+		key = (r['stage'], r['scale'])
+		if 'wall_time' not in r or key not in baseline_times:
+			continue
+		if r['wall_time'] > baseline_times[key] * (1 + tolerance):
+			regressions.append({'stage': r['stage'], 'scale': r['scale'], 'baseline': baseline_times[key], 'current': r['wall_time']})
+	return regressions
+
+def code_version():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+	except Exception:
+		return 'unknown'
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark every guide RNA design stage on synthetic genomes')
+	parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES, help='genome sizes in bp to benchmark')
+	parser.add_argument('--repeat_fraction', type=float, default=0.02, help='fraction of each genome made of repeat element copies')
+	parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest is kept')
+	parser.add_argument('--output', type=str, default='benchmark_results.json', help='path to write the results JSON to')
+	parser.add_argument('--compare', type=str, default='', help='earlier results JSON to check for regressions against')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against --compare, as a fraction')
+	parser.add_argument('--startup', action='store_true', help='only check the startup time against --startup_budget')
+	parser.add_argument('--startup_budget', type=float, default=STARTUP_BUDGET_SECONDS, help='allowed seconds to start python and import main')
+	args = parser.parse_args(argv)
+
+	if args.startup:
+		return check_startup(args.startup_budget, max(args.repeat, 5))
+
+	work_dir = tempfile.mkdtemp(prefix='integrate-benchmark-')
+	results = run_benchmarks(args.scales, args.repeat_fraction, args.repeat, work_dir)
+	shutil.rmtree(work_dir, ignore_errors=True)
+
+	output = {
+		'version': code_version(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'config': DEFAULT_CONFIG.as_dict(),
+		'repeat_fraction': args.repeat_fraction,
+		'results': results
+	}
+	with open(args.output, 'w') as f:
+		json.dump(output, f, indent=1)
+	print(f"Wrote benchmark results to {args.output}")
+
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		regressions = compare_results(results, baseline, args.tolerance)
+		for reg in regressions:
+			print(f"REGRESSION {reg['stage']} @ {reg['scale']}bp: {round(reg['baseline'], 4)}s -> {round(reg['current'], 4)}s")
+		if regressions:
+			return 1
+		print(f"No regressions against {args.compare} (version {baseline.get('version')})")
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
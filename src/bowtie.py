@@ -1,10 +1,10 @@
 import sys
-import subprocess
-import multiprocessing
 import os
 from pathlib import Path
 
-from advanced_parameters import mismatch_threshold, allow_gaps
+from instrument import stage, run_subprocess
+from config import DEFAULT_CONFIG
+from cores import core_scheduler, threads_for_reads
 
 def build(genbank_id, fasta_file=None):
 	root_dir = Path(__file__).parent.parent
@@ -20,15 +20,28 @@ def build(genbank_id, fasta_file=None):
 		fasta_build_file = os.path.join(root_dir, 'assets', 'genbank', f'{genbank_id}.fasta')
 	else:
 		fasta_build_file = fasta_file
-	build_command = f'bowtie2-build {fasta_build_file} {build_output_name}'
-	try:
-		subprocess.run(build_command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-	except Exception as e:
-		raise Exception(f"Error running bowtie, see Installation notes in the README: \n{e}")
+	build_index(fasta_build_file, build_output_name, genbank_id)
 
-def find_offtargets(genbank_id, fasta_name):
+def build_index(fasta_file, index_location, genome_name, threads=1):
+	build_command = f'bowtie2-build --threads {threads} {fasta_file} {index_location}'
+	with stage('bowtie2_build', genome=genome_name, subprocesses=1):
+		try:
+			run_subprocess(build_command)
+		except Exception as e:
+			raise Exception(f"Error running bowtie, see Installation notes in the README: \n{e}")
+
+def find_offtargets(genbank_id, fasta_name, config=DEFAULT_CONFIG):
 	root_dir = Path(__file__).parent.parent
+	# next to the fasta and named after it, so concurrent searches against one genome (each with its own fasta) don't collide
+	output_location = f"{os.path.splitext(fasta_name)[0]}-{genbank_id}-offtarget.sam"
 	index_location = os.path.join(root_dir, 'assets', 'bowtie', genbank_id, 'index')
+	# threads by the number of reads, within the process's core budget (see cores.py)
+	with open(fasta_name, 'r') as f:
+		reads = sum([1 for line in f if line.startswith('>')])
+	with core_scheduler().reserve(threads_for_reads(reads)) as threads:
+		return align_offtargets(index_location, fasta_name, output_location, genbank_id, config, threads)
+
+def align_offtargets(index_location, fasta_name, output_location, genome_name, config=DEFAULT_CONFIG, threads=1):
 	# Run the bowtie2 alignment command
 	# -x {} : the name of the genome index file (already built by bowtie2-build)
 	# -a : return all results, not just highest match
@@ -43,17 +56,15 @@ def find_offtargets(genbank_id, fasta_name):
 	# (This means there must be one fully matching 5bp sequence between a set of ambiguous characters to pass the seed filtering)
 	# --rdg XX,1 : read gap-open penalty of XX and gap-extension penalty of 1. Set XX to scale with mismatch_threshold
 	# --rfg XX,1 : reference gap-open penalty of 50 and gap-extension penalty of 1
-	gap_option = f'--rdg {mismatch_threshold*100},1 --rfg {mismatch_threshold*100},1' if not allow_gaps else ''
-
-	cores = multiprocessing.cpu_count()
-	output_name = f"{fasta_name.split('.')[0]}-{genbank_id}-offtarget.sam"
-	output_location = os.path.join(root_dir, 'assets', 'bowtie', genbank_id, output_name)
+	# --reorder : write the reads in the order of the fasta even with several threads, so spacer_eval can stream the hits spacer by spacer
+	# --mm : memory-map the index, so concurrent bowtie2 processes on one index (e.g. a fingerprint check) share it instead of each loading it
+	gap_option = f'--rdg {config.mismatch_threshold*100},1 --rfg {config.mismatch_threshold*100},1' if not config.allow_gaps else ''
 
-	root_dir = Path(__file__).parent.parent
-	index_location = os.path.join(root_dir, 'assets', 'bowtie', genbank_id, 'index')
-	align_command = f'bowtie2 -x {index_location} -a -f {fasta_name} -t -p {cores - 1} {gap_option} -S {output_location} --no-1mm-upfront --np 0 --n-ceil 5 --score-min L,-{6*mismatch_threshold+1},0 -N 1 -L 11 -i S,6,0 -D 6 --no-unal'
-	try:
-		subprocess.run(align_command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-	except Exception as e:
-		raise Exception(f'Error running bowtie, see Installation notes in the README: \n{e}')
+	align_command = f'bowtie2 -x {index_location} -a -f {fasta_name} -t -p {max(threads, 1)} {gap_option} -S {output_location} --no-1mm-upfront --np 0 --n-ceil 5 --score-min L,-{6*config.mismatch_threshold+1},0 -N 1 -L 11 -i S,6,0 -D 6 --no-unal --mm --reorder'
+	with stage('bowtie2_offtargets', genome=genome_name, subprocesses=1, threads=max(threads, 1)) as counters:
+		try:
+			run_subprocess(align_command)
+		except Exception as e:
+			raise Exception(f'Error running bowtie, see Installation notes in the README: \n{e}')
+		counters['bytes_written'] = os.path.getsize(output_location)
 	return output_location
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+from pathlib import Path
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from designer import Designer, DesignerInputError
+from finder import candidates_for_both_strands, add_fingerprints, get_target_region_for_gene, order_candidates_for_region
+from filters import filter_re_sites, filter_homopolymers, filter_non_unique_fingerprints
+from tiling import unique_spacer_filter, window_ranges, region_window, pick_spacers
+from sweep import offtarget_hits
+from outputs import make_spacer_gen_output
+from instrument import stage
+
+# Precomputed spacer catalogs: build_catalog runs every filter and the off-target search once over every PAM site
+# of a genome and stores the candidates that pass in SQLite, indexed by strand and location. design_from_catalog
+# then answers region requests with range queries, without bowtie2. GC content is filtered at query time, the
+# other settings must match the ones the catalog was built with (see CATALOG_SETTINGS)
+# Ex. python catalog.py CP001509.3 --email me@example.com, then set catalog = True in spacer_gen.py
+
+# Config fields that change which candidates pass or their off-target counts
+CATALOG_SETTINGS = ['mismatch_threshold', 'SPACER_LENGTH', 'PAM_SEQ', 'INTEGRATION_SITE_DISTANCE', 'flex_base', 'flex_spacing',
+					'allow_gaps', 'restriction_enzymes', 'homopolymer_length']
+
+def default_catalog_path(genome_id):
+	root_dir = Path(__file__).parent.parent
+	return os.path.join(root_dir, 'assets', 'catalog', f"{Path(str(genome_id)).name}.sqlite")
+
+def catalog_settings(config):
+	# JSON round trip, so tuples and lists compare equal
+	return json.loads(json.dumps({field: config.as_dict()[field] for field in CATALOG_SETTINGS}))
+
+def build_catalog(designer, catalog_path=None, config=None, chunk_size=20000):
+	# Catalogs every candidate of the designer's default genome, checked for off-targets in all of its genomes
+	config = designer.config_for(config)
+	genome_id = designer.default_genome_id
+	genome = designer.genome_seq(genome_id)
+	catalog_path = catalog_path or default_catalog_path(genome_id)
+	os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+
+	with stage('catalog_build', genome=str(genome_id)) as counters:
+		print(f"Finding every candidate in {genome_id}")
+		candidates = candidates_for_both_strands(genome, 'genome', [0, 100], config)
+		candidates = unique_spacer_filter(candidates, genome, config)
+		counters['candidates_in'] = len(candidates)
+
+		temp_path = f'{catalog_path}.tmp-{os.getpid()}'
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		db = sqlite3.connect(temp_path)
+		db.execute('CREATE TABLE settings (key TEXT, value TEXT)')
+		db.execute('CREATE TABLE spacers (name TEXT, strand TEXT, location INTEGER, sequence TEXT, pam TEXT, GC_content REAL, offtarget_hits INTEGER)')
+		settings = {'genome_id': genome_id, 'genome_ids': designer.genome_ids, 'genome_length': len(genome), 'config': catalog_settings(config)}
+		db.executemany('INSERT INTO settings VALUES (?,?)', [(key, json.dumps(value)) for (key, value) in settings.items()])
+
+		stored = 0
+		for start in range(0, len(candidates), chunk_size):
+			chunk = filter_homopolymers(filter_re_sites(candidates[start:start + chunk_size], config), config=config)
+			add_fingerprints(chunk, genome, config)
+			for fingerprint_genome in designer.genome_ids:
+				chunk = filter_non_unique_fingerprints(chunk, fingerprint_genome)
+			hits_by_genome = [offtarget_hits(offtarget_genome, chunk, config) for offtarget_genome in designer.genome_ids] if len(chunk) else []
+			rows = []
+			for c in chunk:
+				seq = str(c['seqrec'].seq)
+				# the most alignments in any one genome, the target site itself included
+				hits = max([len(h.get(c['name'], [])) for h in hits_by_genome])
+				rows.append((c['name'], c['name'].split('--')[1][:2], c['location'], seq, c['pam'], 100 * (seq.count('G') + seq.count('C')) / len(seq), hits))
+			db.executemany('INSERT INTO spacers VALUES (?,?,?,?,?,?,?)', rows)
+			db.commit()
+			stored += len(rows)
+			print(f"Catalogued {min(start + chunk_size, len(candidates))} of {len(candidates)} candidates, {stored} kept")
+
+		db.execute('CREATE INDEX spacers_by_location ON spacers (strand, location)')
+		db.commit()
+		db.close()
+		os.replace(temp_path, catalog_path)
+		counters['candidates_out'] = stored
+	print(f"Wrote the catalog of {stored} spacers to {catalog_path}")
+	return catalog_path
+
+class SpacerCatalog():
+	'''
+	A catalog built by build_catalog, opened for range queries.
+	'''
+
+	def __init__(self, catalog_path):
+		if not Path(catalog_path).exists():
+			raise DesignerInputError(f"No spacer catalog at {catalog_path}, build one with 'python catalog.py <genome>'")
+		self.path = catalog_path
+		self.db = sqlite3.connect(catalog_path)
+		self.settings = {key: json.loads(value) for (key, value) in self.db.execute('SELECT key, value FROM settings')}
+
+	def check(self, designer, config):
+		# Raises DesignerInputError if the catalog doesn't answer for this session and config
+		if self.settings['genome_id'] != designer.default_genome_id or self.settings['genome_ids'] != designer.genome_ids:
+			raise DesignerInputError(f"The catalog {self.path} was built for {self.settings['genome_ids']}, not {designer.genome_ids}")
+		differences = [field for (field, value) in catalog_settings(config).items() if self.settings['config'][field] != value]
+		if len(differences):
+			raise DesignerInputError(f"The catalog {self.path} was built with different settings for {', '.join(differences)}, rebuild it or run without it")
+
+	def window(self, start_mark, end_mark, GC_requirement, config):
+		# The catalogued candidates in a region's search windows, in get_candidates_for_region's order
+		ranges = window_ranges(start_mark, end_mark, self.settings['genome_length'], min([len(p) for p in config.pams()]), config)
+		candidates = []
+		for strand in ['fw', 'rv']:
+			rows = self.db.execute('SELECT name, location, sequence, pam, offtarget_hits FROM spacers WHERE strand = ? AND location BETWEEN ? AND ? '
+								   'AND GC_content BETWEEN ? AND ?', (strand, ranges[strand][0], ranges[strand][1], GC_requirement[0], GC_requirement[1]))
+			for (name, location, sequence, pam, hits) in rows:
+				candidates.append({'name': name, 'seqrec': SeqRecord(Seq(sequence), id=name, name=name, description=name),
+								   'location': location, 'pam': pam, 'offtarget_hits': hits})
+		return region_window(candidates, start_mark, end_mark, self.settings['genome_length'], config)
+
+	def close(self):
+		self.db.close()
+
+def design_from_catalog(designer, regions, catalog_path=None, start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+						overlapping_spacers='avoid', coding_spacer_direction=None, output_path=None, config=None):
+	# Same results as Designer.design for regions of the designer's default genome, from a catalog instead of bowtie2
+	config = designer.config_for(config)
+	catalog = SpacerCatalog(catalog_path or default_catalog_path(designer.default_genome_id))
+	catalog.check(designer, config)
+	with stage('catalog_query', regions=len(regions)):
+		region_candidates = []
+		for region in regions:
+			if region.get('genome_id', designer.default_genome_id) != designer.default_genome_id or 'sequence' in region:
+				raise DesignerInputError(f"Region {region['name']} is not in the catalogued genome {designer.default_genome_id}")
+			[start_mark, end_mark] = get_target_region_for_gene(region, start_pct, end_pct)
+			window = catalog.window(start_mark, end_mark, GC_requirement, config)
+			if coding_spacer_direction:
+				window = order_candidates_for_region(window, region, coding_spacer_direction, config)
+			region_candidates.append(window)
+		catalog.close()
+		# as in remove_offtarget_matches, the one allowed hit per genome is the target site itself
+		chosen = pick_spacers(region_candidates, spacers_per_region, overlapping_spacers,
+							  lambda candidates: {c['name']: c['offtarget_hits'] <= 1 for c in candidates}, config)
+
+	for (region, spacers) in zip(regions, chosen):
+		region['candidates'] = designer.locate_candidates(region, spacers[:spacers_per_region])
+		print(f"Identified {len(region['candidates'])} spacers for {region['name']}")
+		if output_path is not None:
+			make_spacer_gen_output(region, os.path.join(output_path, 'spacer_gen_output.csv'), config)
+	return regions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Build a spacer catalog for a genome')
+	parser.add_argument('genome', nargs='+', help='genbank ids or genbank files, the first is catalogued and checked against all of them')
+	parser.add_argument('--email', type=str, default='', help='for NCBI API calls, needed for genbank ids')
+	parser.add_argument('--output', type=str, default=None, help='catalog file, under assets/catalog by default')
+	parser.add_argument('--mismatch_threshold', type=int, default=None)
+	args = parser.parse_args(argv)
+
+	genome_files = [g for g in args.genome if Path(g).exists()]
+	genbank_ids = [g for g in args.genome if not Path(g).exists()]
+	if len(genome_files) and len(genbank_ids):
+		# a Designer works on one kind of genome input
+		print(f"Give either genbank ids or genbank files, not both. Got the files {genome_files} and the ids (or missing files) {genbank_ids}")
+		return 1
+	config = {} if args.mismatch_threshold is None else {'mismatch_threshold': args.mismatch_threshold}
+	designer = Designer(genbank_ids, genome_files, [], args.email, config)
+	build_catalog(designer, args.output)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -72,7 +72,7 @@ class CommandLine() :
         self.parser.add_argument('-mG', '--mismatch_threshold', type=int, default=4, action = 'store', help='TODO')
         self.parser.add_argument('-mG', '--minimum_intergenic_region_length', type=int, default=50, action = 'store', help='TODO')
         self.parser.add_argument('-mG', '--spacer_length', type=int, default=32, action = 'store', help='length of spacers')
-        self.parser.add_argument('-mG', '--PAM_SEQ', type=str, default='CC', action = 'store', help='PAM sequence used to identify candidates') # TODO not currently tolerate 'N'
+        self.parser.add_argument('-mG', '--PAM_SEQ', type=str, default=['CC'], nargs='+', action = 'store', help='PAM sequence(s) used to identify candidates, IUPAC codes allowed')
         self.parser.add_argument('-mG', '--INTEGRATION_SITE_DISTANCE', type=int, default=49, action = 'store', help='Distance from the spacer at which transposition occurs. Roughly 49bp downstream for INTEGRATE. This is used to identify spacers that target specific genomic regions.')
         self.parser.add_argument('-lG', '--offset', action = 'store', nargs='?', const=False, default=True, help="Controls taking into account INTEGRATION_SITE_DISTANCE when searching for candidates. True limits spacer candidates to spacers that will direct integration into the target search window. False will return spacers whose 3' ends are within the target search window")
 
@@ -0,0 +1,73 @@
+from dataclasses import dataclass, field, replace, asdict
+
+import advanced_parameters
+from pams import pam_patterns
+
+def _default(name):
+	# Defaults are read from advanced_parameters.py when a Config is created, so editing that file
+	# still changes the defaults for every run
+	return field(default_factory=lambda: getattr(advanced_parameters, name))
+
+@dataclass(frozen=True)
+class Config():
+	'''
+	Immutable run configuration, threaded through the pipeline in place of the
+	advanced_parameters module constants. See advanced_parameters.py for what each
+	setting does. Two configurations can be used side by side in one process, and a
+	Config is hashable so it can be part of any cache key.
+
+	Ex. config = Config(mismatch_threshold=5, restriction_enzymes=('BsaI',), PAM_SEQ=('CC', 'CN'))
+		stricter = config.replace(homopolymer_length=4)
+	'''
+	mismatch_threshold: int = _default('mismatch_threshold')
+	minimum_intergenic_region_length: int = _default('minimum_intergenic_region_length')
+	SPACER_LENGTH: int = _default('SPACER_LENGTH')
+	PAM_SEQ: str = _default('PAM_SEQ')
+	INTEGRATION_SITE_DISTANCE: int = _default('INTEGRATION_SITE_DISTANCE')
+	offset: bool = _default('offset')
+	flex_base: bool = _default('flex_base')
+	flex_spacing: int = _default('flex_spacing')
+	allow_gaps: bool = _default('allow_gaps')
+	restriction_enzymes: tuple = field(default_factory=lambda: tuple(advanced_parameters.restriction_enzymes))
+	homopolymer_length: int = _default('homopolymer_length')
+	seed_length: int = _default('seed_length')
+	seed_mismatch_weight: float = _default('seed_mismatch_weight')
+	distal_mismatch_weight: float = _default('distal_mismatch_weight')
+
+	def __post_init__(self):
+		# lists (e.g. from a JSON job) are stored as tuples to keep the config hashable
+		if not isinstance(self.restriction_enzymes, tuple):
+			object.__setattr__(self, 'restriction_enzymes', tuple(self.restriction_enzymes))
+		if not isinstance(self.PAM_SEQ, (str, tuple)):
+			object.__setattr__(self, 'PAM_SEQ', tuple(self.PAM_SEQ))
+		pam_patterns(self.PAM_SEQ)  # raises ValueError for anything but IUPAC patterns
+
+	def replace(self, **changes):
+		return replace(self, **changes)
+
+	def as_dict(self):
+		return asdict(self)
+
+	def pams(self):
+		# The PAM patterns, longest first (see pams.py)
+		return pam_patterns(self.PAM_SEQ)
+
+	def pam_length(self):
+		# Length of the longest PAM, the bases searched before a spacer
+		return len(self.pams()[0])
+
+	def flex_positions(self):
+		# 0-based spacer positions that are treated as flexible (N) for bowtie alignments
+		if not self.flex_base:
+			return []
+		return list(range(self.flex_spacing-1, self.SPACER_LENGTH, self.flex_spacing))
+
+def make_config(config=None):
+	# Accepts None (defaults), a Config, or a dict of settings to override
+	if config is None:
+		return Config()
+	if isinstance(config, Config):
+		return config
+	return Config(**config)
+
+DEFAULT_CONFIG = Config()
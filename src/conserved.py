@@ -0,0 +1,118 @@
+import csv
+
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from kmers import encode_seq, decode_codes, reverse_complement_codes, pack_kmers, in_kmer_index, kmers_seen_once
+from filters import filter_re_sites, filter_homopolymers
+from pams import pam_adjacent, matching_pam
+from config import DEFAULT_CONFIG
+from instrument import stage
+
+# Conserved spacers: protospacers whose spacer occurs exactly once, on either strand, in every genome of a set
+# Every genome gets a sorted table of its PAM-adjacent spacers that occur once in it, and the tables are
+# intersected, no alignment. Only exact matches count, spacer_eval can check the results for near matches
+# Coordinates are 1-based, of the spacer's first base on its strand, the PAM is the one in the first genome
+
+CONSERVED_OUTPUT = 'conserved_spacers.csv'
+
+def unique_protospacers(seq, config=DEFAULT_CONFIG):
+	# [spacers, coordinates, strands] for the PAM-adjacent spacers of seq that occur exactly once in it
+	# spacers are packed and sorted, strands are 1 (forward) or -1 (reverse)
+	codes = encode_seq(seq)
+	all_kmers = []
+	pam_kmers = []
+	pam_coordinates = []
+	pam_strands = []
+	for (strand, strand_codes) in [(1, codes), (-1, reverse_complement_codes(codes))]:
+		[kmers, valid] = pack_kmers(strand_codes, config.SPACER_LENGTH)
+		all_kmers.append(kmers[valid])
+		positions = np.flatnonzero(valid & pam_adjacent(strand_codes, config.pams(), config.SPACER_LENGTH))
+		pam_kmers.append(kmers[positions])
+		pam_coordinates.append(positions + 1 if strand == 1 else len(codes) - positions)
+		pam_strands.append(np.full(len(positions), strand, dtype=np.int8))
+
+	once = kmers_seen_once(np.concatenate(all_kmers))
+	pam_kmers = np.concatenate(pam_kmers)
+	keep = in_kmer_index(once, pam_kmers)
+	order = np.argsort(pam_kmers[keep])
+	return [pam_kmers[keep][order], np.concatenate(pam_coordinates)[keep][order], np.concatenate(pam_strands)[keep][order]]
+
+def protospacer_pam(seq, coordinate, strand, config=DEFAULT_CONFIG):
+	# The PAM before the spacer at a 1-based coordinate and strand ('fw' or 'rv') of seq
+	pam_length = config.pam_length()
+	if strand == 'fw':
+		upstream = seq[max(coordinate - 1 - pam_length, 0):coordinate - 1]
+	else:
+		upstream = Seq(str(seq[coordinate:coordinate + pam_length])).reverse_complement()
+	return matching_pam(upstream, config.pams())
+
+def spacer_GC(codes):
+	return 100 * ((codes == 1) | (codes == 2)).sum(axis=-1) / codes.shape[-1]
+
+def unpack_spacers(spacers, length):
+	# Packed spacers back to a (len(spacers), length) array of base codes
+	shifts = np.arange(length - 1, -1, -1, dtype=np.uint64) * np.uint64(2)
+	return ((spacers[:, None] >> shifts) & np.uint64(3)).astype(np.uint8)
+
+def find_conserved_spacers(genomes, GC_requirement=[0,100], regions=None, config=DEFAULT_CONFIG):
+	# genomes is a dict of name: sequence. regions (dicts with 'name', 'start' and 'end') limit the results to
+	# spacers within them in the first genome
+	# Returns candidate dicts, with 'coordinates' and 'strands' holding the position in each genome
+	names = list(genomes.keys())
+	with stage('conserved_spacers', genomes=len(names)) as counters:
+		tables = {}
+		shared = None
+		for name in names:
+			tables[name] = unique_protospacers(genomes[name], config)
+			print(f"{name}: {len(tables[name][0])} PAM-adjacent spacers occur once")
+			shared = tables[name][0] if shared is None else np.intersect1d(shared, tables[name][0], assume_unique=True)
+		counters['shared'] = len(shared)
+		print(f"{len(shared)} spacers occur once in all {len(names)} genomes")
+
+		codes = unpack_spacers(shared, config.SPACER_LENGTH)
+		GC_content = spacer_GC(codes) if len(shared) else np.zeros(0)
+		keep = (GC_content >= GC_requirement[0]) & (GC_content <= GC_requirement[1])
+		shared = shared[keep]
+		codes = codes[keep]
+
+		positions = {name: np.searchsorted(tables[name][0], shared) for name in names}
+		reference_coordinates = tables[names[0]][1][positions[names[0]]]
+		# [(index into shared, region name)], in order of the first genome's coordinates, before any objects are made
+		if regions is None:
+			selected = [(i, '') for i in np.argsort(reference_coordinates, kind='stable')]
+		else:
+			selected = []
+			for region in regions:
+				in_region = np.flatnonzero((reference_coordinates >= region['start']) & (reference_coordinates <= region['end']))
+				selected += [(i, region['name']) for i in in_region[np.argsort(reference_coordinates[in_region], kind='stable')]]
+
+		candidates = []
+		for (i, region_name) in selected:
+			seq = decode_codes(codes[i])
+			coordinates = {name: int(tables[name][1][positions[name][i]]) for name in names}
+			strands = {name: 'fw' if tables[name][2][positions[name][i]] == 1 else 'rv' for name in names}
+			candidates.append({'name': f'conserved--{strands[names[0]]}{coordinates[names[0]]}', 'seqrec': SeqRecord(Seq(seq), id=seq),
+							   'location': coordinates[names[0]], 'coordinates': coordinates, 'strands': strands, 'region': region_name,
+							   'pam': protospacer_pam(genomes[names[0]], coordinates[names[0]], strands[names[0]], config)})
+		candidates = filter_re_sites(candidates, config)
+		candidates = filter_homopolymers(candidates, config=config)
+		counters['candidates_out'] = len(candidates)
+	return candidates
+
+def make_conserved_output(candidates, genome_names, output_filename, config=DEFAULT_CONFIG):
+	fieldnames = ['spacer_id', 'region', 'sequence', 'GC_content', 'PAM'] + [f'{g}_{field}' for g in genome_names for field in ['coordinate', 'strand']]
+	with stage('output_writing', output='conserved') as counters, open(output_filename, 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=fieldnames)
+		writer.writeheader()
+		for (index, c) in enumerate(candidates):
+			seq = str(c['seqrec'].seq)
+			row = {'spacer_id': index, 'region': c['region'], 'sequence': seq,
+				   'GC_content': 100 * (seq.count('G') + seq.count('C')) / len(seq), 'PAM': c['pam']}
+			for g in genome_names:
+				row[f'{g}_coordinate'] = c['coordinates'][g]
+				row[f'{g}_strand'] = c['strands'][g]
+			counters['bytes_written'] = counters.get('bytes_written', 0) + writer.writerow(row)
+	print(f"Wrote {len(candidates)} conserved spacers to {output_filename}")
+	return output_filename
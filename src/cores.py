@@ -0,0 +1,107 @@
+import os
+import math
+import threading
+from contextlib import contextmanager
+
+from instrument import stage
+
+# CPU cores for bowtie2
+# The process has one CoreScheduler with a budget of cores (those it may run on, by affinity and cgroup quota,
+# but one). Each alignment reserves threads by its number of reads (threads_for_reads) for as long as bowtie2
+# runs, starting with what is free rather than waiting, so concurrent alignments share the budget
+# Worker processes that align at the same time each get a share of it with set_core_budget
+
+# bowtie2 threads pay off from about this many reads each
+READS_PER_THREAD = 8
+
+def cgroup_cpu_limit():
+	# Cores allowed by the cgroup CPU quota (v2 cpu.max or v1 cfs quota), or None without a quota
+	paths = []
+	try:
+		with open('/proc/self/cgroup', 'r') as f:
+			for line in f:
+				(_, controllers, path) = line.strip().split(':', 2)
+				if controllers == '':
+					paths.append(('v2', os.path.join('/sys/fs/cgroup', path.lstrip('/'))))
+				elif 'cpu' in controllers.split(','):
+					paths.append(('v1', os.path.join('/sys/fs/cgroup', controllers, path.lstrip('/'))))
+	except (OSError, ValueError):
+		pass
+	# inside a container's cgroup namespace its own limits are at the root
+	paths += [('v2', '/sys/fs/cgroup'), ('v1', '/sys/fs/cgroup/cpu'), ('v1', '/sys/fs/cgroup/cpu,cpuacct')]
+	for (version, path) in paths:
+		try:
+			if version == 'v2':
+				with open(os.path.join(path, 'cpu.max'), 'r') as f:
+					(quota, period) = f.read().split()[:2]
+			else:
+				with open(os.path.join(path, 'cpu.cfs_quota_us'), 'r') as f:
+					quota = f.read().strip()
+				with open(os.path.join(path, 'cpu.cfs_period_us'), 'r') as f:
+					period = f.read().strip()
+		except (OSError, ValueError):
+			continue
+		if quota in ['max', '-1']:
+			return None
+		return max(1, math.ceil(int(quota) / int(period)))
+	return None
+
+def available_cores():
+	# Cores this process may use: its CPU affinity and the cgroup quota, at least 1
+	try:
+		cores = len(os.sched_getaffinity(0))
+	except AttributeError:
+		cores = os.cpu_count() or 1
+	limit = cgroup_cpu_limit()
+	return max(1, min(cores, limit) if limit else cores)
+
+def threads_for_reads(reads):
+	return max(1, math.ceil(reads / READS_PER_THREAD))
+
+class CoreScheduler():
+	'''
+	A budget of cores shared by the bowtie2 runs of a process.
+
+	Ex. with core_scheduler().reserve(threads_for_reads(len(batch))) as threads:
+			align_offtargets(..., threads=threads)
+	'''
+
+	def __init__(self, cores=None):
+		self.cores = cores or max(available_cores() - 1, 1)
+		self.free = self.cores
+		self.condition = threading.Condition()
+
+	@contextmanager
+	def reserve(self, threads):
+		# Yields the number of threads granted, between 1 and threads
+		threads = max(1, min(threads, self.cores))
+		with stage('core_wait', threads=threads) as counters:
+			with self.condition:
+				while self.free < 1:
+					self.condition.wait()
+				granted = min(threads, self.free)
+				self.free -= granted
+			counters['granted'] = granted
+		try:
+			yield granted
+		finally:
+			with self.condition:
+				self.free += granted
+				self.condition.notify_all()
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def core_scheduler():
+	# The process's CoreScheduler
+	global _scheduler
+	with _scheduler_lock:
+		if _scheduler is None:
+			_scheduler = CoreScheduler()
+		return _scheduler
+
+def set_core_budget(cores):
+	# Replaces the process's CoreScheduler with one of cores cores (None for the default), e.g. in a worker process
+	global _scheduler
+	with _scheduler_lock:
+		_scheduler = CoreScheduler(cores)
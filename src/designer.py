@@ -0,0 +1,371 @@
+import os
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from genbank import retrieve_annotation, get_regions, load_genome_file, contig_table, contig_location, contig_offset
+from finder import get_target_region_for_gene, get_candidates_for_region, remove_offtarget_matches, order_candidates_for_region, choose_next_offtarget_batch, offtarget_verdicts
+from outputs import make_spacer_gen_output, make_eval_outputs
+from bowtie import find_offtargets, build as bowtie_build
+from filters import filter_non_unique_fingerprints, filter_re_sites, filter_homopolymers
+from instrument import stage, in_context
+from config import make_config
+from sharedmem import attach, attach_unique_spacers
+from pool import CandidatePool
+from prefilter import prefilter_applies, prefilter_path, load_prefilter
+
+class DesignerInputError(ValueError):
+	pass
+
+def region_candidates(region, genome, genome_both_ways, start_pct, end_pct, GC_requirement, coding_spacer_direction, config, pool=None, unique_spacers=None):
+	# Candidates for one region by PAM and GC content, filtered for restriction sites and homopolymers
+	# genome is unused for regions given as a custom 'sequence'
+	# pool (a pool.CandidatePool) shares the uniqueness verdicts of the region's genome across a run
+	# unique_spacers is the genome's kmers.unique_kmer_table, if there is one (see sharedmem.py)
+	if 'sequence' in region and len(region['sequence']) >= 20:
+		genome = Seq(region['sequence'])
+		genome_both_ways = None
+		pool = None
+		unique_spacers = None
+		start_mark = 0
+		end_mark = len(genome)
+	else:
+		[start_mark, end_mark] = get_target_region_for_gene(region, start_pct, end_pct)
+
+	candidates = get_candidates_for_region(genome, start_mark, end_mark, region['name'], GC_requirement, genome_both_ways, config, pool, region.get('genome_id'), unique_spacers)
+	print(f"Identified {len(candidates)} candidates by PAM and GC content, filtering them now...")
+	if coding_spacer_direction:
+		candidates = order_candidates_for_region(candidates, region, coding_spacer_direction, config)
+	candidates = filter_re_sites(candidates, config)
+	return filter_homopolymers(candidates, config=config)
+
+def fasta_index_name(genome_fasta_file):
+	# Name of the bowtie2 index of a genome fasta file: the file name without its extension (and .gz)
+	path = str(genome_fasta_file)
+	return Path(path[:-3] if path.endswith('.gz') else path).stem
+
+class Designer():
+	'''
+	A design session over a fixed set of genomes.
+
+	Genomes are loaded (and their bowtie2 indices built) once when the session is created, and
+	gene tables and the both-strand genome sequence used for the spacer uniqueness check are
+	cached on first use. design() and evaluate() can then be called any number of times, with
+	different parameters, and return structured results.
+
+	Ex.
+		designer = Designer(genbank_ids=['CP001509.3'], email='me@example.com')
+		for gc in [[35, 65], [40, 60]]:
+			regions = designer.design(designer.coding_regions(['ECD_00001']), GC_requirement=gc)
+		results = designer.evaluate(['AAAAATAAAAACAAAAAATAAAACAAAAAGTT'], output_path='./outputs')
+
+	The session's Config (see config.py) is used for every call, unless a call is passed its own
+	config, so different settings can be tried against the same loaded genomes.
+	'''
+
+	def __init__(self, genbank_ids=[], genbank_files=[], genome_fasta_files=[], email='', config=None):
+		self.email = email
+		self.config = make_config(config)
+		self.genbank_ids = list(genbank_ids)
+		self.genome_fasta_files = list(genome_fasta_files)
+		# bowtie2 index of each fasta file, named after the file: the record ids inside need not be unique or path safe
+		self.fasta_index_names = [fasta_index_name(genome_fasta_file) for genome_fasta_file in genome_fasta_files]
+		self.genome_input_type = None
+		self.default_genome_id = None
+		# ids of the bowtie2 indices every candidate is checked against
+		self.genome_ids = []
+		# what record() takes for each genome: genbank ids or file paths
+		self.genome_sources = list(genbank_ids) or list(genbank_files) or list(genome_fasta_files)
+		self.gene_tables = {}
+		self.genome_seqs = {}
+		self.genomes_both_ways = {}
+		self.contig_tables = {}
+		self.prefilters = {}
+		# {(genome id, spacer length): kmers.unique_kmer_table}, only for sessions attached to shared memory
+		self.unique_spacer_tables = {}
+
+		if len(genbank_ids):
+			if not email or '@' not in email:
+				raise DesignerInputError("Please enter an email for NCBI API calls")
+			self.genome_input_type = 'genbank_ids'
+			self.default_genome_id = genbank_ids[0]
+			for genbank_id in genbank_ids:
+				retrieve_annotation(genbank_id, email)
+			self.genome_ids = list(genbank_ids)
+		elif len(genbank_files):
+			for genbank_file in genbank_files:
+				if not Path(genbank_file).exists():
+					raise DesignerInputError("Invalid genbank_file provided. Either leave it empty or provide a valid file path. ")
+			self.genome_input_type = 'genbank_files'
+			self.default_genome_id = genbank_files[0]
+			self.genome_ids = [load_genome_file(genbank_file, 'genbank').id for genbank_file in genbank_files]
+		elif len(genome_fasta_files):
+			for genome_fasta_file in genome_fasta_files:
+				if not Path(genome_fasta_file).exists():
+					raise DesignerInputError(f"Invalid genome_fasta_file provided: {genome_fasta_file}. Either leave it empty or provide a valid file path. ")
+			self.genome_input_type = 'fasta_files'
+			self.default_genome_id = genome_fasta_files[0]
+			for (index_name, genome_fasta_file) in zip(self.fasta_index_names, genome_fasta_files):
+				bowtie_build(index_name, fasta_file=Path(genome_fasta_file).absolute())
+			self.genome_ids = list(self.fasta_index_names)
+
+	@classmethod
+	def attached(cls, descriptor):
+		# A session in a worker process over genomes published with sharedmem.SharedGenomes.add_designer
+		# Genome sequences are read from shared memory, genome files are only parsed if gene tables are needed
+		designer = cls.__new__(cls)
+		for (field, value) in descriptor['designer'].items():
+			setattr(designer, field, value)
+		designer.gene_tables = {}
+		designer.genome_seqs = {}
+		designer.genomes_both_ways = {}
+		designer.contig_tables = {}
+		designer.prefilters = {}
+		designer.unique_spacer_tables = attach_unique_spacers(descriptor)
+		for (genome_id, (genome, genome_both_ways)) in attach(descriptor).items():
+			designer.genome_seqs[genome_id] = genome
+			designer.genomes_both_ways[genome_id] = genome_both_ways
+			designer.contig_tables[genome_id] = descriptor['genomes'][genome_id]['contigs']
+		return designer
+
+	def record(self, genome_id=None):
+		# The parsed record for a genome id (genbank id or file path, depending on the input type)
+		genome_id = genome_id or self.default_genome_id
+		if self.genome_input_type == 'genbank_ids':
+			return retrieve_annotation(genome_id, self.email)
+		elif self.genome_input_type == 'genbank_files':
+			return load_genome_file(genome_id, 'genbank')
+		elif self.genome_input_type == 'fasta_files':
+			return load_genome_file(genome_id, 'fasta')
+		raise DesignerInputError("No genome was given to this Designer")
+
+	def config_for(self, config=None):
+		# A call's own config (a Config or a dict of overrides), or the session's
+		return self.config if config is None else make_config(config)
+
+	def genes(self, region='coding', config=None):
+		# Gene (or noncoding region) table of the default genome, cached per region kind and config
+		config = self.config_for(config)
+		key = (region, config)
+		if key not in self.gene_tables:
+			self.gene_tables[key] = get_regions(self.record(), region=region, config=config)
+		return self.gene_tables[key]
+
+	def genome_seq(self, genome_id):
+		# Uppercase genome sequence, cached
+		if genome_id not in self.genome_seqs:
+			self.genome_seqs[genome_id] = self.record(genome_id).seq.upper()
+		return self.genome_seqs[genome_id]
+
+	def contigs(self, genome_id):
+		# Contig table of a genome, cached
+		if genome_id not in self.contig_tables:
+			self.contig_tables[genome_id] = contig_table(self.record(genome_id))
+		return self.contig_tables[genome_id]
+
+	def offtarget_prefilter(self, genome_id, config=None):
+		# Off-target prefilter (see prefilter.py) of one of genome_ids, loaded or built once, or None where it can't be used
+		config = self.config_for(config)
+		if not prefilter_applies(config):
+			return None
+		key = (genome_id, prefilter_path(genome_id, config))
+		if key not in self.prefilters:
+			source = self.genome_sources[self.genome_ids.index(genome_id)]
+			genome = self.genome_seq(source)
+			contigs = [genome[c['offset']:c['offset'] + c['length']] for c in self.contigs(source)]
+			self.prefilters[key] = load_prefilter(genome_id, contigs, config)
+		return self.prefilters[key]
+
+	def genome_sequences(self):
+		# {record id: uppercase sequence} of every genome of the session
+		return {self.record(source).id: self.genome_seq(source) for source in self.genome_sources}
+
+	def genome_both_ways(self, genome_id):
+		if genome_id not in self.genomes_both_ways:
+			genome = self.genome_seq(genome_id)
+			self.genomes_both_ways[genome_id] = genome + genome.reverse_complement()
+		return self.genomes_both_ways[genome_id]
+
+	def coding_regions(self, locus_tags):
+		if self.genome_input_type == 'fasta_files':
+			raise DesignerInputError("Cannot do coding or noncoding spacer generation against a fasta file. Use a genbank input or use custom regions against this fasta. ")
+		all_genes = self.genes('coding')
+		regions = [dict(gene) for gene in all_genes if gene['name'] in locus_tags]
+		if not len(regions):
+			raise DesignerInputError(f"You must enter at least one valid locus tag identifier, ex. {all_genes[0]['name']}")
+		for r in regions:
+			r['genome_input_type'] = self.genome_input_type
+			r['genome_id'] = self.default_genome_id
+		return regions
+
+	def noncoding_regions(self, noncoding_boundary, nonessential_only=False, config=None):
+		if self.genome_input_type == 'fasta_files':
+			raise DesignerInputError("Cannot do coding or noncoding spacer generation against a fasta file. Use a genbank input or use custom regions against this fasta. ")
+		if len(noncoding_boundary) != 2:
+			raise DesignerInputError("You must specify the boundaries around which to search for noncoding regions")
+		all_noncoding = self.genes('nonessential' if nonessential_only else 'noncoding', config)
+		regions = [dict(r) for r in all_noncoding if r['end'] > noncoding_boundary[0] and r['start'] < noncoding_boundary[1]]
+		for r in regions:
+			r['genome_input_type'] = self.genome_input_type
+			r['genome_id'] = self.default_genome_id
+		return regions
+
+	def custom_regions(self, custom_regions=[], custom_sequences=[]):
+		# custom_regions are dicts with 'genome_id', 'start_ref' and 'end_ref', as in the custom regions csv
+		# An optional 'contig' gives start_ref and end_ref relative to that contig of a multi-record genome
+		if len(custom_regions):
+			regions = []
+			for (index, c) in enumerate(custom_regions):
+				offset = 0
+				if c.get('contig'):
+					offset = contig_offset(self.contigs(c['genome_id']), c['contig'])
+					if offset is None:
+						raise DesignerInputError(f"Contig {c['contig']} not found in {c['genome_id']}")
+				regions.append({'name': f'custom-{index}', 'start': int(c['start_ref']) + offset, 'end': int(c['end_ref']) + offset, 'direction': 'fw', 'genome_id': c['genome_id']})
+			return regions
+		elif len(custom_sequences) > 0:
+			return [{'name': f'custom-{index}', 'start': 0, 'end': len(c), 'direction': 'fw', 'genome_id': None, 'sequence': c.upper()} for (index, c) in enumerate(custom_sequences)]
+		raise DesignerInputError("No custom regions csv or custom sequences provided. Please fill in one of those fields")
+
+	def screen_region(self, region, start_pct=10, end_pct=50, GC_requirement=[35,65], coding_spacer_direction=None, config=None, pool=None,
+					  overlapping_spacers=None):
+		# Candidates for one region that pass the PAM, GC, restriction site, homopolymer and fingerprint
+		# uniqueness filters, i.e. every check except the off-target search
+		# pool (a pool.CandidatePool) reuses the verdicts of other regions of the same run
+		# With a pool and overlapping_spacers, the first off-target batch of each genome is aligned alongside its fingerprint
+		# check and its verdicts are kept in the pool for remove_offtarget_matches, see filter_fingerprints_and_prefetch
+		config = self.config_for(config)
+		if 'sequence' in region and len(region['sequence']) >= 20:
+			genome = None
+			genome_both_ways = None
+		else:
+			genome = self.genome_seq(region['genome_id'])
+			genome_both_ways = self.genome_both_ways(region['genome_id'])
+		unique_spacers = self.unique_spacer_tables.get((region.get('genome_id'), config.SPACER_LENGTH))
+
+		candidates = region_candidates(region, genome, genome_both_ways, start_pct, end_pct, GC_requirement, coding_spacer_direction, config, pool, unique_spacers)
+		for genome_id in self.genome_ids:
+			if pool is not None and overlapping_spacers is not None:
+				candidates = self.filter_fingerprints_and_prefetch(genome_id, region['name'], candidates, overlapping_spacers, config, pool)
+			else:
+				candidates = filter_non_unique_fingerprints(candidates, genome_id, pool)
+		print(f"{len(candidates)} remain after filtering for re_sites, homopolymers, and non unique fingerprints")
+		return self.locate_candidates(region, candidates)
+
+	def filter_fingerprints_and_prefetch(self, genome_id, name, candidates, overlapping_spacers, config, pool):
+		# filter_non_unique_fingerprints for genome_id, with the off-target search of the batch remove_offtarget_matches will test
+		# first running at the same time against the same (memory mapped) bowtie2 index. The two searches need different
+		# bowtie2 settings, so they are two concurrent processes rather than one. Candidates of the batch that fail the
+		# fingerprint check were aligned for nothing, that is rare and cheaper than loading the index twice in a row
+		check_all = len(self.genome_ids) > 1
+		batch = choose_next_offtarget_batch(candidates, [], overlapping_spacers, len(candidates) if check_all else 10, config)
+		prefilter = self.offtarget_prefilter(genome_id, config)
+		align = lambda unchecked: offtarget_verdicts(genome_id, name, unchecked, config, prefilter)
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			prefetched = executor.submit(in_context(pool.verdicts), ('offtarget', genome_id), batch, align)
+			candidates = filter_non_unique_fingerprints(candidates, genome_id, pool)
+			prefetched.result()
+		return candidates
+
+	def locate_candidates(self, region, candidates):
+		# Sets every candidate's 'contig' and 'contig_location', its location within its chromosome, plasmid or contig
+		if 'sequence' in region or region.get('genome_id') is None:
+			contigs = [{'id': region['name'], 'length': region['end'], 'offset': 0}]
+		else:
+			contigs = self.contigs(region['genome_id'])
+		for c in candidates:
+			[c['contig'], c['contig_location']] = contig_location(contigs, c['location'])
+		return candidates
+
+	def design_region(self, region, start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+					  overlapping_spacers='avoid', coding_spacer_direction=None, config=None, pool=None):
+		# Finds spacers for one region, sets and returns region['candidates']
+		# coding_spacer_direction orders the candidates within coding regions, None leaves them in genome order
+		# pool (a pool.CandidatePool) reuses the verdicts of other regions of the same run
+		config = self.config_for(config)
+		pool = pool or CandidatePool()
+		start = time.perf_counter()
+		print(f"Finding gRNA for \"{region['name']}\"")
+
+		with stage('region', region=region['name']) as counters:
+			candidates = self.screen_region(region, start_pct, end_pct, GC_requirement, coding_spacer_direction, config, pool, overlapping_spacers)
+			counters['candidates_in'] = len(candidates)
+			for genome_id in self.genome_ids:
+				candidates = remove_offtarget_matches(genome_id, region['name'], candidates, spacers_per_region, overlapping_spacers, check_all=len(self.genome_ids) > 1, config=config, pool=pool,
+													  prefilter=self.offtarget_prefilter(genome_id, config))
+			region['candidates'] = candidates[:spacers_per_region]
+			counters['candidates_out'] = len(region['candidates'])
+
+		elapsed_time = round(time.perf_counter() - start, 2)
+		print(f"Identified {len(candidates)} spacers for {region['name']} in {elapsed_time} seconds")
+		return region['candidates']
+
+	def design(self, regions, start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+			   overlapping_spacers='avoid', coding_spacer_direction=None, output_path=None, config=None):
+		# Designs spacers for every region and returns the regions with their 'candidates'
+		# If output_path is given, each region is also appended to spacer_gen_output.csv there
+		# Candidates that several regions share are checked once, see pool.py
+		config = self.config_for(config)
+		if coding_spacer_direction not in [None, 'N_to_C', 'C_to_N']:
+			raise DesignerInputError("Invalid 'coding_spacer_direction' parameter, see the valid inputs")
+		pool = CandidatePool()
+		for region in regions:
+			self.design_region(region, start_pct, end_pct, spacers_per_region, GC_requirement, overlapping_spacers, coding_spacer_direction, config, pool)
+			if output_path is not None:
+				make_spacer_gen_output(region, os.path.join(output_path, 'spacer_gen_output.csv'), config)
+		if pool.reused:
+			print(f"Reused {pool.reused} verdicts for candidates shared between regions, {pool.computed} were computed")
+		for genome_id in self.genome_ids:
+			prefilter = self.offtarget_prefilter(genome_id, config)
+			if prefilter is not None:
+				print(prefilter.summary())
+		return regions
+
+	def evaluate(self, user_spacers, output_path, report_format='text', config=None, pam_supported_only=False):
+		# Evaluates spacers (a list, or a dict of name: spacer) against every genome of the session
+		# With pam_supported_only, only hits with a PAM are reported (see make_eval_outputs)
+		# Returns the per-spacer summaries that are also written to spacer_eval_output.csv
+		config = self.config_for(config)
+		if type(user_spacers) is dict:
+			spacers = [v for k,v in user_spacers.items() if len(v) == config.SPACER_LENGTH]
+		else:
+			spacers = [s for s in user_spacers if len(s) == config.SPACER_LENGTH]
+		print(f"Starting evaluation for {len(spacers)} spacers...")
+		spacer_batch = []
+		spacer_batch_unmod = []  # make unmodified copy of spacer recs for output
+		for (index, spacer) in enumerate(spacers):
+			flexible_seq = spacer.upper()[:]
+			for i in config.flex_positions():
+				flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
+			# use 'description' to store ref_genome info
+			spacer_batch.append(SeqRecord(Seq(flexible_seq), id=f'spacer_{index+1}', description=f'spacer_{index+1}'))
+			spacer_batch_unmod.append(SeqRecord(Seq(spacer.upper()), id=f'spacer_{index+1}', description=f'spacer_{index+1}'))
+
+		# Write the batch of candidate sequences to a fasta for bowtie2 to use
+		# unique file name, so concurrent evaluations don't collide
+		root_dir = Path(__file__).parent.parent
+		os.makedirs(os.path.join(root_dir, 'assets', 'bowtie'), exist_ok=True)
+		(fasta_handle, fasta_name) = tempfile.mkstemp(prefix='eval_spacers_', suffix='.fasta', dir=os.path.join(root_dir, 'assets', 'bowtie'))
+		with os.fdopen(fasta_handle, 'w') as targets_file:
+			SeqIO.write(spacer_batch, targets_file, 'fasta')
+
+		genome_sams = []
+		records = {}
+		for genbank_id in self.genbank_ids:
+			genome_sams.append((genbank_id, find_offtargets(genbank_id, fasta_name, config)))
+		for (index_name, genome_fasta_file) in zip(self.fasta_index_names, self.genome_fasta_files):
+			bowtie_build(index_name, fasta_file=Path(genome_fasta_file).absolute())
+			genome_sams.append((index_name, find_offtargets(index_name, fasta_name, config)))
+			records[index_name] = load_genome_file(genome_fasta_file, 'fasta')
+
+		spacer_output = make_eval_outputs(spacer_batch_unmod, genome_sams, self.email, output_path, user_spacers, report_format, config, pam_supported_only, records)
+
+		os.remove(fasta_name)
+		for (_, output_sam) in genome_sams:
+			os.remove(output_sam)
+		return spacer_output
@@ -1,43 +1,70 @@
-from Bio import Restriction, Seq, SeqIO
-import multiprocessing
-import subprocess
+from Bio import Seq, SeqIO
+import tempfile
 import os
 from pathlib import Path
 from simplesam import Reader as samReader
-from advanced_parameters import restriction_enzymes, homopolymer_length
+from instrument import stage, run_subprocess
+from config import DEFAULT_CONFIG
+from cores import core_scheduler, threads_for_reads
+from pool import fingerprint_key
 
-def filter_re_sites(candidates):
-	rb = Restriction.RestrictionBatch(restriction_enzymes)
-	filtered_candidates = []
-	for c in candidates:
-		rbsearch = rb.search(c['seqrec'].seq)
-		matched = any([match for re in rbsearch.keys() for match in rbsearch[re]])
-		if not matched:
-			filtered_candidates.append(c)
+def filter_re_sites(candidates, config=DEFAULT_CONFIG):
+	# Bio.Restriction takes a while to import (every enzyme is a class), so only runs that filter load it
+	from Bio import Restriction
+	with stage('filter_re_sites', candidates_in=len(candidates)) as counters:
+		rb = Restriction.RestrictionBatch(list(config.restriction_enzymes))
+		filtered_candidates = []
+		for c in candidates:
+			rbsearch = rb.search(c['seqrec'].seq)
+			matched = any([match for re in rbsearch.keys() for match in rbsearch[re]])
+			if not matched:
+				filtered_candidates.append(c)
+		counters['candidates_out'] = len(filtered_candidates)
+	return filtered_candidates
+
+def filter_non_unique_fingerprints(candidates, genbank_id, pool=None):
+	# pool (a pool.CandidatePool) reuses the verdicts of fingerprints another region of the run already aligned
+	with stage('filter_non_unique_fingerprints', genome=genbank_id, candidates_in=len(candidates)) as counters:
+		if pool is None:
+			filtered_candidates = _filter_non_unique_fingerprints(candidates, genbank_id)
+		else:
+			def align(unchecked):
+				unique = set([c['name'] for c in _filter_non_unique_fingerprints(unchecked, genbank_id)])
+				return {c['name']: c['name'] in unique for c in unchecked}
+			filtered_candidates = pool.keep(('fingerprint', genbank_id), candidates, align, key=fingerprint_key)
+		counters['candidates_out'] = len(filtered_candidates)
 	return filtered_candidates
 
-def filter_non_unique_fingerprints(candidates, genbank_id):
+def _filter_non_unique_fingerprints(candidates, genbank_id):
 	root_dir = Path(__file__).parent.parent
-	temp_fasta_name = 'fp_check.fasta'
-	with open(temp_fasta_name, 'w') as temp_fasta:
+	bowtie_genome_dir = os.path.join(root_dir, 'assets', 'bowtie', genbank_id)
+	os.makedirs(bowtie_genome_dir, exist_ok=True)
+	# unique file names, so concurrent runs against the same genome don't collide
+	(temp_fasta_handle, temp_fasta_name) = tempfile.mkstemp(prefix='fp_check_', suffix='.fasta', dir=bowtie_genome_dir)
+	with os.fdopen(temp_fasta_handle, 'w') as temp_fasta:
 		SeqIO.write([c['fp_seq'] for c in candidates if len(c['fp_seq'].seq) > 1], temp_fasta, 'fasta')
-	cores = multiprocessing.cpu_count()
-	output_name = 'fp_check_out.sam'
-	index_location = os.path.join(root_dir, 'assets', 'bowtie', genbank_id, 'index')
-	align_command = 'bowtie2 -x {} -k 2 -f {} -p {} -S {}'.format(index_location, temp_fasta_name, cores-1, output_name)
-	try:
-		subprocess.run(align_command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-	except Exception as e:
-		raise Exception(f'Error running bowtie: \n{e}')
+	output_name = temp_fasta_name[:-len('.fasta')] + '_out.sam'
+	index_location = os.path.join(bowtie_genome_dir, 'index')
+	# --mm shares the memory-mapped index with off-target searches running at the same time (see Designer.filter_fingerprints_and_prefetch)
+	# threads by the number of reads, within the process's core budget (see cores.py)
+	with core_scheduler().reserve(threads_for_reads(len(candidates))) as threads:
+		align_command = 'bowtie2 -x {} -k 2 -f {} -p {} -S {} --mm'.format(index_location, temp_fasta_name, threads, output_name)
+		with stage('bowtie2_fingerprints', genome=genbank_id, subprocesses=1, reads_in=len(candidates), threads=threads):
+			try:
+				run_subprocess(align_command)
+			except Exception as e:
+				raise Exception(f'Error running bowtie: \n{e}')
 	filtered_candidates = []
 	sam_reads = {}
-	with open(output_name, 'r') as sam_file:
-		reader = samReader(sam_file)
-		for r in reader:
-			if r.safename not in sam_reads:
-				sam_reads[r.safename] = 1
-			else:
-				sam_reads[r.safename] += 1
+	with stage('sam_parsing') as counters:
+		with open(output_name, 'r') as sam_file:
+			reader = samReader(sam_file)
+			for r in reader:
+				if r.safename not in sam_reads:
+					sam_reads[r.safename] = 1
+				else:
+					sam_reads[r.safename] += 1
+		counters['reads_aligned'] = sum(sam_reads.values())
 
 	for c in candidates:
 		c_id = c['fp_seq'].id
@@ -47,19 +74,21 @@ def filter_non_unique_fingerprints(candidates, genbank_id):
 	os.remove(output_name)
 	return filtered_candidates
 
-def filter_homopolymers(candidates, G_only=True):
-	filtered_candidates = []
-	bases_to_avoid = ['G']
-	if not G_only:
-		bases_to_avoid = ['G', 'A', 'T', 'C']
-	for c in candidates:
-		should_filter = False
-		seq = c['seqrec'].seq.upper()
-		for base in bases_to_avoid:
-			homopolymer = base*homopolymer_length
-			if seq.find(homopolymer) != -1:
-				should_filter = True
-		if not should_filter:
-			filtered_candidates.append(c)
+def filter_homopolymers(candidates, G_only=True, config=DEFAULT_CONFIG):
+	with stage('filter_homopolymers', candidates_in=len(candidates)) as counters:
+		filtered_candidates = []
+		bases_to_avoid = ['G']
+		if not G_only:
+			bases_to_avoid = ['G', 'A', 'T', 'C']
+		for c in candidates:
+			should_filter = False
+			seq = c['seqrec'].seq.upper()
+			for base in bases_to_avoid:
+				homopolymer = base*config.homopolymer_length
+				if seq.find(homopolymer) != -1:
+					should_filter = True
+			if not should_filter:
+				filtered_candidates.append(c)
+		counters['candidates_out'] = len(filtered_candidates)
 
 	return filtered_candidates
@@ -13,29 +13,47 @@ from Bio.SeqRecord import SeqRecord
 from simplesam import Reader as samReader
 
 from bowtie import find_offtargets
-from advanced_parameters import PAM_SEQ, INTEGRATION_SITE_DISTANCE, SPACER_LENGTH, flex_base, flex_spacing, offset
+from instrument import stage
+from config import DEFAULT_CONFIG
+from pams import find_pams
+from kmers import kmers_in_table
 
-def candidates_for_seq(seq, descriptor, GC_requirement=[0,100]):
+def candidates_for_seq(seq, descriptor, GC_requirement=[0,100], config=DEFAULT_CONFIG):
+	# The spacers directly after every PAM of every one of the config's PAM patterns in seq, in order of location
+	# Each candidate is tagged with the PAM it follows
 	candidates = []
-	i=0
-	while i < len(seq):
-		nextPAM = seq[i:].find(PAM_SEQ)
-		if nextPAM == -1 or (i+nextPAM+len(PAM_SEQ)+SPACER_LENGTH) > len(seq):
-			i += 10000000
-			break
-
-		targetSeq = seq[i+nextPAM+len(PAM_SEQ):i+nextPAM+len(PAM_SEQ)+SPACER_LENGTH]
+	spacer_starts = set()
+	for (position, pam) in find_pams(seq, config.pams()):
+		spacer_start = position + len(pam)
+		if spacer_start + config.SPACER_LENGTH > len(seq) or spacer_start in spacer_starts:
+			# the same spacer can follow PAMs that start at different positions, the first (longest) one is kept
+			continue
+		spacer_starts.add(spacer_start)
+
+		targetSeq = seq[spacer_start:spacer_start+config.SPACER_LENGTH]
+		if 'N' in targetSeq:
+			# ambiguous bases, or the separator between the contigs of a joined genome
+			continue
 		GC_content = SeqUtils.GC(targetSeq)
 		if GC_content < GC_requirement[0] or GC_content > GC_requirement[1]:
-			i += nextPAM + 1
 			continue
-		name = descriptor + str(i+nextPAM+len(PAM_SEQ))
+		name = descriptor + str(spacer_start)
 
 		target = SeqRecord(targetSeq, id=name, name=name, description=name)
-		candidate = {'name': target.id, 'seqrec': target, 'location': i+nextPAM+len(PAM_SEQ)}
-		candidates.append(candidate)
-		i += nextPAM + 1
-	return candidates
+		candidates.append({'name': target.id, 'seqrec': target, 'location': spacer_start, 'pam': pam})
+	# PAMs are found in order of position, with PAMs of different lengths a later one can have the earlier spacer
+	return sorted(candidates, key=lambda c: c['location'])
+
+def candidates_for_both_strands(seq, name, GC_requirement=[0,100], config=DEFAULT_CONFIG):
+	# Candidates on both strands of a whole sequence, located as in get_candidates_for_region: fw candidates
+	# in order of location, then rv candidates in reverse order of location
+	candidates = candidates_for_seq(seq, name+'--fw', GC_requirement, config)
+	for c in candidates:
+		c['location'] += 1
+	rv_candidates = candidates_for_seq(seq.reverse_complement(), name+'--rv', GC_requirement, config)
+	for c in rv_candidates:
+		c['location'] = len(seq) - c['location'] + 1
+	return candidates + rv_candidates
 
 def get_target_region_for_gene(gene, start_pct, end_pct):
 	# Calculate the target region of a gene by pct of the coding region, from N to C
@@ -50,46 +68,67 @@ def get_target_region_for_gene(gene, start_pct, end_pct):
 		end_mark = gene['start'] + int(gene_length*(100-start_pct)/100)
 	return [start_mark, end_mark]
 
-def get_candidates_for_region(genome, start_mark, end_mark, name, GC_requirement):
+def get_candidates_for_region(genome, start_mark, end_mark, name, GC_requirement, genome_both_ways=None, config=DEFAULT_CONFIG, pool=None, genome_id=None,
+							  unique_spacers=None):
+	# genome_both_ways is the uppercase genome followed by its reverse complement, pass it in to reuse it across regions
+	# pool (a pool.CandidatePool) shares the uniqueness verdicts of genome_id across the regions of a run
+	# unique_spacers is the genome's kmers.unique_kmer_table, candidates in it are unique without scanning genome_both_ways
 	genome_seq = genome
 
-	if offset:
-		search_offset = len(PAM_SEQ) + SPACER_LENGTH + INTEGRATION_SITE_DISTANCE
+	if config.offset:
+		search_offset = config.pam_length() + config.SPACER_LENGTH + config.INTEGRATION_SITE_DISTANCE
 	else:
-		search_offset = len(PAM_SEQ) + SPACER_LENGTH
+		search_offset = config.pam_length() + config.SPACER_LENGTH
 
-	fw_search_seq = genome_seq[max(0,start_mark-search_offset):end_mark-search_offset + len(PAM_SEQ) + SPACER_LENGTH]
-	rv_search_seq = genome_seq[start_mark+INTEGRATION_SITE_DISTANCE:end_mark+search_offset].reverse_complement()
-	candidates = candidates_for_seq(fw_search_seq, name+'--fw', GC_requirement)
-	for c in candidates:
-		# the initial "location" here is the location in the search sequence, needs to be
-		# placed in the genome location
-		c['location'] = start_mark - search_offset + c['location'] + 1
-	rv_candidates = candidates_for_seq(rv_search_seq, name+'--rv', GC_requirement)
-	for c in rv_candidates:
-		# move back additional spacer length for the reverse oriented spacers
-		c['location'] = end_mark + search_offset - c['location'] +1
-	candidates.extend(rv_candidates)
+	with stage('candidate_generation', region=name) as counters:
+		fw_search_seq = genome_seq[max(0,start_mark-search_offset):end_mark-search_offset + config.pam_length() + config.SPACER_LENGTH]
+		rv_search_seq = genome_seq[start_mark+config.INTEGRATION_SITE_DISTANCE:end_mark+search_offset].reverse_complement()
+		candidates = candidates_for_seq(fw_search_seq, name+'--fw', GC_requirement, config)
+		for c in candidates:
+			# the initial "location" here is the location in the search sequence, needs to be
+			# placed in the genome location
+			c['location'] = start_mark - search_offset + c['location'] + 1
+		rv_candidates = candidates_for_seq(rv_search_seq, name+'--rv', GC_requirement, config)
+		for c in rv_candidates:
+			# move back additional spacer length for the reverse oriented spacers
+			c['location'] = end_mark + search_offset - c['location'] +1
+		candidates.extend(rv_candidates)
 
+		add_fingerprints(candidates, genome_seq, config)
+		counters['candidates_out'] = len(candidates)
+	with stage('filter_unique_spacers', candidates_in=len(candidates)) as counters:
+		if genome_both_ways is None:
+			genome_both_ways = genome.upper()+genome.reverse_complement().upper()
+		def is_unique(candidates):
+			in_table = [False] * len(candidates) if unique_spacers is None else kmers_in_table(unique_spacers, [c['seqrec'].seq for c in candidates], config.SPACER_LENGTH)
+			return {c['name']: bool(once) or genome_both_ways.count(c["seqrec"].seq) == 1 for (c, once) in zip(candidates, in_table)}
+		if pool is None:
+			unique = is_unique(candidates)
+		else:
+			unique = pool.verdicts(('unique', genome_id), candidates, is_unique)
+		unique_candidates = [c for c in candidates if unique[c['name']]]
+		counters['candidates_out'] = len(unique_candidates)
+	return unique_candidates
+
+
+def add_fingerprints(candidates, genome_seq, config=DEFAULT_CONFIG):
+	# Sets each candidate's 'fp_seq', the 20bp next to its integration site
 	for candidate in candidates:
 		if 'fw' in candidate['name']:
 			# for fw strand inserts, the fingerprint is downstream
-			fp_start = candidate['location'] + SPACER_LENGTH + INTEGRATION_SITE_DISTANCE - 20
-			fp_end = candidate['location'] + SPACER_LENGTH + INTEGRATION_SITE_DISTANCE
+			fp_start = candidate['location'] + config.SPACER_LENGTH + config.INTEGRATION_SITE_DISTANCE - 20
+			fp_end = candidate['location'] + config.SPACER_LENGTH + config.INTEGRATION_SITE_DISTANCE
 			fp_seq = genome_seq[fp_start:fp_end]
 		else:
 			# for rv strand inserts, the fingerprint is upstream
-			fp_start = candidate['location'] - SPACER_LENGTH - INTEGRATION_SITE_DISTANCE
-			fp_end = candidate['location'] - SPACER_LENGTH - INTEGRATION_SITE_DISTANCE + 20
+			fp_start = candidate['location'] - config.SPACER_LENGTH - config.INTEGRATION_SITE_DISTANCE
+			fp_end = candidate['location'] - config.SPACER_LENGTH - config.INTEGRATION_SITE_DISTANCE + 20
 			fp_seq = genome_seq[fp_start:fp_end].reverse_complement()
 		name = candidate['name']
 		candidate['fp_seq'] = SeqRecord(fp_seq, id=name, name=name, description=name)
-	genome_both_ways = genome.upper()+genome.reverse_complement().upper()
-	unique_candidates = [c for c in candidates if genome_both_ways.count(c["seqrec"].seq) == 1]
-	return unique_candidates
-
+	return candidates
 
-def order_candidates_for_region(candidates, region, coding_spacer_direction):
+def order_candidates_for_region(candidates, region, coding_spacer_direction, config=DEFAULT_CONFIG):
 	is_fwd_strand_and_NtoC = coding_spacer_direction == 'N_to_C' and region['direction'] == 'fw'
 	is_rv_strand_and_CtoN = coding_spacer_direction == 'C_to_N' and region['direction'] == 'rv'
 
@@ -98,31 +137,31 @@ def order_candidates_for_region(candidates, region, coding_spacer_direction):
 	else:
 		reverse = True
 	# The lambda sort functions is to sort by the target site location instead of the spacer location
-	return sorted(candidates,key=(lambda c: c['location'] + INTEGRATION_SITE_DISTANCE if 'fw' in c['name'] else (c['location'] - INTEGRATION_SITE_DISTANCE)), reverse=reverse)
+	return sorted(candidates,key=(lambda c: c['location'] + config.INTEGRATION_SITE_DISTANCE if 'fw' in c['name'] else (c['location'] - config.INTEGRATION_SITE_DISTANCE)), reverse=reverse)
 
-def candidate_overlaps(candidate, overlap_regions):
+def candidate_overlaps(candidate, overlap_regions, config=DEFAULT_CONFIG):
 	loc = candidate['location']
-	end_loc = loc+SPACER_LENGTH
+	end_loc = loc+config.SPACER_LENGTH
 	start_overlaps_matches = any([loc > m[0] and loc < m[1] for m in overlap_regions])
 	end_overlaps_matches = any([end_loc > m[0] and end_loc < m[1] for m in overlap_regions])
 	return start_overlaps_matches or end_overlaps_matches
 
-def choose_next_offtarget_batch(remaining_candidates, matches, overlapping_spacers, batch_size):
+def choose_next_offtarget_batch(remaining_candidates, matches, overlapping_spacers, batch_size, config=DEFAULT_CONFIG):
 	if overlapping_spacers == 'allowed':
 		return remaining_candidates[:batch_size]
 
 	# Return a batch of up to 10 candidates to test for off-target activity
-	existing_spacer_areas = [[m['location'], m['location']+SPACER_LENGTH] for m in matches]
+	existing_spacer_areas = [[m['location'], m['location']+config.SPACER_LENGTH] for m in matches]
 
 	# First try and search for spacers that also wouldn't overlap with each other, to minimize
 	# unnecessary slow offtarget searches
 	to_check = []
 	optimistically_avoid = []
 	for c in remaining_candidates:
-		overlaps = candidate_overlaps(c, existing_spacer_areas.copy() + optimistically_avoid)
+		overlaps = candidate_overlaps(c, existing_spacer_areas.copy() + optimistically_avoid, config)
 		if not overlaps:
 			to_check.append(c)
-			optimistically_avoid.append([c['location'], c['location']+SPACER_LENGTH])
+			optimistically_avoid.append([c['location'], c['location']+config.SPACER_LENGTH])
 		if len(to_check) >= batch_size:
 			return to_check[:batch_size]
 
@@ -130,7 +169,7 @@ def choose_next_offtarget_batch(remaining_candidates, matches, overlapping_space
 	# These will be filtered aftwards if necessary
 	for c in remaining_candidates:
 		if c not in to_check:
-			overlaps = candidate_overlaps(c, existing_spacer_areas.copy() + optimistically_avoid)
+			overlaps = candidate_overlaps(c, existing_spacer_areas.copy() + optimistically_avoid, config)
 			if overlaps:
 				to_check.append(c)
 			if len(to_check) >= batch_size:
@@ -143,50 +182,83 @@ def choose_next_offtarget_batch(remaining_candidates, matches, overlapping_space
 	return to_check[:batch_size]
 
 
-def remove_offtarget_matches(genbank_id, name, candidates, minMatches, overlapping_spacers, check_all=False):
+def remove_offtarget_matches(genbank_id, name, candidates, minMatches, overlapping_spacers, check_all=False, config=DEFAULT_CONFIG, pool=None, prefilter=None):
+	# pool (a pool.CandidatePool) reuses the verdicts of candidates another region of the run already tested
+	# prefilter (a prefilter.OfftargetPrefilter of genbank_id) passes candidates without any near site before bowtie2 runs
+	with stage('remove_offtarget_matches', genome=genbank_id, candidates_in=len(candidates)) as counters:
+		no_offtargets = _remove_offtarget_matches(genbank_id, name, candidates, minMatches, overlapping_spacers, check_all, config, pool, prefilter)
+		counters['candidates_out'] = len(no_offtargets)
+	return no_offtargets
+
+def _remove_offtarget_matches(genbank_id, name, candidates, minMatches, overlapping_spacers, check_all, config, pool=None, prefilter=None):
 	no_offtargets = []
 	untested = candidates.copy()
+	align = lambda test_candidates: offtarget_verdicts(genbank_id, name, test_candidates, config, prefilter)
 	while len(no_offtargets) < minMatches and len(untested) > 0:
 		print(f"Testing candidates for off-target activity against {genbank_id}... {len(untested)} candidates remain")
 		# Use 10 as the batch size to check for bowtie off-target matches
-		test_candidates = choose_next_offtarget_batch(untested, no_offtargets, overlapping_spacers, len(untested) if check_all else 10)
-		# Get the candidate sequences to use, and
-		# make every 6th bp an N to allow for ambiguous matches
-		match_seqs = [c['seqrec'].upper() for c in test_candidates]
-		if flex_base:
-			for seq in match_seqs:
-				flexible_seq = seq.seq[:]
-				for i in range(flex_spacing-1, SPACER_LENGTH, flex_spacing):
-					flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
-				seq.seq = flexible_seq
-
-		# Write the batch of candidate sequences to a fasta for bowtie2 to use
-		fasta_name = name+'-candidates.fasta'
-		root_dir = Path(__file__).parent.parent
-		fasta_name = os.path.join(root_dir, 'assets', 'bowtie', genbank_id, fasta_name)
-
-		os.makedirs( os.path.join(root_dir, 'assets', 'bowtie', genbank_id), exist_ok=True)
-
-		with open(fasta_name, 'w') as targets_file:
-			SeqIO.write(match_seqs, targets_file, 'fasta')
-
-		output_location = find_offtargets(genbank_id, fasta_name)
-
-		filtered_candidates = []
-		sam_reads = []
-		with open(output_location, 'r') as sam_file:
-			reader = samReader(sam_file)
-			sam_reads = [r for r in reader]
-
+		test_candidates = choose_next_offtarget_batch(untested, no_offtargets, overlapping_spacers, len(untested) if check_all else 10, config)
+		if pool is None:
+			verdicts = align(test_candidates)
+		else:
+			verdicts = pool.verdicts(('offtarget', genbank_id), test_candidates, align)
 		for c in test_candidates:
-			reads = [r for r in sam_reads if r.safename == c['name']]
-			if len(reads) <= 1:
+			if verdicts[c['name']]:
 				no_offtargets.append(c)
 			untested.remove(c)
 
-		os.remove(fasta_name)
-		os.remove(output_location)
 		# return once at least minMatches are found without off-targets
 		if len(no_offtargets) >= minMatches and not check_all:
 			return no_offtargets[:minMatches]
 	return no_offtargets
+
+def offtarget_verdicts(genbank_id, name, test_candidates, config=DEFAULT_CONFIG, prefilter=None):
+	# {candidate name: True if it has no off-targets in genbank_id}, from one bowtie2 run
+	# for the candidates prefilter doesn't find clean
+	verdicts = {}
+	if prefilter is not None:
+		[clean, test_candidates] = prefilter.split(test_candidates, config)
+		verdicts.update({c['name']: True for c in clean})
+		if not len(test_candidates):
+			return verdicts
+
+	# Get the candidate sequences to use, and
+	# make every 6th bp an N to allow for ambiguous matches
+	match_seqs = [c['seqrec'].upper() for c in test_candidates]
+	if config.flex_base:
+		for seq in match_seqs:
+			flexible_seq = seq.seq[:]
+			for i in range(config.flex_spacing-1, config.SPACER_LENGTH, config.flex_spacing):
+				flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
+			seq.seq = flexible_seq
+
+	# Write the batch of candidate sequences to a fasta for bowtie2 to use
+	# The file name is unique so concurrent runs for the same region name don't collide
+	root_dir = Path(__file__).parent.parent
+	os.makedirs( os.path.join(root_dir, 'assets', 'bowtie', genbank_id), exist_ok=True)
+	(fasta_handle, fasta_name) = tempfile.mkstemp(prefix=name.replace('-', '_').replace('.', '_')+'_candidates_', suffix='.fasta',
+												  dir=os.path.join(root_dir, 'assets', 'bowtie', genbank_id))
+
+	with os.fdopen(fasta_handle, 'w') as targets_file:
+		SeqIO.write(match_seqs, targets_file, 'fasta')
+
+	output_location = find_offtargets(genbank_id, fasta_name, config)
+
+	sam_reads = []
+	with stage('sam_parsing') as counters:
+		with open(output_location, 'r') as sam_file:
+			reader = samReader(sam_file)
+			sam_reads = [r for r in reader]
+		counters['reads_aligned'] = len(sam_reads)
+
+	aligned = {}
+	for c in test_candidates:
+		reads = [r for r in sam_reads if r.safename == c['name']]
+		aligned[c['name']] = len(reads) <= 1
+	if prefilter is not None:
+		prefilter.record_alignments(aligned)
+	verdicts.update(aligned)
+
+	os.remove(fasta_name)
+	os.remove(output_location)
+	return verdicts
@@ -2,20 +2,104 @@ import sys
 import json
 import csv
 import os
+import gzip
+import threading
+from collections import OrderedDict
+from bisect import bisect_right
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-import boto3
-import botocore
-from Bio import Entrez, SeqIO
+from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from bowtie import build
-from advanced_parameters import minimum_intergenic_region_length
+from config import DEFAULT_CONFIG
 
+# Used by the disabled S3 cache code below, which needs boto3 and botocore imported where it's turned back on
 S3_BUCKET = 'lab-script-resources'
 
+# Contigs of multi-record genomes are joined with this between them, so no spacer spans two contigs
+CONTIG_SEPARATOR = 'N' * 100
+
+# Parsed records are kept in memory, so repeated lookups within one process (several regions,
+# or several jobs in a long-running service) don't re-parse the same genbank/fasta file
+# Up to MAX_LOADED_RECORDS are kept, the least recently used are dropped
+MAX_LOADED_RECORDS = 16
+loaded_records = OrderedDict()
+_loaded_records_lock = threading.Lock()
+
+def open_genome_file(path):
+	# Plain text, gzip or bgzip (blocked gzip, read the same way) files, recognised by content rather than name
+	with open(path, 'rb') as f:
+		compressed = f.read(2) == b'\x1f\x8b'
+	return gzip.open(path, 'rt') if compressed else open(path, 'r')
+
+def read_contigs(path, file_format):
+	# Streams the records (chromosomes, plasmids, contigs) of a genome file one at a time
+	with open_genome_file(path) as handle:
+		for record in SeqIO.parse(handle, file_format):
+			yield record
+
+def join_contigs(records):
+	# One record for a multi-record genome, with the contigs separated by CONTIG_SEPARATOR and their features shifted
+	# record.annotations['contigs'] is the contig table: the id, length and 0-based offset in the joined sequence of each contig
+	contigs = []
+	seqs = []
+	features = []
+	offset = 0
+	for record in records:
+		contigs.append({'id': record.id, 'length': len(record.seq), 'offset': offset})
+		seqs.append(str(record.seq))
+		features += [f._shift(offset) for f in record.features]
+		offset += len(record.seq) + len(CONTIG_SEPARATOR)
+	first = records[0]
+	joined = SeqRecord(Seq(CONTIG_SEPARATOR.join(seqs)), id=first.id, name=first.name, description=first.description, features=features)
+	joined.annotations = dict(first.annotations, contigs=contigs)
+	return joined
+
+def load_genome_file(path, file_format):
+	# file_format is a Bio.SeqIO format, 'genbank' or 'fasta'. Multi-record and gzipped files are joined into one record
+	path = Path(path).absolute()
+	cache_key = (str(path), file_format, os.path.getmtime(path))
+	with _loaded_records_lock:
+		if cache_key in loaded_records:
+			loaded_records.move_to_end(cache_key)
+			return loaded_records[cache_key]
+	record = join_contigs(list(read_contigs(path, file_format)))
+	with _loaded_records_lock:
+		loaded_records[cache_key] = record
+		while len(loaded_records) > MAX_LOADED_RECORDS:
+			loaded_records.popitem(last=False)
+	return record
+
+def loaded_genome_paths():
+	with _loaded_records_lock:
+		return [key[0] for key in loaded_records.keys()]
+
+def unload_genome_file(path):
+	# Drops the parsed records of path (of any format or mtime) from loaded_records
+	path = str(Path(path).absolute())
+	with _loaded_records_lock:
+		for key in [k for k in loaded_records if k[0] == path]:
+			del loaded_records[key]
+
+def contig_table(record):
+	# The contigs of a record loaded with load_genome_file, or the record as a single contig
+	return record.annotations.get('contigs', [{'id': record.id, 'length': len(record.seq), 'offset': 0}])
+
+def contig_location(contigs, location):
+	# [contig id, location within the contig] for a 1-based location in a joined genome
+	index = max(bisect_right([c['offset'] for c in contigs], location - 1) - 1, 0)
+	return [contigs[index]['id'], location - contigs[index]['offset']]
+
+def contig_offset(contigs, contig_id):
+	# Offset of a contig in the joined genome, None if the genome has no such contig
+	for c in contigs:
+		if c['id'] == contig_id:
+			return c['offset']
+	return None
+
 def get_from_cache(genbank_id, return_record=True):
 	root_dir = Path(__file__).parent.parent
 	genbank_assets_path = os.path.join(root_dir, 'assets', 'genbank')
@@ -35,12 +119,12 @@ def get_from_cache(genbank_id, return_record=True):
 			if e.response['Error']['Code'] == "404":
 				return False'''
 
-	with open(local_gb, 'r') as f:
-		seq = SeqIO.read(f, 'gb')
-		fasta_path = os.path.join(genbank_assets_path,  f'{genbank_id}.fasta')
-		if not Path(fasta_path).exists():
-			with open(fasta_path, 'w') as fasta:
-				SeqIO.write(seq, fasta, 'fasta')
+	seq = load_genome_file(local_gb, 'gb')
+	fasta_path = os.path.join(genbank_assets_path,  f'{genbank_id}.fasta')
+	if not Path(fasta_path).exists():
+		# one fasta record per contig, so off-target hits are reported in contig coordinates
+		with open(fasta_path, 'w') as fasta:
+			SeqIO.write(read_contigs(local_gb, 'gb'), fasta, 'fasta')
 	build(genbank_id)
 	return seq
 
@@ -50,7 +134,7 @@ def save_to_cache(genbank_id, record):
 	os.makedirs(genbank_assets_path, exist_ok=True)
 	local_gb = os.path.join(genbank_assets_path, f'{genbank_id}.gb')
 
-	s3 = boto3.client('s3')
+	#s3 = boto3.client('s3')
 	genbank_key = f"genbank/{genbank_id}.gb"
 	with open(local_gb, 'w') as f:
 		SeqIO.write(record, f, 'gb')
@@ -63,12 +147,13 @@ def save_to_cache(genbank_id, record):
 	return
 
 def retrieve_annotation(genbank_id, email, return_record=True):
-	# *Always* tell NCBI who you are
-	Entrez.email = email
-
 	cached = get_from_cache(genbank_id, return_record)
 	if cached:
 		return cached
+	# imported only when something is downloaded, most runs use the local cache
+	from Bio import Entrez
+	# *Always* tell NCBI who you are
+	Entrez.email = email
 	"""
 	Annotates Entrez Gene IDs using Bio.Entrez, in particular epost (to
 	submit the data to NCBI) and esummary to retrieve the information.
@@ -84,7 +169,7 @@ def retrieve_annotation(genbank_id, email, return_record=True):
 	save_to_cache(genbank_id, result)
 	return result
 
-def get_noncoding_regions_from_genes(genes, genome, nonessential):
+def get_noncoding_regions_from_genes(genes, genome, nonessential, config=DEFAULT_CONFIG):
 	genome_end = len(genome)
 	noncoding_regions = []
 
@@ -92,7 +177,7 @@ def get_noncoding_regions_from_genes(genes, genome, nonessential):
 	prev_gene = {'end': -1, 'direction': 'none'}
 	while gene_index < len(genes):
 		next_gene = genes[gene_index]
-		if (int(next_gene['start']) - int(prev_gene['end'])) > minimum_intergenic_region_length:
+		if (int(next_gene['start']) - int(prev_gene['end'])) > config.minimum_intergenic_region_length:
 			# add check for essentiality, if it's a parameter only use noncoding regions with
 			# C term on each side (aka, prev gene orientation is 'fw' and next gene orientation is 'rv')
 			if not nonessential or (prev_gene['direction'] == 'fw' and next_gene['direction'] == 'rv'):
@@ -137,7 +222,7 @@ def basic_gene_info(gene, genes_metadata=None):
 		"essential": essential
 	}
 
-def get_regions(genbank, region='coding'):
+def get_regions(genbank, region='coding', config=DEFAULT_CONFIG):
 	genes = [feat for feat in genbank.features if feat.type == 'gene']
 	genes_metadata = []
 	# TODO: allow a generic input file here that has gene essentiality information
@@ -145,7 +230,7 @@ def get_regions(genbank, region='coding'):
 	genes = [basic_gene_info(g, genes_metadata) for g in genes]
 	if region == 'noncoding' or region == 'nonessential':
 		genome = genbank.seq
-		noncoding_regions = get_noncoding_regions_from_genes(genes, genome, region=='nonessential')
+		noncoding_regions = get_noncoding_regions_from_genes(genes, genome, region=='nonessential', config)
 		return noncoding_regions
 	if region == 'coding_nonessential':
 		return [g for g in genes if not g['essential']]
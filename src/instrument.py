@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+import subprocess
+import contextvars
+from contextlib import contextmanager
+
+# Stage-level timing and counters for a run
+# Every instrumented stage records wall time, CPU time of the thread running it, CPU time of the
+# subprocesses (bowtie2) it ran with run_subprocess, and any counters the stage sets (candidates in/out,
+# reads aligned, bytes written, subprocesses...). Events are kept in memory until export_trace is called.
+#
+# Events go to the run's Trace. Each spacer_gen / spacer_eval call starts its own with new_trace, so
+# concurrent runs (service jobs) keep separate traces. The trace is held in a context variable:
+# threads a run starts get it by running their work through in_context.
+
+TRACE_FORMATS = ['json', 'chrome']
+
+class Trace():
+	'''
+	The stage events of one run.
+	'''
+
+	def __init__(self):
+		self.events = []
+		self.lock = threading.Lock()
+		self.start = time.perf_counter()
+
+	def record(self, event):
+		with self.lock:
+			self.events.append(event)
+
+	def recorded(self):
+		with self.lock:
+			return list(self.events)
+
+	def summary(self):
+		# Totals per stage name: number of calls, times, and summed counters
+		totals = {}
+		for e in self.recorded():
+			total = totals.setdefault(e['name'], {'calls': 0, 'wall_time': 0, 'cpu_time': 0, 'child_cpu_time': 0, 'counters': {}})
+			total['calls'] += 1
+			total['wall_time'] += e['wall_time']
+			total['cpu_time'] += e['cpu_time']
+			total['child_cpu_time'] += e['child_cpu_time']
+			for (key, value) in e['counters'].items():
+				if isinstance(value, (int, float)):
+					total['counters'][key] = total['counters'].get(key, 0) + value
+		return totals
+
+# Stages outside of any run (e.g. a Designer used directly) are recorded here
+_process_trace = Trace()
+_trace = contextvars.ContextVar('trace', default=_process_trace)
+# The stages open in the current context, innermost last, that subprocess CPU time is added to
+_open_stages = contextvars.ContextVar('open_stages', default=())
+_child_cpu_lock = threading.Lock()
+
+def current_trace():
+	return _trace.get()
+
+def new_trace():
+	# Starts a new trace for the run in the current context (and the threads it starts with in_context)
+	trace = Trace()
+	_trace.set(trace)
+	return trace
+
+def in_context(func):
+	# func wrapped to run in a copy of the current context, for threads and executors, so the stages
+	# it runs go to the current trace and its subprocesses count towards the stages open here
+	context = contextvars.copy_context()
+	return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+@contextmanager
+def stage(name, **counters):
+	# Usage:
+	# with stage('filter_homopolymers', candidates_in=len(candidates)) as counters:
+	#     ...
+	#     counters['candidates_out'] = len(filtered)
+	counters = dict(counters)
+	trace = current_trace()
+	opened = {'child_cpu_time': 0.0}
+	token = _open_stages.set(_open_stages.get() + (opened,))
+	wall_start = time.perf_counter()
+	cpu_start = time.thread_time()
+	try:
+		yield counters
+	finally:
+		_open_stages.reset(token)
+		trace.record({
+			'name': name,
+			'start': wall_start - trace.start,
+			'wall_time': time.perf_counter() - wall_start,
+			'cpu_time': time.thread_time() - cpu_start,
+			'child_cpu_time': opened['child_cpu_time'],
+			'thread': threading.get_ident(),
+			'counters': counters
+		})
+
+def run_subprocess(command):
+	# subprocess.run(command, shell=True, check=True) with the output discarded. The CPU time of the process
+	# (and everything it waited for) is added to every stage open in the current context, and only to those
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	(_, status, usage) = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+	with _child_cpu_lock:
+		for opened in _open_stages.get():
+			opened['child_cpu_time'] += usage.ru_utime + usage.ru_stime
+	if process.returncode != 0:
+		raise subprocess.CalledProcessError(process.returncode, command)
+
+def summary():
+	return current_trace().summary()
+
+def export_trace(path, trace_format='json', run_info=None):
+	# 'json' writes the per-stage summary and every event of the current trace
+	# 'chrome' writes the Chrome trace event format, viewable in chrome://tracing or ui.perfetto.dev
+	if trace_format not in TRACE_FORMATS:
+		raise Exception(f"Unknown trace format '{trace_format}', must be one of {TRACE_FORMATS}")
+	trace = current_trace()
+	recorded = trace.recorded()
+	if trace_format == 'json':
+		output = {'run': run_info or {}, 'stages': trace.summary(), 'events': recorded}
+	else:
+		output = {'traceEvents': [{
+			'name': e['name'],
+			'ph': 'X',
+			'ts': round(e['start'] * 1e6),
+			'dur': round(e['wall_time'] * 1e6),
+			'pid': os.getpid(),
+			'tid': e['thread'],
+			'args': dict(e['counters'], cpu_time=e['cpu_time'], child_cpu_time=e['child_cpu_time'])
+		} for e in recorded], 'otherData': run_info or {}}
+	with open(path, 'w') as trace_file:
+		json.dump(output, trace_file, indent=1, default=str)
+	return path
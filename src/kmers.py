@@ -0,0 +1,99 @@
+import numpy as np
+
+# Sequences are encoded as one uint8 per base: A=0, C=1, G=2, T=3, anything else (N, gaps, ambiguity codes)=4
+# k-mers of up to 32bp are packed 2 bits per base into a uint64, with the first base in the highest bits
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for (code, base) in enumerate('ACGT'):
+	BASE_CODES[ord(base)] = code
+	BASE_CODES[ord(base.lower())] = code
+CODE_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+def encode_seq(seq):
+	# seq can be a str, Bio.Seq or bytes
+	if not isinstance(seq, (bytes, bytearray)):
+		seq = str(seq).encode('ascii')
+	return BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+def decode_codes(codes):
+	return CODE_BASES[codes].tobytes().decode('ascii')
+
+def reverse_complement_codes(codes):
+	rc = 3 - codes[::-1]
+	rc[codes[::-1] == 4] = 4
+	return rc
+
+def pack_kmers(codes, k):
+	# Packs the k-mer starting at every position of codes (a 1d array), or of every row of codes
+	# (a 2d array). Returns [kmers, valid] where valid is False for k-mers containing a non-ACGT base
+	if k > 32:
+		raise Exception(f"k-mers longer than 32bp cannot be packed, got k={k}")
+	codes = np.asarray(codes)
+	n = codes.shape[-1] - k + 1
+	if n <= 0:
+		empty_shape = codes.shape[:-1] + (0,)
+		return [np.zeros(empty_shape, dtype=np.uint64), np.zeros(empty_shape, dtype=bool)]
+	kmers = np.zeros(codes.shape[:-1] + (n,), dtype=np.uint64)
+	invalid = np.zeros(codes.shape[:-1] + (n,), dtype=bool)
+	for j in range(k):
+		window = codes[..., j:j+n]
+		kmers = (kmers << np.uint64(2)) | (window & 3).astype(np.uint64)
+		invalid |= window == 4
+	return [kmers, ~invalid]
+
+def build_kmer_index(seqs, k):
+	# Sorted array of the distinct k-mers found on both strands of every sequence in seqs
+	indexed = []
+	for seq in seqs:
+		codes = encode_seq(seq)
+		for strand in [codes, reverse_complement_codes(codes)]:
+			[kmers, valid] = pack_kmers(strand, k)
+			indexed.append(kmers[valid])
+	if not indexed:
+		return np.zeros(0, dtype=np.uint64)
+	return np.unique(np.concatenate(indexed))
+
+def count_kmers(seqs, k):
+	# [kmers, counts] for every k-mer on both strands of every sequence in seqs, kmers sorted
+	indexed = []
+	for seq in seqs:
+		codes = encode_seq(seq)
+		for strand in [codes, reverse_complement_codes(codes)]:
+			[kmers, valid] = pack_kmers(strand, k)
+			indexed.append(kmers[valid])
+	if not indexed:
+		return [np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)]
+	return np.unique(np.concatenate(indexed), return_counts=True)
+
+def in_kmer_index(index, kmers):
+	# Boolean array, True where a k-mer is present in a sorted k-mer index
+	if not len(index):
+		return np.zeros(np.shape(kmers), dtype=bool)
+	positions = np.minimum(np.searchsorted(index, kmers), len(index) - 1)
+	return index[positions] == kmers
+
+def unique_kmer_table(seq, k):
+	# Sorted k-mers that occur exactly once on both strands of seq together
+	codes = encode_seq(seq)
+	kmers = []
+	for strand in [codes, reverse_complement_codes(codes)]:
+		[strand_kmers, valid] = pack_kmers(strand, k)
+		kmers.append(strand_kmers[valid])
+	return kmers_seen_once(np.concatenate(kmers))
+
+def kmers_in_table(table, seqs, k):
+	# Boolean array, True where each of seqs (all k long) is in a sorted k-mer table. Seqs with a non-ACGT base never are
+	if not len(seqs):
+		return np.zeros(0, dtype=bool)
+	[kmers, valid] = pack_kmers(np.stack([encode_seq(s) for s in seqs]), k)
+	return in_kmer_index(table, kmers[:, 0]) & valid[:, 0]
+
+def kmers_seen_once(kmers):
+	# Sorted k-mers that occur exactly once in kmers (sorting and comparing neighbours is much faster than a hash-based np.unique)
+	kmers = np.sort(kmers)
+	if len(kmers) < 2:
+		return kmers
+	differs = kmers[1:] != kmers[:-1]
+	single = np.ones(len(kmers), dtype=bool)
+	single[1:] &= differs
+	single[:-1] &= differs
+	return kmers[single]
@@ -1,22 +1,26 @@
-import json
-import time
 import os
 import csv
 from pathlib import Path
 
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from Bio import SeqIO
-
-from genbank import retrieve_annotation, get_regions
-from finder import get_target_region_for_gene, get_candidates_for_region, remove_offtarget_matches, order_candidates_for_region
-from outputs import make_spacer_gen_output, make_eval_outputs
+from designer import Designer, DesignerInputError
+from config import make_config
 from parse import extract_column_from_csv
-from bowtie import find_offtargets, build as bowtie_build
-from filters import filter_non_unique_fingerprints, filter_re_sites, filter_homopolymers
-from advanced_parameters import SPACER_LENGTH, flex_base, flex_spacing
-
-def spacer_gen(args):
+from report import REPORT_FORMATS
+from instrument import new_trace, export_trace
+
+# The modules of optional run modes (conserved, tiling, sharding, catalogs, sweeps, the pipeline and
+# pangenome screens) are imported where their mode runs, so short runs only load what they use.
+# benchmark.py --startup checks the import time of this module
+
+def input_config(args):
+	# The run's Config from args['config'], a DesignerInputError if it is invalid
+	try:
+		return make_config(args.get('config'))
+	except (TypeError, ValueError) as e:
+		raise DesignerInputError(f"Invalid config: {e}")
+
+def spacer_gen(args, designer=None, raise_input_errors=False):
+	# Invalid input is printed and None returned, or with raise_input_errors, raised as a DesignerInputError
 	# unpack the arguments
 	email = args['email']
 	nonessential_only = args['nonessential_only']
@@ -35,194 +39,151 @@ def spacer_gen(args):
 	noncoding_boundary = args['noncoding_boundary']
 	custom_regions_csv = args['custom_regions_csv']
 	custom_sequences = args['custom_sequences']
-
-	# Check for required parameters
-	if region_type not in ['coding', 'noncoding', 'custom']:
-		print("region_type must be either 'coding', 'noncoding', or 'custom")
+	sweep_settings = args.get('sweep_settings', [])
+	pipelined = args.get('pipelined', False)
+	queue_dir = args.get('queue_dir', '')
+	shard_size = args.get('shard_size', 20)
+	catalog = args.get('catalog', '')
+	trace_output = args.get('trace_output', '')
+	new_trace()
+
+	try:
+		# Check for required parameters
+		config = input_config(args)
+
+		if region_type not in ['coding', 'noncoding', 'custom', 'conserved', 'genome']:
+			raise DesignerInputError("region_type must be either 'coding', 'noncoding', 'custom', 'conserved' or 'genome'")
+
+		# each of these runs the design its own way, only one can be used at a time
+		modes = {"region_type 'genome'": region_type == 'genome', 'queue_dir': bool(queue_dir), 'catalog': bool(catalog),
+				 'sweep_settings': bool(len(sweep_settings)), 'pipelined': bool(pipelined)}
+		if len([mode for (mode, used) in modes.items() if used]) > 1:
+			raise DesignerInputError(f"Only one of {', '.join(modes.keys())} can be used at a time, got {', '.join([mode for (mode, used) in modes.items() if used])}")
+
+		# Load genome data, unless an existing design session for these genomes was passed in
+		if designer is None:
+			designer = Designer(genbank_ids, genbank_files, genome_fasta_files, email, config)
+
+		print("Starting spacer search...")
+		# Generate regions for each region_type
+		if region_type == 'coding':
+			target_locus_tag_ids = extract_column_from_csv(target_locus_tags_csv, 'locus_tags')
+			regions = designer.coding_regions(target_locus_tag_ids)
+
+		if region_type == 'noncoding':
+			regions = designer.noncoding_regions(noncoding_boundary, nonessential_only, config)
+			start_pct = 0
+			end_pct = 100
+
+		if region_type == 'genome':
+			# every gene and intergenic region, designed together by tile_genome below
+			coding_regions = designer.coding_regions(set([gene['name'] for gene in designer.genes('coding')]))
+			noncoding_regions = designer.noncoding_regions([0, float('inf')], nonessential_only, config)
+			regions = coding_regions + noncoding_regions
+
+		if region_type == 'conserved':
+			# spacers found exactly once in every genome, optionally only within the target locus tags of the first genome
+			regions = designer.coding_regions(extract_column_from_csv(target_locus_tags_csv, 'locus_tags')) if target_locus_tags_csv else None
+
+		if region_type == 'custom':
+			custom_regions = []
+			if len(custom_regions_csv):
+				if not Path(custom_regions_csv).exists():
+					raise DesignerInputError("Must input a valid filepath for the custom regions csv")
+				with open(Path(custom_regions_csv), 'r', encoding='utf-8-sig') as csv_file:
+					reader = csv.DictReader(csv_file)
+					custom_regions = [r for r in reader]
+			regions = designer.custom_regions(custom_regions, custom_sequences)
+			start_pct = 0
+			end_pct = 100
+
+		# what spacer_gen returns: the regions with their spacers, unless set otherwise below
+		result = regions
+		if region_type == 'conserved':
+			from conserved import find_conserved_spacers, make_conserved_output, CONSERVED_OUTPUT
+			genomes = designer.genome_sequences()
+			result = find_conserved_spacers(genomes, GC_requirement, regions, config)
+			make_conserved_output(result, list(genomes.keys()), os.path.join(output_path, CONSERVED_OUTPUT), config)
+		elif region_type == 'genome':
+			from tiling import tile_genome
+			tile_genome(designer, coding_regions, noncoding_regions, start_pct, end_pct, spacers_per_region, GC_requirement, overlapping_spacers,
+						coding_spacer_direction, output_path=output_path, config=config)
+		elif queue_dir:
+			# only split the regions into shards, workers started with 'python shards.py worker' design them
+			job = {'genbank_ids': genbank_ids, 'genbank_files': genbank_files, 'genome_fasta_files': genome_fasta_files, 'email': email,
+				   'start_pct': start_pct, 'end_pct': end_pct, 'spacers_per_region': spacers_per_region, 'GC_requirement': GC_requirement,
+				   'overlapping_spacers': overlapping_spacers, 'coding_spacer_direction': coding_spacer_direction if region_type == 'coding' else None,
+				   'config': config.as_dict(), 'output_path': output_path}
+			from shards import create_queue
+			create_queue(queue_dir, job, regions, shard_size)
+		elif catalog:
+			# spacers from a precomputed catalog, no bowtie2 runs
+			from catalog import design_from_catalog
+			design_from_catalog(designer, regions, catalog if isinstance(catalog, str) else None, start_pct, end_pct, spacers_per_region, GC_requirement,
+								overlapping_spacers, coding_spacer_direction if region_type == 'coding' else None, output_path=output_path, config=config)
+		elif len(sweep_settings):
+			# one off-target search for all of the settings, returns the spacers found with each setting
+			from sweep import sweep
+			result = sweep(designer, regions, sweep_settings, start_pct, end_pct, spacers_per_region, GC_requirement, overlapping_spacers,
+								  coding_spacer_direction if region_type == 'coding' else None, output_path=output_path, config=config)
+		elif pipelined:
+			from pipeline import design_pipelined
+			design_pipelined(designer, regions, start_pct, end_pct, spacers_per_region, GC_requirement, overlapping_spacers,
+							 coding_spacer_direction if region_type == 'coding' else None, output_path=output_path, config=config)
+		else:
+			designer.design(regions, start_pct, end_pct, spacers_per_region, GC_requirement, overlapping_spacers,
+							coding_spacer_direction if region_type == 'coding' else None, output_path=output_path, config=config)
+	except DesignerInputError as e:
+		if raise_input_errors:
+			raise
+		print(e)
 		return
 
-	# Load genome data
-	genome_input_type = None
-	if len(genbank_ids):
-		if not email or '@' not in email:
-			print("Please enter an email for NCBI API calls")
-			return
-		genome_input_type = 'genbank_ids'
-		default_genome_id = genbank_ids[0]
-		record = retrieve_annotation(default_genome_id, email)
-		for genbank_id in genbank_ids:
-			retrieve_annotation(genbank_id, email, return_record=False)
-		genome_ids = genbank_ids
-
-	elif len(genbank_files):
-		for genbank_file in genbank_files:
-			if not Path(genbank_file).exists():
-				print("Invalid genbank_file provided. Either leave it empty or provide a valid file path. ")
-				return
-		genome_input_type = 'genbank_files'
-		default_genome_id = genbank_files[0]
-		record = SeqIO.read(Path(default_genome_id), 'genbank')
-		genome_ids = []
-		for genbank_file in genbank_files:
-			record = SeqIO.read(Path(default_genome_id), 'genbank')
-			genome_ids += [record.id]
-	elif genome_fasta_files:
-		for genome_fasta_file in genome_fasta_files:
-			if not Path(genome_fasta_file).exists():
-				print(f"Invalid genome_fasta_file provided: {genome_fasta_file}. Either leave it empty or provide a valid file path. ")
-				return
-			without_filetype = genome_fasta_file[:-6].split('/')[-1]
-			bowtie_build(without_filetype, fasta_file=Path(genome_fasta_file).absolute())
-		if not region_type == 'custom':
-			print("Cannot do coding or noncoding spacer generation against a fasta file. Use a genbank input or use custom regions against this fasta. ")
-			return
-		genome_input_type = 'fasta_files'
-		genome_ids = []
-		for genome_fasta_file in genome_fasta_files:
-			record = SeqIO.read(Path(genome_fasta_file), "fasta")
-			genome_ids += [record.id]
-
-	print("Starting spacer search...")
-	# Generate coding regions for each region_type
-	if region_type == 'coding':
-		all_genes = get_regions(record, region='coding')
-
-		# match gene names case insensitive, lowercase both sides
-		target_locus_tag_ids = extract_column_from_csv(target_locus_tags_csv, 'locus_tags')
-		target_genes = [gene for gene in all_genes if gene['name'] in target_locus_tag_ids]
-		if not len(target_genes):
-			print(f"You must enter at least one valid locus tag identifier, ex. {all_genes[0]['name']}")
-			return
-		regions = target_genes
-		for r in regions:
-			r['genome_input_type'] = genome_input_type
-			r['genome_id'] = default_genome_id
-
-	if region_type == 'noncoding':
-		if len(noncoding_boundary) != 2:
-			print("You must specify the boundaries around which to search for noncoding regions")
-			return
-		region_name = 'nonessential' if nonessential_only else 'noncoding'
-		all_noncoding = get_regions(record, region=region_name)
-		regions = [r for r in all_noncoding if r['end'] > noncoding_boundary[0] and r['start'] < noncoding_boundary[1]]
-		for r in regions:
-			r['genome_input_type'] = genome_input_type
-			r['genome_id'] = default_genome_id
-		start_pct = 0
-		end_pct = 100
-
-	if region_type == 'custom':
-		if len(custom_regions_csv):
-			if not Path(custom_regions_csv).exists():
-				print("Must input a valid filepath for the custom regions csv")
-				return
-			with open(Path(custom_regions_csv), 'r', encoding='utf-8-sig') as csv_file:
-				reader = csv.DictReader(csv_file)
-				custom_regions = [r for r in reader]
-			regions = [{'name': f'custom-{index}', 'start': int(c['start_ref']), 'end': int(c['end_ref']), 'direction': 'fw', 'genome_id': c['genome_id']} for (index, c) in enumerate(custom_regions)]
-		elif len(custom_sequences) > 0:
-			regions = [{'name': f'custom-{index}', 'start': 0, 'end': len(c), 'direction': 'fw', 'genome_id': None, 'sequence': c.upper()} for (index, c) in enumerate(custom_sequences)]
-		else:
-			print("No custom regions csv or custom sequences provided. Please fill in one of those fields")
-			return
-		start_pct = 0
-		end_pct = 100
-
-	for idx, region in enumerate(regions):
-		start = time.perf_counter()
-		print(f"Finding gRNA for \"{region['name']}\"")
-
-		if 'sequence' in region and len(region['sequence']) >= 20:
-			genome = Seq(region['sequence'])
-			start_mark = 0
-			end_mark = len(genome)
-		else:
-			[start_mark, end_mark] = get_target_region_for_gene(region, start_pct, end_pct)
-			if genome_input_type == 'genbank_ids':
-				record = retrieve_annotation(region['genome_id'], email)
-			elif genome_input_type == 'genbank_files':
-				record = SeqIO.read(Path(region['genome_id']), 'genbank')
-			elif genome_input_type == 'fasta_files':
-				record = SeqIO.read(Path(region['genome_id']), "fasta")
-			genome = record.seq.upper()
-
-		candidates = get_candidates_for_region(genome, start_mark, end_mark, region['name'], GC_requirement)
-		print(f"Identified {len(candidates)} candidates by PAM and GC content, filtering them now...")
-		if region_type == 'coding':
-			if coding_spacer_direction not in ['N_to_C', 'C_to_N']:
-				print("Invalid 'coding_spacer_direction' parameter, see the valid inputs")
-				return
-			candidates = order_candidates_for_region(candidates, region, coding_spacer_direction)
-
-		candidates = filter_re_sites(candidates)
-		candidates = filter_homopolymers(candidates)
-		for genome_id in genome_ids:
-			candidates = filter_non_unique_fingerprints(candidates, genome_id)
-
-		print(f"{len(candidates)} remain after filtering for re_sites, homopolymers, and non unique fingerprints")
-		for genome_id in genome_ids:
-			candidates = remove_offtarget_matches(genome_id, region['name'], candidates, spacers_per_region, overlapping_spacers, check_all=len(genome_ids) > 1)
-		region['candidates'] = candidates
-		if len(candidates) > spacers_per_region:
-			region['candidates'] = candidates[:spacers_per_region]
-
-		elapsed_time = round(time.perf_counter() - start, 2)
-		print(f"Identified {len(candidates)} spacers for {region['name']} in {elapsed_time} seconds")
-		make_spacer_gen_output(region, os.path.join(output_path, 'spacer_gen_output.csv'))
-
-def spacer_eval(args):
+	if trace_output:
+		export_trace(trace_output, 'chrome' if trace_output.endswith('.trace.json') else 'json', {'command': 'spacer_gen', 'region_type': region_type, 'regions': len(regions or [])})
+		print(f"Wrote run trace to {trace_output}")
+	return result
+
+def spacer_eval(args, designer=None, raise_input_errors=False):
+	# Invalid input is handled as in spacer_gen
 	genbank_ids = args['genbank_ids']
 	fasta_files = args['fasta_files']
 	output_path = args['output_path']
 	email = args['email']
 	user_spacers = args['spacers']
-
-	if not email or '@' not in email:
-		print("Please enter an email for NCBI API calls")
+	report_format = args.get('off_target_report', 'text')
+	pam_supported_only = args.get('pam_supported_only', False)
+	pangenome_dir = args.get('pangenome_dir', '')
+	trace_output = args.get('trace_output', '')
+	new_trace()
+
+	try:
+		if not pangenome_dir and (not email or '@' not in email):
+			raise DesignerInputError("Please enter an email for NCBI API calls")
+
+		if report_format not in REPORT_FORMATS:
+			raise DesignerInputError(f"off_target_report must be one of {REPORT_FORMATS}")
+
+		config = input_config(args)
+
+		if pangenome_dir:
+			# hit counts per genome of a whole directory of genomes, instead of the detailed off-target reports
+			from pangenome import screen_pangenome
+			result = screen_pangenome(user_spacers, pangenome_dir, output_path, args.get('cores'), config=config)
+			spacer_output = [{'name': name, 'sequence': result['sequences'][i], 'genomes_hit': int((result['hits'][i] > 0).sum()),
+							  'hits': {g: int(result['hits'][i, j]) for (j, g) in enumerate(result['genomes']) if result['hits'][i, j] > 0}}
+							 for (i, name) in enumerate(result['spacers'])]
+		else:
+			if designer is None:
+				designer = Designer(genbank_ids, [], fasta_files, email, config)
+			spacer_output = designer.evaluate(user_spacers, output_path, report_format, config, pam_supported_only)
+	except DesignerInputError as e:
+		if raise_input_errors:
+			raise
+		print(e)
 		return
 
-	if type(user_spacers) is dict:
-		spacers = [v for k,v in user_spacers.items() if len(v) == SPACER_LENGTH]
-	else:
-		spacers = [s for s in user_spacers if len(s) == SPACER_LENGTH]
-	print(f"Starting evaluation for {len(spacers)} spacers...")
-	spacer_batch = []
-	spacer_batch_unmod = []  # make unmodified copy of spacer recs for output
-	if flex_base:
-		for (index, spacer) in enumerate(spacers):
-			flexible_seq = spacer.upper()[:]
-			for i in range(flex_spacing-1, SPACER_LENGTH, flex_spacing):
-				flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
-			spacer_record = SeqRecord(Seq(flexible_seq), id=f'spacer_{index+1}', description=f'spacer_{index+1}')  # use 'description' to store ref_genome info
-			spacer_batch.append(spacer_record)
-			spacer_record_unmod = SeqRecord(Seq(spacer.upper()), id=f'spacer_{index + 1}',
-									  description=f'spacer_{index+1}')  # unmodified spacer for output
-			spacer_batch_unmod.append(spacer_record_unmod)
-	else:
-		for (index, spacer) in enumerate(spacers):
-			spacer_record = SeqRecord(Seq(spacer), id=f'spacer_{index + 1}',
-									  description=f'spacer_{index+1}')  # use 'description' to store ref_genome info
-			spacer_batch.append(spacer_record)
-			spacer_batch_unmod.append(spacer_record)
-
-	# Write the batch of candidate sequences to a fasta for bowtie2 to use
-	fasta_name = 'eval-spacers.fasta'
-	root_dir = Path(__file__).parent.parent
-	fasta_name = os.path.join(root_dir, 'assets', 'bowtie', fasta_name)
-	with open(fasta_name, 'w') as targets_file:
-		SeqIO.write(spacer_batch, targets_file, 'fasta')
-
-	output_locations = []
-	for genbank_id in genbank_ids:
-		record = retrieve_annotation(genbank_id, email, return_record=False)
-		output_locations.append(find_offtargets(genbank_id, fasta_name))
-	for genome_fasta_file in fasta_files:
-		without_filetype = genome_fasta_file[:-6].split('/')[-1]
-		bowtie_build(without_filetype, fasta_file=Path(genome_fasta_file).absolute())
-		output_locations.append(find_offtargets(without_filetype, fasta_name))
-
-	make_eval_outputs(spacer_batch_unmod, output_locations, email, output_path, user_spacers)
-
-	os.remove(fasta_name)
-	for loc in output_locations:
-		os.remove(loc)
+	if trace_output:
+		export_trace(trace_output, 'chrome' if trace_output.endswith('.trace.json') else 'json', {'command': 'spacer_eval', 'spacers': len(spacer_output)})
+		print(f"Wrote run trace to {trace_output}")
+	return spacer_output
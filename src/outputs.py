@@ -1,21 +1,32 @@
 import os
 import csv
+from itertools import groupby
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-import boto3
-import botocore
-from Bio.pairwise2 import format_alignment as f_align
-from Bio import SeqIO, SeqRecord, Seq, SeqUtils, pairwise2
+import numpy as np
+from Bio import SeqIO, SeqRecord, Seq, SeqUtils
 from simplesam import Reader as samReader
 
-from genbank import retrieve_annotation
-from advanced_parameters import PAM_SEQ, SPACER_LENGTH, flex_base, flex_spacing
+from genbank import retrieve_annotation, contig_table
+from report import OffTargetReport, report_filename
+from risk import mismatch_profiles, profile_positions, hit_risks, gapped_hit_risk, spacer_risk
+from pams import pam_supported
+from kmers import BASE_CODES
+from instrument import stage
+from config import DEFAULT_CONFIG
 
+# Used by the disabled S3 upload code below, which needs boto3 and botocore imported where it's turned back on
 S3_BUCKET = 'lab-script-resources'
 
-def make_spacer_gen_output(region, output_filename):
-	fieldnames = ['spacer_id', 'region', 'sequence', 'genomic_coordinate', 'GC_content', 'PAM', 'strand']
+# SAM files are read and their hits classified this many reads at a time
+SAM_CHUNK_SIZE = 100000
+# Complements of the IUPAC bases, for hits on the reverse strand
+COMPLEMENT = str.maketrans('ACGTRYSWKMBDHVN', 'TGCAYRSWMKVHDBN')
+COMPLEMENT_BYTES = np.frombuffer(bytes(range(256)).translate(bytes.maketrans(b'ACGTRYSWKMBDHVN', b'TGCAYRSWMKVHDBN')), dtype=np.uint8)
+
+def make_spacer_gen_output(region, output_filename, config=DEFAULT_CONFIG):
+	fieldnames = ['spacer_id', 'region', 'sequence', 'genomic_coordinate', 'GC_content', 'PAM', 'strand', 'contig', 'contig_coordinate']
 
 	root_dir = Path(__file__).parent.parent
 	temp_path = os.path.join(root_dir, output_filename)
@@ -30,11 +41,11 @@ def make_spacer_gen_output(region, output_filename):
 				needsHeaders = False
 	except FileNotFoundError:
 		needsHeaders = True
-	except botocore.exceptions.ClientError as e:
-		if e.response['Error']['Code'] == "404":
-			needsHeaders = True
+	#except botocore.exceptions.ClientError as e:
+	#	if e.response['Error']['Code'] == "404":
+	#		needsHeaders = True
 
-	with open(temp_path, 'a', newline='') as tmp:
+	with stage('output_writing', output='spacer_gen') as counters, open(temp_path, 'a', newline='') as tmp:
 		writer = csv.DictWriter(tmp, fieldnames=fieldnames)
 		if needsHeaders:
 			writer.writeheader()
@@ -51,10 +62,12 @@ def make_spacer_gen_output(region, output_filename):
 					'sequence': c['seqrec'].seq,
 					'genomic_coordinate': c['location'],
 					'GC_content': GC_content,
-					'PAM': PAM_SEQ,
-					'strand': c['name'].split('--')[1][:2]
+					'PAM': c.get('pam', '/'.join(config.pams())),
+					'strand': c['name'].split('--')[1][:2],
+					'contig': c.get('contig', ''),
+					'contig_coordinate': c.get('contig_location', c['location'])
 				}
-				writer.writerow(row)
+				counters['bytes_written'] = counters.get('bytes_written', 0) + writer.writerow(row)
 				spacer_num += 1
 
 	#s3.upload_file(temp_path, S3_BUCKET, output_key)
@@ -62,6 +75,9 @@ def make_spacer_gen_output(region, output_filename):
 	return
 
 def align_offtargets(spacer_seq, offtar_info):  # uses Bio.pairwise2, offtar_info is a list of 2 things
+	# imported here, only the detailed text report draws alignments
+	from Bio import pairwise2
+	from Bio.pairwise2 import format_alignment as f_align
 	if not offtar_info[1]:  # ungapped alignment, penalize gaps more as it usually looks better
 		alignments = pairwise2.align.globalms(spacer_seq, offtar_info[0], 2, -1, -7, -1) # opening gaps = at least 7 mismatches
 	else:  # probably has gaps that need to be shown
@@ -72,89 +88,214 @@ def align_offtargets(spacer_seq, offtar_info):  # uses Bio.pairwise2, offtar_inf
 	del items[-1]
 	return '\n'.join(items)+'\n'
 
-def make_eval_outputs(spacers, output_sams, email, output_path, user_spacers):
-	sam_reads = []
-	for output_sam in output_sams:
-		genbank_id = output_sam.split('-')[-2]
-		record = retrieve_annotation(genbank_id, email)
-		genome_seq = record.seq
-
-		with open(output_sam, 'r') as sam_file:
-			reader = samReader(sam_file)
-			file_reads = [r for r in reader]
-			for r in file_reads:
-				r['genbankId'] = genbank_id
-				if r.reverse:
-					pam = genome_seq[r.coords[-1]:r.coords[-1] + 2].upper()  # todo allow different PAM lengths
-					pam = pam.reverse_complement()
-					protospacer = genome_seq[r.coords[0] - 1:r.coords[-1]].upper()
-					protospacer = protospacer.reverse_complement()
-				else:
-					pam = genome_seq[r.coords[0] - 3:r.coords[0] - 1]
-					protospacer = genome_seq[r.coords[0] - 1:r.coords[-1]]
-				r['protospacer'] = protospacer
-				r['pam'] = pam
-			sam_reads += file_reads
+def ungapped_alignments(spacer_seq, protospacers):
+	# Alignments of ungapped hits as align_offtargets draws them, for all of them at once without aligning:
+	# the spacer, '|' under every identical base and '.' under every other, the protospacer
+	if not len(protospacers):
+		return []
+	spacer = np.frombuffer(str(spacer_seq).encode('ascii'), dtype=np.uint8)
+	targets = np.frombuffer(''.join([str(p) for p in protospacers]).encode('ascii'), dtype=np.uint8).reshape(len(protospacers), len(spacer))
+	match_lines = np.where(targets == spacer, ord('|'), ord('.')).astype(np.uint8)
+	return [f"{spacer_seq}\n{line.tobytes().decode('ascii')}\n{p}\n" for (line, p) in zip(match_lines, protospacers)]
+
+def write_offtarget_text(spacer, spacer_name, hits, output_path, config=DEFAULT_CONFIG):
+	with open(os.path.join(output_path, f'{spacer_name}_off_target.txt'), 'w') as text_out:
+		text_out.write(f"Potential off-target sites for {spacer_name}")
+		text_out.write("\n(Closer matches to protospacer listed first)")
+		text_out.write("\n-------------")
+		perfect_match = False
+		for hit in hits:
+			perfect_match = perfect_match or hit['perfect_match']
+			mismatch_count = hit['mismatches'] if hit['mismatches'] is not None else 'N/A'
+			text_out.write(f"\n{hit['protospacer']}\n"
+						   f"Genome: {hit['genome']}; Contig: {hit['contig']}; Coordinates: {hit['coordinate']}; PAM: {hit['pam']}; PAM Supported = {hit['pam_supported']}; RevCom = {hit['strand'] == 'rv'}; "
+						   f"Perfect Match = {str(perfect_match)}; Mismatches = {mismatch_count}; Gapped Alignment = {hit['gapped']}; Risk = {hit['risk']:.3g}")
+		text_out.write("\n-------------")
+		text_out.write(
+			"\nPairwise Alignments: (ruler for ambiguous base positions shown above each alignment pair for ungapped alignments)\n")
+		for hit in hits:
+			if not hit['gapped']:  # ungapped; print out a ruler
+				text_out.write('\n')
+				for _ in range(0, len(spacer.seq)):
+					if config.flex_base and (_ + 1) % config.flex_spacing == 0:
+						text_out.write('X')
+					else:
+						text_out.write('-')
+			text_out.write('\n' + hit['alignment'])
+
+		text_out.write(f"\nTotal potential matches = {len(hits)}")
+		if not perfect_match:
+			text_out.write('\nNo identical protospacer found')
+		else:
+			text_out.write('\nIdentical protospacer(s) found')
+
+def annotate_hits(reads, genbank_id, genome_text, genome_bytes, offsets, config=DEFAULT_CONFIG):
+	# Adds its protospacer and PAM to every read, and whether the PAM is one of config.pams() on the read's strand
+	# The PAMs of all of the reads are gathered from genome_bytes, a uint8 view of genome_text, and checked at once
+	pam_length = config.pam_length()
+	starts = np.array([r.coords[0] + offsets.get(r.rname, 0) for r in reads])
+	ends = np.array([r.coords[-1] + offsets.get(r.rname, 0) for r in reads])
+	reverse = np.array([bool(r.reverse) for r in reads])
+	# genome positions of the bases before each hit, in the order they are read on its strand
+	steps = np.arange(pam_length)
+	positions = np.where(reverse[:, None], ends[:, None] + pam_length - 1 - steps, starts[:, None] - 1 - pam_length + steps)
+	inside = (positions >= 0) & (positions < len(genome_bytes))
+	pams = genome_bytes[np.clip(positions, 0, len(genome_bytes) - 1)]
+	pams = np.where(reverse[:, None], COMPLEMENT_BYTES[pams], pams)
+	pams[~inside] = 0  # past the genome ends, a shorter PAM that isn't supported
+	supported = pam_supported(BASE_CODES[pams], config.pams())
+	for (r, start, end, pam, is_supported) in zip(reads, starts, ends, pams, supported):
+		protospacer = genome_text[start - 1:end]
+		r['genbankId'] = genbank_id
+		r['protospacer'] = protospacer.translate(COMPLEMENT)[::-1] if r.reverse else protospacer
+		r['pam'] = pam.tobytes().replace(b'\x00', b'').decode('ascii')
+		r['pam_supported'] = bool(is_supported)
+
+def sam_hit_groups(output_sam, genbank_id, genome_text, genome_bytes, offsets, config, pam_counts, pam_supported_only=False):
+	# Yields [spacer id, reads] for every run of consecutive reads of one spacer in a SAM file, with annotate_hits added
+	# Reads are parsed and annotated SAM_CHUNK_SIZE at a time (whole runs), so only a chunk is held in memory
+	# pam_counts[spacer id] counts [hits with a PAM, hits without], with pam_supported_only only the first are yielded
+	with open(output_sam, 'r') as sam_file:
+		groups = groupby(samReader(sam_file), key=lambda r: r.safename)
+		while True:
+			with stage('sam_parsing', genome=genbank_id) as counters:
+				chunk = []
+				chunk_reads = 0
+				for (name, reads) in groups:
+					chunk.append([name, list(reads)])
+					chunk_reads += len(chunk[-1][1])
+					if chunk_reads >= SAM_CHUNK_SIZE:
+						break
+				if not len(chunk):
+					return
+				annotate_hits([r for (_, reads) in chunk for r in reads], genbank_id, genome_text, genome_bytes, offsets, config)
+				for (name, reads) in chunk:
+					counts = pam_counts.setdefault(name, [0, 0])
+					supported = sum([r['pam_supported'] for r in reads])
+					counts[0] += supported
+					counts[1] += len(reads) - supported
+				counters['reads_aligned'] = chunk_reads
+				if pam_supported_only:
+					chunk = [[name, [r for r in reads if r['pam_supported']]] for (name, reads) in chunk]
+				counters['reads_kept'] = sum([len(reads) for (_, reads) in chunk])
+			for group in chunk:
+				yield group
+
+def hits_in_spacer_order(spacer_ids, streams):
+	# Yields the reads of every spacer of spacer_ids, in order, from every stream of sam_hit_groups
+	# bowtie2 writes a SAM in the order of its fasta (--reorder), so each stream is read just past the current
+	# spacer and nothing else is held
+	position = {spacer_id: i for (i, spacer_id) in enumerate(spacer_ids)}
+	held = [{} for _ in streams]
+	furthest = [-1 for _ in streams]
+	for (i, spacer_id) in enumerate(spacer_ids):
+		reads = []
+		for (k, stream) in enumerate(streams):
+			while furthest[k] <= i:
+				group = next(stream, None)
+				if group is None:
+					furthest[k] = len(spacer_ids)
+					break
+				(name, group_reads) = group
+				if position.get(name, i) < i:
+					raise Exception(f"Hits of {name} found after those of {spacer_ids[i]}, the SAM files must list spacers in order")
+				if name in position:
+					held[k].setdefault(name, []).extend(group_reads)
+					furthest[k] = max(furthest[k], position[name])
+			reads += held[k].pop(spacer_id, [])
+		yield reads
+
+def make_eval_outputs(spacers, genome_sams, email, output_path, user_spacers, report_format='text', config=DEFAULT_CONFIG, pam_supported_only=False, records=None):
+	# genome_sams are the (genome id, SAM path) of every genome searched. records has the parsed record of genome
+	# ids that are not genbank ids (e.g. fasta genomes), the others are retrieved with retrieve_annotation
+	# Hits are read from the SAMs of every genome at once and written to the report one spacer at a time, so only
+	# the current spacer's hits (and a chunk of each SAM) are held in memory
+	# With pam_supported_only, hits without one of config.pams() are counted but left out of the reports and summaries
+	# [hits with a PAM, hits without] of every spacer
+	records = records or {}
+	pam_counts = {}
+	streams = []
+	for (genbank_id, output_sam) in genome_sams:
+		record = records[genbank_id] if genbank_id in records else retrieve_annotation(genbank_id, email)
+		genome_text = str(record.seq).upper()
+		genome_bytes = np.frombuffer(genome_text.encode('ascii'), dtype=np.uint8)
+		# hits are reported per contig, their offsets place them in the joined genome sequence
+		offsets = {c['id']: c['offset'] for c in contig_table(record)}
+		streams.append(sam_hit_groups(output_sam, genbank_id, genome_text, genome_bytes, offsets, config, pam_counts, pam_supported_only))
+
+	report = None
+	if report_format != 'text':
+		report = OffTargetReport(report_filename(output_path, report_format), report_format)
 
 	spacer_output = []
-	for spacer in spacers:
-		reads = [r for r in sam_reads if r.safename == spacer.id]
-		reads = sorted(reads, key=lambda r: r.tags['XM'])
+	for (spacer, reads) in zip(spacers, hits_in_spacer_order([spacer.id for spacer in spacers], streams)):
 		mismatch_list = []  # to get min/max mismatches
 		spacer_match = 'No perfect match found'  # update if perfect match (true protospacer) is found
 
+		spacer_name = spacer.id
+		if type(user_spacers) is dict:
+			for (name, seq) in user_spacers.items():
+				if seq.upper() == spacer.seq.upper():
+					spacer_name = name
+
 		if len(reads) >= 1:
-			spacer_name = spacer.id
-			if type(user_spacers) is dict:
-				for (name, seq) in user_spacers.items():
-					if seq.upper() == spacer.seq.upper():
-						spacer_name = name
-
-			print(f"Spacer '{spacer_name}' has {len(reads)} potential match(es) - see output files for details")
-
-			with open(os.path.join(output_path, f'{spacer_name}_off_target.txt'), 'w') as text_out:
-				text_out.write(f"Potential off-target sites for {spacer_name}")
-				text_out.write("\n(Closer matches to protospacer listed first)")
-				text_out.write("\n-------------")
-				proto_list = []
-				perfect_match = False
-				for i in reads:
-					protospacer = i['protospacer']
-					pam = i['pam']
-					gapped_align = i.tags['XO'] > 0
-					proto_list.append([protospacer, gapped_align])
-					if str(protospacer) == str(spacer.seq):
-						perfect_match = True
-					flex_count = len(spacer.seq)//flex_spacing if flex_base else 0
-					mismatch_count = abs(i.tags['XM']) - flex_count if len(
-						protospacer) >= len(spacer.seq) else 'N/A'  # use XM, taking into account flexible bases
-					if perfect_match:
-						spacer_match = 'Perfect match(es) found'
-					text_out.write(f"\n{protospacer.upper()}\n"
-								   f"Genome: {i['genbankId']}; Coordinates: {i.coords[0]}; PAM: {pam.upper()}; RevCom = {i.reverse}; "
-								   f"Perfect Match = {str(perfect_match)}; Mismatches = {mismatch_count}; Gapped Alignment = {gapped_align}")
-					if mismatch_count != 'N/A':
-						mismatch_list.append(mismatch_count)
-				text_out.write("\n-------------")
-				text_out.write(
-					"\nPairwise Alignments: (ruler for ambiguous base positions shown above each alignment pair for ungapped alignments)\n")
-				# text_out.write('\n')
-				for target in proto_list:
-					if not target[1]:  # ungapped; print out a ruler
-						text_out.write('\n')
-						for _ in range(0, len(spacer.seq)):
-							if (_ + 1) % 6 == 0:
-								text_out.write('X')
-							else:
-								text_out.write('-')
-					text_out.write('\n' + align_offtargets(spacer.seq, target))
-
-				text_out.write(f"\nTotal potential matches = {len(reads)}")
-				if not perfect_match:
-					text_out.write('\nNo identical protospacer found')
+			if report:
+				print(f"Spacer '{spacer_name}' has {len(reads)} potential match(es) - see {report.path} for details")
+			else:
+				print(f"Spacer '{spacer_name}' has {len(reads)} potential match(es) - see output files for details")
+
+			hits = []
+			flex_count = len(config.flex_positions())
+			# mismatches and risk of every ungapped full-length hit at once, from their mismatch profiles (see risk.py)
+			profiled = [r for r in reads if r.tags['XO'] == 0 and len(r['protospacer']) >= len(spacer.seq)]
+			profiles = mismatch_profiles(spacer.seq, [r['protospacer'] for r in profiled], config)
+			profiles_by_read = {id(r): (int(count), positions, float(risk)) for (r, count, positions, risk)
+								in zip(profiled, profiles.sum(axis=1), profile_positions(profiles), hit_risks(profiles, config))}
+			# pairwise2 is only needed to draw gapped hits
+			exact_length = [r for r in profiled if len(r['protospacer']) == len(spacer.seq)]
+			alignments = {id(r): a for (r, a) in zip(exact_length, ungapped_alignments(spacer.seq, [r['protospacer'] for r in exact_length]))}
+			for i in reads:
+				protospacer = i['protospacer']
+				gapped_align = i.tags['XO'] > 0
+				is_full_length = len(protospacer) >= len(spacer.seq)
+				if id(i) in profiles_by_read:
+					(mismatch_count, positions, risk) = profiles_by_read[id(i)]
 				else:
-					text_out.write('\nIdentical protospacer(s) found')
+					# gapped hits only have XM, which counts the N of every flexible base
+					mismatch_count = max(abs(i.tags['XM']) - flex_count, 0) if is_full_length else None
+					positions = None
+					risk = gapped_hit_risk(max(abs(i.tags['XM']) - flex_count, 0) + i.tags['XO'], config)
+				hits.append({
+					'genome': i['genbankId'],
+					'contig': i.rname,
+					'coordinate': i.coords[0],
+					'strand': 'rv' if i.reverse else 'fw',
+					'pam': i['pam'],
+					'pam_supported': i['pam_supported'],
+					'protospacer': str(protospacer.upper()),
+					'mismatches': mismatch_count,
+					'mismatch_positions': positions,
+					'gapped': gapped_align,
+					'perfect_match': str(protospacer) == str(spacer.seq),
+					'risk': risk,
+					'alignment': alignments[id(i)] if id(i) in alignments else align_offtargets(spacer.seq, [protospacer, gapped_align])
+				})
+				if mismatch_count is not None:
+					mismatch_list.append(mismatch_count)
+			# riskiest (closest) hits first
+			hits = sorted(hits, key=lambda h: -h['risk'])
+			if any([h['perfect_match'] for h in hits]):
+				spacer_match = 'Perfect match(es) found'
 
+			with stage('output_writing', output='off_target_report') as counters:
+				if report:
+					report.write_spacer(spacer_name, hits)
+				else:
+					write_offtarget_text(spacer, spacer_name, hits, output_path, config)
+					counters['bytes_written'] = os.path.getsize(os.path.join(output_path, f'{spacer_name}_off_target.txt'))
+
+		elif pam_counts.get(spacer.id, [0, 0])[1]:
+			print(f"Warning - no matches with a PAM, including protospacer, found for spacer '{spacer_name}'")
 		else:
 			print(f"Warning - no matches, including protospacer, found for spacer '{spacer_name}'")
 
@@ -162,21 +303,36 @@ def make_eval_outputs(spacers, output_sams, email, output_path, user_spacers):
 					   'match_found': spacer_match,
 					   'offtar_count': len(reads),
 					   'mismatch_min': min(mismatch_list) if len(mismatch_list) > 0 else 'N/A',
-					   'mismatch_max': max(mismatch_list) if len(mismatch_list) > 0 else 'N/A'}
+					   'mismatch_max': max(mismatch_list) if len(mismatch_list) > 0 else 'N/A',
+					   'offtarget_risk': spacer_risk(hits) if len(reads) >= 1 else 0,
+					   'pam_supported_count': pam_counts.get(spacer.id, [0, 0])[0],
+					   'pam_unsupported_count': pam_counts.get(spacer.id, [0, 0])[1]}
 		spacer_output.append(spacer_dict)
+	# rank 1 is the spacer with the lowest off-target risk
+	for (rank, spacer_dict) in enumerate(sorted(spacer_output, key=lambda s: s['offtarget_risk'])):
+		spacer_dict['risk_rank'] = rank + 1
 
+	if report:
+		with stage('output_writing', output='off_target_report') as counters:
+			report.close()
+			counters['bytes_written'] = os.path.getsize(report.path)
 	print('------------')
 
 	fieldnames = ['Spacer Name', 'Spacer Sequence', 'Reference Genome',
-				  'Perfect Match', 'Number of Matches', 'Fewest Mismatches', 'Most Mismatches']
-	with open(os.path.join(Path(output_path), 'spacer_eval_output.csv'), 'w', newline='') as out_file:
+				  'Perfect Match', 'Number of Matches', 'Fewest Mismatches', 'Most Mismatches', 'Off-target Risk', 'Risk Rank',
+				  'Matches With PAM', 'Matches Without PAM']
+	eval_output_name = os.path.join(Path(output_path), 'spacer_eval_output.csv')
+	with stage('output_writing', output='spacer_eval') as counters, open(eval_output_name, 'w', newline='') as out_file:
 		writer = csv.DictWriter(out_file, fieldnames=fieldnames)
 		writer.writeheader()
 		for spacer in spacer_output:
 			row = {'Spacer Name': spacer['name'], 'Spacer Sequence': spacer['sequence'],
 				   'Reference Genome': spacer['refseq'], 'Perfect Match': spacer['match_found'],
 				   'Number of Matches': spacer['offtar_count'],
-				   'Fewest Mismatches': spacer['mismatch_min'], 'Most Mismatches': spacer['mismatch_max']}
+				   'Fewest Mismatches': spacer['mismatch_min'], 'Most Mismatches': spacer['mismatch_max'],
+				   'Off-target Risk': round(spacer['offtarget_risk'], 6), 'Risk Rank': spacer['risk_rank'],
+				   'Matches With PAM': spacer['pam_supported_count'], 'Matches Without PAM': spacer['pam_unsupported_count']}
 			writer.writerow(row)
-	return
+		counters['bytes_written'] = out_file.tell()
+	return spacer_output
 
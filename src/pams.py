@@ -0,0 +1,82 @@
+import re
+import heapq
+from functools import lru_cache
+
+import numpy as np
+
+# PAM patterns
+# A PAM setting is one IUPAC pattern ('CC', 'CN') or a list of them (['CC', 'CT', 'CNG']). Each is compiled
+# into a regular expression in a lookahead, so scans find overlapping PAMs, and the scans of all the patterns
+# are merged by position, so patterns matching at the same position (CC and CNG at CCG) are all reported
+
+IUPAC_CODES = {
+	'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+	'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+	'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'
+}
+
+def pam_patterns(pam_setting):
+	# The uppercase patterns of a PAM setting, longest first. Raises ValueError for non-IUPAC patterns
+	patterns = [pam_setting] if isinstance(pam_setting, str) else list(pam_setting)
+	patterns = [p.upper() for p in patterns]
+	if not len(patterns) or not all([len(p) and all([base in IUPAC_CODES for base in p]) for p in patterns]):
+		raise ValueError(f"PAM_SEQ must be IUPAC patterns, got {pam_setting}")
+	return tuple(sorted(set(patterns), key=lambda p: (-len(p), p)))
+
+def pattern_regex(pattern):
+	return ''.join([base if len(IUPAC_CODES[base]) == 1 else f'[{IUPAC_CODES[base]}]' for base in pattern])
+
+@lru_cache(maxsize=None)
+def pam_regexes(patterns):
+	# One regex per pattern, matching (empty) at every position where the pattern starts, with the PAM in group 1
+	return tuple([re.compile('(?=(' + pattern_regex(p) + '))') for p in patterns])
+
+def find_pams(seq, patterns):
+	# [(position, PAM), ...] for every PAM of every pattern in seq, in order of position
+	# PAMs at the same position are in the order of patterns (longest first for pam_patterns)
+	seq = str(seq).upper()
+	scans = [[(match.start(), i, match.group(1)) for match in regex.finditer(seq)] for (i, regex) in enumerate(pam_regexes(patterns))]
+	return [(position, pam) for (position, _, pam) in heapq.merge(*scans)]
+
+def matching_pam(upstream, patterns):
+	# The PAM that upstream (the bases just before a spacer) ends with, or None
+	upstream = str(upstream).upper()
+	for pattern in patterns:
+		if len(upstream) >= len(pattern) and re.fullmatch(pattern_regex(pattern), upstream[len(upstream) - len(pattern):]):
+			return upstream[len(upstream) - len(pattern):]
+	return None
+
+def pam_adjacent(codes, patterns, spacer_length):
+	# Boolean array over the spacer start positions of codes (kmers.py base codes), True where the spacer
+	# is directly preceded by a PAM of any of patterns
+	n = len(codes) - spacer_length + 1
+	adjacent = np.zeros(max(n, 0), dtype=bool)
+	for pattern in patterns:
+		if n <= len(pattern):
+			continue
+		matches = np.ones(n - len(pattern), dtype=bool)
+		for (j, base) in enumerate(pattern):
+			matches &= allowed_codes(base)[codes[j:j + n - len(pattern)]]
+		adjacent[len(pattern):] |= matches
+	return adjacent
+
+def allowed_codes(base):
+	# Lookup table over kmers.py base codes, True for the bases an IUPAC code stands for
+	allowed = np.zeros(5, dtype=bool)
+	allowed[['ACGT'.index(b) for b in IUPAC_CODES[base]]] = True
+	return allowed
+
+def pam_supported(upstream_codes, patterns):
+	# Boolean array over the rows of upstream_codes (kmers.py base codes, the bases just before each of a number of
+	# spacer sites, on the site's strand), True where the row ends with a PAM of any of patterns, as matching_pam
+	upstream_codes = np.asarray(upstream_codes)
+	width = upstream_codes.shape[1]
+	supported = np.zeros(len(upstream_codes), dtype=bool)
+	for pattern in patterns:
+		if len(pattern) > width:
+			continue
+		matches = np.ones(len(upstream_codes), dtype=bool)
+		for (j, base) in enumerate(pattern):
+			matches &= allowed_codes(base)[upstream_codes[:, width - len(pattern) + j]]
+		supported |= matches
+	return supported
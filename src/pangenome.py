@@ -0,0 +1,227 @@
+import os
+import sys
+import csv
+import json
+import re
+import shutil
+import hashlib
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from simplesam import Reader as samReader
+
+from bowtie import build_index, align_offtargets
+from genbank import read_contigs
+from config import DEFAULT_CONFIG, make_config
+from instrument import stage, in_context
+from cores import available_cores, core_scheduler
+from risk import read_mismatches
+
+# Off-target screening against a directory of genomes (e.g. a whole genus)
+# Genomes are packed into shards of up to shard_bases bases with one bowtie2 index each, named by a hash of
+# their genomes' paths, sizes and modification times so only changed shards are rebuilt. Spacers are searched
+# against the shards in parallel and the hits of every spacer in every genome are reported as a matrix
+# Ex. python pangenome.py ./vibrio_genomes --spacers spacers.csv --cores 16 --output pangenome_hits.csv
+
+GENOME_EXTENSIONS = {'.fasta': 'fasta', '.fa': 'fasta', '.fna': 'fasta', '.gb': 'genbank', '.gbk': 'genbank', '.genbank': 'genbank'}
+PANGENOME_OUTPUT = 'pangenome_hits.csv'
+
+def genome_format(path):
+	name = path.name[:-len('.gz')] if path.name.endswith('.gz') else path.name
+	return GENOME_EXTENSIONS.get(Path(name).suffix.lower())
+
+def genome_name(path):
+	name = path.name[:-len('.gz')] if path.name.endswith('.gz') else path.name
+	return Path(name).stem
+
+def list_genomes(genome_dir):
+	# Every fasta or genbank file (optionally gzipped) in genome_dir, sorted by name
+	# Genomes are reported by name, so two files with the same name (x.fna and x.fna.gz, x.gb and x.fasta) are an error
+	genomes = []
+	paths = {}
+	for path in sorted(Path(genome_dir).iterdir()):
+		if path.is_file() and genome_format(path):
+			name = genome_name(path)
+			if name in paths:
+				raise Exception(f"Genomes {paths[name].name} and {path.name} in {genome_dir} have the same name '{name}', remove or rename one of them")
+			paths[name] = path
+			stat = path.stat()
+			genomes.append({'name': name, 'path': str(path.absolute()), 'format': genome_format(path), 'size': stat.st_size, 'mtime': stat.st_mtime})
+	return genomes
+
+def read_genome(genome):
+	# The genome's records, one at a time
+	return read_contigs(genome['path'], genome['format'])
+
+def plan_shards(genomes, shard_bases):
+	# Groups genomes (in order) into shards of roughly shard_bases, using file size as the size estimate
+	shards = []
+	current = []
+	current_size = 0
+	for genome in genomes:
+		if len(current) and current_size + genome['size'] > shard_bases:
+			shards.append(current)
+			current = []
+			current_size = 0
+		current.append(genome)
+		current_size += genome['size']
+	if len(current):
+		shards.append(current)
+	return shards
+
+def shard_id(shard_genomes):
+	signature = json.dumps([[g['path'], g['size'], g['mtime']] for g in shard_genomes])
+	return 'shard_' + hashlib.sha1(signature.encode('utf-8')).hexdigest()[:12]
+
+def is_shard_dir(path):
+	return bool(re.fullmatch(r'shard_[0-9a-f]{12}', os.path.basename(path))) and os.path.exists(os.path.join(path, 'contigs.json'))
+
+def build_shard(shard_dir, shard_genomes, threads):
+	# Writes the shard's genomes to one fasta, with contigs renamed c0, c1... and builds its index
+	# contigs.json maps every contig back to its genome
+	os.makedirs(shard_dir, exist_ok=True)
+	contigs = {}
+	fasta_file = os.path.join(shard_dir, 'genomes.fasta')
+	with open(fasta_file, 'w') as f:
+		for genome in shard_genomes:
+			for record in read_genome(genome):
+				contig = f'c{len(contigs)}'
+				contigs[contig] = genome['name']
+				SeqIO.write(SeqRecord(record.seq, id=contig, description=''), f, 'fasta')
+	with core_scheduler().reserve(threads) as granted:
+		build_index(fasta_file, os.path.join(shard_dir, 'index'), os.path.basename(shard_dir), granted)
+	os.remove(fasta_file)
+	with open(os.path.join(shard_dir, 'contigs.json'), 'w') as f:
+		json.dump(contigs, f)
+
+def prepare_pangenome(genome_dir, index_dir=None, shard_bases=200000000, cores=None):
+	# Builds the missing index shards for genome_dir (in parallel within the cores budget), removes stale ones
+	# Returns [genome names, [shard directories]]
+	cores = cores or available_cores()
+	index_dir = index_dir or os.path.join(Path(__file__).parent.parent, 'assets', 'pangenome', hashlib.sha1(str(Path(genome_dir).absolute()).encode('utf-8')).hexdigest()[:12])
+	genomes = list_genomes(genome_dir)
+	if not len(genomes):
+		raise Exception(f"No fasta or genbank files found in {genome_dir}")
+	os.makedirs(index_dir, exist_ok=True)
+
+	shards = plan_shards(genomes, shard_bases)
+	shard_dirs = [os.path.join(index_dir, shard_id(s)) for s in shards]
+	for existing in os.listdir(index_dir):
+		path = os.path.join(index_dir, existing)
+		# index_dir may be any directory, only shards built here are removed
+		if path not in shard_dirs and is_shard_dir(path):
+			shutil.rmtree(path, ignore_errors=True)
+
+	to_build = [(d, s) for (d, s) in zip(shard_dirs, shards) if not os.path.exists(os.path.join(d, 'contigs.json'))]
+	if len(to_build):
+		print(f"Building {len(to_build)} of {len(shards)} index shards for {len(genomes)} genomes")
+		[parallel, threads] = core_split(cores, len(to_build))
+		with stage('pangenome_index', genomes=len(genomes), shards=len(to_build)), ThreadPoolExecutor(parallel) as executor:
+			list(executor.map(in_context(lambda ds: build_shard(ds[0], ds[1], threads)), to_build))
+	return [[g['name'] for g in genomes], shard_dirs]
+
+def core_split(cores, jobs, threads_per_job=4):
+	# [jobs run at once, bowtie2 threads per job] that keep the total within cores
+	parallel = max(1, min(jobs, cores // threads_per_job))
+	return [parallel, max(1, cores // parallel)]
+
+def screen_shard(shard_dir, fasta_name, spacer_index, genome_index, threads, config):
+	# Hit counts and minimum mismatches (of ungapped hits) of every spacer against the genomes of one shard
+	hits = np.zeros((len(spacer_index), len(genome_index)), dtype=np.int32)
+	min_mismatches = np.full((len(spacer_index), len(genome_index)), -1, dtype=np.int32)
+	with open(os.path.join(shard_dir, 'contigs.json'), 'r') as f:
+		contigs = json.load(f)
+	output_location = os.path.join(shard_dir, f'{Path(fasta_name).stem}.sam')
+	with core_scheduler().reserve(threads) as granted:
+		align_offtargets(os.path.join(shard_dir, 'index'), fasta_name, output_location, os.path.basename(shard_dir), config, granted)
+
+	with stage('sam_parsing', genome=os.path.basename(shard_dir)) as counters, open(output_location, 'r') as sam_file:
+		reads = 0
+		for r in samReader(sam_file):
+			(s, g) = (spacer_index[r.safename], genome_index[contigs[r.rname]])
+			mismatches = read_mismatches(r, config)
+			hits[s, g] += 1
+			if mismatches is not None and (min_mismatches[s, g] < 0 or mismatches < min_mismatches[s, g]):
+				min_mismatches[s, g] = mismatches
+			reads += 1
+		counters['reads_aligned'] = reads
+	os.remove(output_location)
+	return [hits, min_mismatches]
+
+def screen_pangenome(spacers, genome_dir, output_path=None, cores=None, shard_bases=200000000, index_dir=None, config=DEFAULT_CONFIG):
+	# Searches spacers (a list, or a dict of name: spacer) against every genome in genome_dir
+	# Returns {'spacers': names, 'genomes': names, 'hits': counts matrix, 'min_mismatches': matrix, -1 where no ungapped hit}
+	config = make_config(config)
+	cores = cores or available_cores()
+	if type(spacers) is not dict:
+		spacers = {f'spacer_{i+1}': s for (i, s) in enumerate(spacers)}
+	wrong_length = [name for (name, s) in spacers.items() if len(s) != config.SPACER_LENGTH]
+	if len(wrong_length):
+		print(f"Warning: skipping {len(wrong_length)} spacers that are not {config.SPACER_LENGTH} bases long: {', '.join(wrong_length[:10])}{'...' if len(wrong_length) > 10 else ''}")
+	spacers = {name: s.upper() for (name, s) in spacers.items() if len(s) == config.SPACER_LENGTH}
+	[genome_names, shard_dirs] = prepare_pangenome(genome_dir, index_dir, shard_bases, cores)
+
+	records = []
+	for (index, spacer) in enumerate(spacers.values()):
+		flexible_seq = spacer
+		for i in config.flex_positions():
+			flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
+		records.append(SeqRecord(Seq(flexible_seq), id=f'spacer_{index+1}', description=''))
+	(fasta_handle, fasta_name) = tempfile.mkstemp(prefix='pangenome_spacers_', suffix='.fasta')
+	with os.fdopen(fasta_handle, 'w') as f:
+		SeqIO.write(records, f, 'fasta')
+
+	spacer_index = {r.id: i for (i, r) in enumerate(records)}
+	genome_index = {name: i for (i, name) in enumerate(genome_names)}
+	[parallel, threads] = core_split(cores, len(shard_dirs))
+	print(f"Screening {len(records)} spacers against {len(genome_names)} genomes in {len(shard_dirs)} shards, {parallel} at a time")
+	with stage('pangenome_screen', spacers=len(records), genomes=len(genome_names), shards=len(shard_dirs)), ThreadPoolExecutor(parallel) as executor:
+		results = list(executor.map(in_context(lambda d: screen_shard(d, fasta_name, spacer_index, genome_index, threads, config)), shard_dirs))
+	os.remove(fasta_name)
+
+	# every genome is in exactly one shard, so the shard matrices don't overlap
+	hits = sum([r[0] for r in results])
+	min_mismatches = np.max([r[1] for r in results], axis=0)
+	result = {'spacers': list(spacers.keys()), 'sequences': list(spacers.values()), 'genomes': genome_names, 'hits': hits, 'min_mismatches': min_mismatches}
+	if output_path is not None:
+		write_hit_matrix(result, os.path.join(output_path, PANGENOME_OUTPUT))
+	return result
+
+def write_hit_matrix(result, output_filename):
+	# One row per spacer, one column of hit counts per genome
+	with stage('output_writing', output='pangenome') as counters, open(output_filename, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(['name', 'sequence', 'genomes_hit'] + result['genomes'])
+		for (i, name) in enumerate(result['spacers']):
+			row = result['hits'][i]
+			counters['bytes_written'] = counters.get('bytes_written', 0) + writer.writerow([name, result['sequences'][i], int((row > 0).sum())] + row.tolist())
+	print(f"Wrote per-genome hit counts to {output_filename}")
+	return output_filename
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Screen spacers for hits in every genome of a directory')
+	parser.add_argument('genome_dir', help='directory of fasta or genbank genomes, optionally gzipped')
+	parser.add_argument('--spacers', type=str, nargs='+', required=True, help='spacer sequences, or a csv with a spacer_seq column')
+	parser.add_argument('--cores', type=int, default=None, help='cores to use in total, all by default')
+	parser.add_argument('--shard_bases', type=int, default=200000000, help='approximate bases per index shard')
+	parser.add_argument('--output', type=str, default=PANGENOME_OUTPUT)
+	parser.add_argument('--mismatch_threshold', type=int, default=DEFAULT_CONFIG.mismatch_threshold)
+	args = parser.parse_args(argv)
+
+	spacers = args.spacers
+	if len(spacers) == 1 and spacers[0].endswith('.csv'):
+		with open(spacers[0], 'r', encoding='utf-8-sig') as f:
+			spacers = [row['spacer_seq'] for row in csv.DictReader(f)]
+	result = screen_pangenome(spacers, args.genome_dir, cores=args.cores, shard_bases=args.shard_bases,
+							  config=DEFAULT_CONFIG.replace(mismatch_threshold=args.mismatch_threshold))
+	write_hit_matrix(result, args.output)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from designer import region_candidates
+from finder import remove_offtarget_matches
+from filters import filter_non_unique_fingerprints
+from outputs import make_spacer_gen_output
+from instrument import stage, in_context
+from cores import available_cores
+from sharedmem import SharedGenomes, attach, attach_unique_spacers
+from kmers import unique_kmer_table
+from pool import CandidatePool
+
+# Pipelined spacer design: candidate generation -> fingerprint filter -> off-target alignment -> output writing
+# The stages are connected by bounded queues and run concurrently, so candidate generation for the next regions
+# overlaps with the bowtie2 runs of the previous ones. Generation runs in worker processes that read the genomes
+# from shared memory (see sharedmem.py), the bowtie2 stages in threads, and regions are written out in order
+# Stage timings from the generation processes are not part of the run trace
+
+DONE = None
+
+# genome id -> (genome, genome + reverse complement), and (genome id, spacer length) -> kmers.unique_kmer_table,
+# set once in every generation process
+_worker_genomes = {}
+_worker_unique_spacers = {}
+
+def _init_generation_worker(shared_descriptor):
+	# The genomes and their tables are read from shared memory, so every process doesn't hold its own copy
+	_worker_genomes.update(attach(shared_descriptor))
+	_worker_unique_spacers.update(attach_unique_spacers(shared_descriptor))
+
+def _generate(region, start_pct, end_pct, GC_requirement, coding_spacer_direction, config, genomes=None, unique_spacers=None):
+	# genomes and unique_spacers are given when generating in the pipeline's own process, otherwise they are this worker's
+	genomes = _worker_genomes if genomes is None else genomes
+	unique_spacers = _worker_unique_spacers if unique_spacers is None else unique_spacers
+	(genome, genome_both_ways) = genomes.get(region.get('genome_id'), (None, None))
+	return region_candidates(region, genome, genome_both_ways, start_pct, end_pct, GC_requirement, coding_spacer_direction, config,
+							 unique_spacers=unique_spacers.get((region.get('genome_id'), config.SPACER_LENGTH)))
+
+def stage_workers(func, in_queue, out_queue, workers, errors):
+	# Threads that apply func to every item of in_queue and put the result in out_queue
+	# DONE is passed on once every worker has finished. After an error, items are drained without work
+	# so no other stage blocks on a full queue
+	def work():
+		while True:
+			item = in_queue.get()
+			if item is DONE:
+				in_queue.put(DONE)  # so the other workers of this stage stop too
+				return
+			if errors:
+				continue
+			try:
+				out_queue.put(func(item))
+			except Exception as e:
+				errors.append(e)
+
+	threads = [threading.Thread(target=in_context(work), daemon=True) for _ in range(workers)]
+	for t in threads:
+		t.start()
+
+	def close():
+		for t in threads:
+			t.join()
+		out_queue.put(DONE)
+	threading.Thread(target=close, daemon=True).start()
+
+def design_pipelined(designer, regions, start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+					 overlapping_spacers='avoid', coding_spacer_direction=None, output_path=None, config=None,
+					 generation_processes=None, alignment_threads=2, queue_size=4):
+	# Same results as Designer.design, with the stages of different regions running concurrently
+	# generation_processes defaults to the number of cores (at most 4), 0 generates candidates in a thread instead
+	config = designer.config_for(config)
+	if generation_processes is None:
+		generation_processes = min(4, available_cores())
+	genome_ids = set([r['genome_id'] for r in regions if r.get('genome_id') is not None and 'sequence' not in r])
+
+	generated = queue.Queue(maxsize=queue_size)
+	fingerprinted = queue.Queue(maxsize=queue_size)
+	aligned = queue.Queue(maxsize=queue_size)
+	errors = []
+	# fingerprint and off-target verdicts shared between regions (uniqueness is checked in the generation processes)
+	pool = CandidatePool()
+	# loaded (or built) before the alignment threads start
+	prefilters = {genome_id: designer.offtarget_prefilter(genome_id, config) for genome_id in designer.genome_ids}
+
+	def generate():
+		# Producer: keeps at most queue_size regions in flight in the process pool, and queues them in order
+		shared = SharedGenomes()
+		try:
+			if generation_processes > 0:
+				for genome_id in genome_ids:
+					shared.add_genome(genome_id, designer.genome_seq(genome_id))
+					if config.SPACER_LENGTH <= 32:
+						shared.add_unique_spacers(genome_id, designer.genome_seq(genome_id), config.SPACER_LENGTH)
+				executor = ProcessPoolExecutor(generation_processes, initializer=_init_generation_worker, initargs=(shared.descriptor,))
+				submit = lambda region: executor.submit(_generate, region, start_pct, end_pct, GC_requirement, coding_spacer_direction, config)
+			else:
+				executor = None
+				genomes = {genome_id: (designer.genome_seq(genome_id), designer.genome_both_ways(genome_id)) for genome_id in genome_ids}
+				unique_spacers = {(genome_id, config.SPACER_LENGTH): unique_kmer_table(designer.genome_seq(genome_id), config.SPACER_LENGTH)
+								  for genome_id in genome_ids if config.SPACER_LENGTH <= 32}
+				submit = lambda region: _generate(region, start_pct, end_pct, GC_requirement, coding_spacer_direction, config, genomes, unique_spacers)
+
+			in_flight = deque()
+			for (index, region) in enumerate(regions):
+				if errors:
+					break
+				in_flight.append((index, region, submit(region)))
+				if len(in_flight) > queue_size:
+					(i, r, result) = in_flight.popleft()
+					generated.put((i, r, result.result() if executor else result))
+			while in_flight and not errors:
+				(i, r, result) = in_flight.popleft()
+				generated.put((i, r, result.result() if executor else result))
+			if executor:
+				executor.shutdown(cancel_futures=True)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			shared.close()
+		generated.put(DONE)
+
+	def fingerprint(item):
+		(index, region, candidates) = item
+		for genome_id in designer.genome_ids:
+			candidates = filter_non_unique_fingerprints(candidates, genome_id, pool)
+		print(f"{len(candidates)} remain after filtering for re_sites, homopolymers, and non unique fingerprints for {region['name']}")
+		return (index, region, designer.locate_candidates(region, candidates))
+
+	def align(item):
+		(index, region, candidates) = item
+		for genome_id in designer.genome_ids:
+			candidates = remove_offtarget_matches(genome_id, region['name'], candidates, spacers_per_region, overlapping_spacers,
+												  check_all=len(designer.genome_ids) > 1, config=config, pool=pool, prefilter=prefilters[genome_id])
+		return (index, region, candidates[:spacers_per_region])
+
+	with stage('pipeline', regions=len(regions)) as counters:
+		threading.Thread(target=in_context(generate), daemon=True).start()
+		stage_workers(fingerprint, generated, fingerprinted, 1, errors)
+		stage_workers(align, fingerprinted, aligned, alignment_threads, errors)
+
+		# Output writing, in region order
+		finished = {}
+		next_index = 0
+		while True:
+			item = aligned.get()
+			if item is DONE:
+				break
+			(index, region, candidates) = item
+			finished[index] = candidates
+			while next_index in finished:
+				regions[next_index]['candidates'] = finished.pop(next_index)
+				print(f"Identified {len(regions[next_index]['candidates'])} spacers for {regions[next_index]['name']}")
+				if output_path is not None:
+					make_spacer_gen_output(regions[next_index], os.path.join(output_path, 'spacer_gen_output.csv'), config)
+				next_index += 1
+		counters['regions_done'] = next_index
+
+	if errors:
+		raise errors[0]
+	return regions
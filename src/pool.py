@@ -0,0 +1,66 @@
+import threading
+
+# Verdicts shared by the regions of a run
+# Neighbouring and overlapping regions share search windows, so the same candidates would be checked once per
+# region. A CandidatePool keeps every uniqueness, fingerprint and off-target verdict of a run, keyed by the check
+# (e.g. ('offtarget', genome id)) and the sequence it looks at, so each candidate is checked once
+
+def spacer_key(candidate):
+	return str(candidate['seqrec'].seq).upper()
+
+def fingerprint_key(candidate):
+	return str(candidate['fp_seq'].seq).upper()
+
+class CandidatePool():
+	'''
+	Check results for the candidates of one run, shared across its regions.
+
+	A pool can be shared by threads (the pipeline's alignment threads, a prefetched off-target batch).
+	A key being checked by one thread is not checked again by another, which waits for its verdict.
+	'''
+
+	def __init__(self):
+		self.results = {}
+		self.computed = 0
+		self.reused = 0
+		self.lock = threading.Lock()
+		# keys being checked: {key: threading.Event set once its verdict is in results, or its check failed}
+		self.pending = {}
+
+	def verdicts(self, check, candidates, compute, key=spacer_key):
+		# {candidate name: verdict} for candidates, calling compute(unchecked candidates) -> {name: verdict} only
+		# for the ones no earlier region (or another candidate with the same key) was checked for
+		keys = [(check, key(c)) for c in candidates]
+		computed_here = 0
+		while True:
+			with self.lock:
+				missing = {k: c for (k, c) in zip(keys, candidates) if k not in self.results}
+				waiting = [self.pending[k] for k in missing if k in self.pending]
+				claimed = [(k, c) for (k, c) in missing.items() if k not in self.pending]
+				for (k, _) in claimed:
+					self.pending[k] = threading.Event()
+			if len(claimed):
+				try:
+					computed = compute([c for (_, c) in claimed])
+					with self.lock:
+						for (k, c) in claimed:
+							self.results[k] = computed[c['name']]
+						self.computed += len(claimed)
+					computed_here += len(claimed)
+				finally:
+					with self.lock:
+						for (k, _) in claimed:
+							self.pending.pop(k).set()
+			if not len(waiting):
+				break
+			# checked by another thread meanwhile, if its check failed the key is claimed again on the next pass
+			for event in waiting:
+				event.wait()
+		with self.lock:
+			self.reused += len(candidates) - computed_here
+			return {c['name']: self.results[k] for (k, c) in zip(keys, candidates)}
+
+	def keep(self, check, candidates, compute, key=spacer_key):
+		# The candidates whose verdict is True, in order
+		verdicts = self.verdicts(check, candidates, compute, key)
+		return [c for c in candidates if verdicts[c['name']]]
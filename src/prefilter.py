@@ -0,0 +1,222 @@
+import os
+import threading
+from math import comb
+from itertools import combinations, product
+from pathlib import Path
+
+import numpy as np
+
+from kmers import encode_seq, reverse_complement_codes
+from instrument import stage
+
+# Off-target prefilter
+# A candidate passes remove_offtarget_matches when its target site is its only alignment within
+# mismatch_threshold mismatches. Two Bloom filters over the genome's seeds (the non-flexible bases of every
+# spacer-length window, both strands), one of every seed and one of the seeds seen at two or more windows,
+# show that a candidate has no other site when its seed isn't repeated and no seed within mismatch_threshold
+# substitutions of it is seen. Bloom filters have no false negatives, so those candidates pass without bowtie2
+# and every other candidate is aligned as before. Not used with allow_gaps, for genomes with ambiguous bases,
+# or when a candidate would take more than PREFILTER_MAX_LOOKUPS lookups. Saved next to the bowtie2 index
+
+PREFILTER_MAX_LOOKUPS = 100000
+# 32 bits and 22 hash functions per seed give a false positive rate around 2e-7 per lookup, so a clean
+# candidate is rarely taken for possibly dirty even with PREFILTER_MAX_LOOKUPS lookups
+PREFILTER_BITS_PER_SEED = 32
+PREFILTER_HASHES = 22
+
+def seed_lookups(config):
+	# Seeds looked up per candidate: its own and every one within mismatch_threshold substitutions
+	seed_length = len(seed_positions(config))
+	return sum([comb(seed_length, count) * 3 ** count for count in range(config.mismatch_threshold + 1)])
+
+def prefilter_applies(config):
+	return not config.allow_gaps and len(seed_positions(config)) <= 32 and seed_lookups(config) <= PREFILTER_MAX_LOOKUPS
+
+def seed_positions(config):
+	# Spacer positions whose bases are part of a seed: every one that isn't flexible
+	flex_positions = set(config.flex_positions())
+	return [i for i in range(config.SPACER_LENGTH) if i not in flex_positions]
+
+def pack_seeds(codes, positions, spacer_length):
+	# [seeds, valid] for the window starting at every position of codes (kmers.py base codes, 1d or 2d like pack_kmers)
+	# valid is False for windows with a non-ACGT base at a seed position
+	codes = np.asarray(codes)
+	n = codes.shape[-1] - spacer_length + 1
+	if n <= 0:
+		empty_shape = codes.shape[:-1] + (0,)
+		return [np.zeros(empty_shape, dtype=np.uint64), np.zeros(empty_shape, dtype=bool)]
+	seeds = np.zeros(codes.shape[:-1] + (n,), dtype=np.uint64)
+	invalid = np.zeros(codes.shape[:-1] + (n,), dtype=bool)
+	for p in positions:
+		window = codes[..., p:p+n]
+		seeds = (seeds << np.uint64(2)) | (window & 3).astype(np.uint64)
+		invalid |= window == 4
+	return [seeds, ~invalid]
+
+def substitution_masks(seed_length, mismatches):
+	# XOR masks that turn a packed seed into every seed with 1 to mismatches substituted bases
+	masks = []
+	for count in range(1, mismatches + 1):
+		for positions in combinations(range(seed_length), count):
+			shifts = np.array([2 * (seed_length - 1 - p) for p in positions], dtype=np.uint64)
+			for changes in product([1, 2, 3], repeat=count):
+				masks.append(int(np.bitwise_or.reduce(np.array(changes, dtype=np.uint64) << shifts)))
+	return np.array(masks, dtype=np.uint64)
+
+def mix64(x):
+	# splitmix64 finalizer, a fast well-mixed hash of uint64 arrays
+	x = x + np.uint64(0x9E3779B97F4A7C15)
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return x ^ (x >> np.uint64(31))
+
+class BloomFilter():
+	'''
+	Bloom filter of uint64 keys, with a power of two number of bits and double hashing.
+	'''
+
+	def __init__(self, bits, hashes):
+		self.bits = bits
+		self.hashes = hashes
+		self.mask = np.uint64(len(bits) * 8 - 1)
+
+	@classmethod
+	def sized(cls, keys, bits_per_key=PREFILTER_BITS_PER_SEED, hashes=PREFILTER_HASHES):
+		size = 1 << max(int(np.ceil(np.log2(max(keys, 1) * bits_per_key))), 6)
+		return cls(np.zeros(size // 8, dtype=np.uint8), hashes)
+
+	def positions(self, keys):
+		first = mix64(keys)
+		step = mix64(first) | np.uint64(1)
+		return [(first + np.uint64(i) * step) & self.mask for i in range(self.hashes)]
+
+	def add(self, keys, chunk_size=1000000):
+		for start in range(0, len(keys), chunk_size):
+			for position in self.positions(keys[start:start + chunk_size]):
+				np.bitwise_or.at(self.bits, position >> np.uint64(3), (np.uint8(1) << (position & np.uint64(7)).astype(np.uint8)))
+
+	def contains(self, keys):
+		found = np.ones(len(keys), dtype=bool)
+		for position in self.positions(keys):
+			found &= (self.bits[position >> np.uint64(3)] >> (position & np.uint64(7)).astype(np.uint8)) & np.uint8(1) == 1
+		return found
+
+	def false_positive_rate(self):
+		# Chance that a key that was never added is reported present, from the fraction of bits set
+		fill = np.unpackbits(self.bits).mean() if len(self.bits) else 0
+		return float(fill ** self.hashes)
+
+class OfftargetPrefilter():
+	'''
+	Splits candidates into definitely clean and possibly dirty, see the module docstring.
+
+	Counts every split and the alignments of possibly dirty candidates, for stats().
+	'''
+
+	def __init__(self, genome_id, seen, repeated, positions):
+		self.genome_id = genome_id
+		self.seen = seen
+		self.repeated = repeated
+		self.positions = positions
+		self.masks = {}
+		self.counts = {'checked': 0, 'clean': 0, 'aligned': 0, 'aligned_clean': 0}
+		self.lock = threading.Lock()
+
+	@classmethod
+	def build(cls, genome_id, contigs, config):
+		# contigs are the genome's sequences, one per contig, as in its bowtie2 index
+		positions = seed_positions(config)
+		seeds = []
+		for contig in contigs:
+			codes = encode_seq(contig)
+			for strand in [codes, reverse_complement_codes(codes)]:
+				[strand_seeds, valid] = pack_seeds(strand, positions, config.SPACER_LENGTH)
+				seeds.append(strand_seeds[valid])
+		seeds = np.sort(np.concatenate(seeds)) if len(seeds) else np.zeros(0, dtype=np.uint64)
+		first = np.ones(len(seeds), dtype=bool)
+		first[1:] = seeds[1:] != seeds[:-1]
+		repeats = np.zeros(len(seeds), dtype=bool)
+		repeats[1:] = ~first[1:]
+		distinct = seeds[first]
+		repeated = np.unique(seeds[repeats])
+
+		seen_filter = BloomFilter.sized(len(distinct))
+		seen_filter.add(distinct)
+		repeated_filter = BloomFilter.sized(len(repeated))
+		repeated_filter.add(repeated)
+		return cls(genome_id, seen_filter, repeated_filter, positions)
+
+	def save(self, path):
+		np.savez(path, seen=self.seen.bits, repeated=self.repeated.bits, hashes=self.seen.hashes, positions=np.array(self.positions))
+
+	@classmethod
+	def load(cls, genome_id, path):
+		with np.load(path) as saved:
+			hashes = int(saved['hashes'])
+			return cls(genome_id, BloomFilter(saved['seen'], hashes), BloomFilter(saved['repeated'], hashes), [int(p) for p in saved['positions']])
+
+	def substitutions(self, mismatches):
+		if mismatches not in self.masks:
+			self.masks[mismatches] = substitution_masks(len(self.positions), mismatches)
+		return self.masks[mismatches]
+
+	def split(self, candidates, config):
+		# [definitely clean candidates, possibly dirty candidates], in order
+		masks = self.substitutions(config.mismatch_threshold)
+		clean = []
+		possibly_dirty = []
+		with stage('offtarget_prefilter', genome=self.genome_id, candidates_in=len(candidates)) as counters:
+			for c in candidates:
+				[seed, valid] = pack_seeds(encode_seq(str(c['seqrec'].seq).upper()), self.positions, config.SPACER_LENGTH)
+				if valid[0] and not self.repeated.contains(seed)[0] and not self.seen.contains(seed[0] ^ masks).any():
+					clean.append(c)
+				else:
+					possibly_dirty.append(c)
+			counters['alignments_saved'] = len(clean)
+		with self.lock:
+			self.counts['checked'] += len(candidates)
+			self.counts['clean'] += len(clean)
+		return [clean, possibly_dirty]
+
+	def record_alignments(self, verdicts):
+		# verdicts of the possibly dirty candidates, from bowtie2
+		with self.lock:
+			self.counts['aligned'] += len(verdicts)
+			self.counts['aligned_clean'] += sum(verdicts.values())
+
+	def stats(self):
+		# Counts, and the false positive rates: per seed lookup (estimated from the filters), and the share of possibly
+		# dirty candidates bowtie2 then passed (lookup false positives and near sites bowtie2 doesn't report)
+		with self.lock:
+			stats = dict(self.counts)
+		stats['lookup_false_positive_rate'] = max(self.seen.false_positive_rate(), self.repeated.false_positive_rate())
+		stats['possibly_dirty_passed_rate'] = stats['aligned_clean'] / stats['aligned'] if stats['aligned'] else 0
+		return stats
+
+	def summary(self):
+		stats = self.stats()
+		return (f"Off-target prefilter for {self.genome_id}: {stats['clean']} of {stats['checked']} candidates were clean without alignment, "
+				f"{stats['aligned_clean']} of {stats['aligned']} possibly dirty ones passed it "
+				f"(lookup false positive rate {stats['lookup_false_positive_rate']:.1e})")
+
+def prefilter_path(genome_id, config):
+	root_dir = Path(__file__).parent.parent
+	flex_positions = '-'.join([str(p) for p in config.flex_positions()]) or 'none'
+	return os.path.join(root_dir, 'assets', 'bowtie', genome_id, f'prefilter_{config.SPACER_LENGTH}_{flex_positions}.npz')
+
+def load_prefilter(genome_id, contigs, config):
+	# The prefilter of genome_id for config, built from contigs and saved next to the bowtie2 index the first time
+	# None if it can't be used with config or the genome has ambiguous bases
+	if not prefilter_applies(config):
+		return None
+	path = prefilter_path(genome_id, config)
+	if Path(path).exists():
+		return OfftargetPrefilter.load(genome_id, path)
+	if any([(encode_seq(contig) == 4).any() for contig in contigs]):
+		print(f"{genome_id} has ambiguous bases, every candidate is aligned against it")
+		return None
+	with stage('offtarget_prefilter_build', genome=genome_id):
+		prefilter = OfftargetPrefilter.build(genome_id, contigs, config)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	prefilter.save(path)
+	return prefilter
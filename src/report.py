@@ -0,0 +1,105 @@
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+# Formats for the detailed off-target report written by spacer_eval
+# 'text' writes one <spacer>_off_target.txt file per spacer (original behavior)
+# 'jsonl' writes every hit to a single JSON Lines file, plus a small index file by spacer
+# 'sqlite' writes every hit to a single SQLite database, indexed by spacer
+REPORT_FORMATS = ['text', 'jsonl', 'sqlite']
+
+HIT_FIELDS = ['spacer', 'genome', 'contig', 'coordinate', 'strand', 'pam', 'pam_supported', 'protospacer',
+			  'mismatches', 'mismatch_positions', 'gapped', 'perfect_match', 'risk', 'alignment']
+
+def report_filename(output_path, report_format):
+	extension = 'jsonl' if report_format == 'jsonl' else 'sqlite'
+	return os.path.join(Path(output_path), f'spacer_eval_off_targets.{extension}')
+
+def index_filename(report_path):
+	return f'{report_path}.idx.json'
+
+class OffTargetReport():
+	'''
+	Single-file off-target report, written one spacer at a time.
+
+	Hits for a spacer are written together as soon as that spacer is evaluated,
+	so nothing but the current spacer is held in memory. The report is indexed
+	by spacer name so that query_offtarget_report can read back one spacer
+	without scanning the whole file.
+	'''
+
+	def __init__(self, path, report_format):
+		if report_format not in ['jsonl', 'sqlite']:
+			raise Exception(f"Unknown off-target report format '{report_format}', must be one of {REPORT_FORMATS}")
+		self.path = path
+		self.report_format = report_format
+		self.index = {}
+		if report_format == 'jsonl':
+			self.out = open(path, 'wb')
+		else:
+			if Path(path).exists():
+				os.remove(path)
+			self.db = sqlite3.connect(path)
+			self.db.execute(
+				'CREATE TABLE hits (spacer TEXT, genome TEXT, contig TEXT, coordinate INTEGER, strand TEXT, pam TEXT, '
+				'pam_supported INTEGER, protospacer TEXT, mismatches INTEGER, mismatch_positions TEXT, gapped INTEGER, '
+				'perfect_match INTEGER, risk REAL, alignment TEXT)')
+
+	def write_spacer(self, spacer_name, hits):
+		if self.report_format == 'jsonl':
+			# index entry is [byte offset of the first hit, number of hits]
+			self.index[spacer_name] = [self.out.tell(), len(hits)]
+			for hit in hits:
+				row = {field: hit.get(field) for field in HIT_FIELDS}
+				row['spacer'] = spacer_name
+				self.out.write((json.dumps(row) + '\n').encode('utf-8'))
+		else:
+			rows = [(spacer_name, h['genome'], h.get('contig'), h['coordinate'], h['strand'], h['pam'], int(h['pam_supported']), h['protospacer'],
+					 h['mismatches'], json.dumps(h['mismatch_positions']), int(h['gapped']),
+					 int(h['perfect_match']), h.get('risk'), h['alignment']) for h in hits]
+			self.db.executemany('INSERT INTO hits VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+			self.db.commit()
+
+	def close(self):
+		if self.report_format == 'jsonl':
+			self.out.close()
+			with open(index_filename(self.path), 'w') as index_file:
+				json.dump(self.index, index_file)
+		else:
+			# build the index once at the end, which is much faster than maintaining it during inserts
+			self.db.execute('CREATE INDEX hits_by_spacer ON hits (spacer)')
+			self.db.commit()
+			self.db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def query_offtarget_report(path, spacer_name):
+	# Returns the list of hits recorded for one spacer in a jsonl or sqlite report
+	if str(path).endswith('.jsonl'):
+		with open(index_filename(path), 'r') as index_file:
+			index = json.load(index_file)
+		if spacer_name not in index:
+			return []
+		[start, count] = index[spacer_name]
+		with open(path, 'rb') as report:
+			report.seek(start)
+			return [json.loads(report.readline()) for _ in range(count)]
+
+	db = sqlite3.connect(path)
+	db.row_factory = sqlite3.Row
+	rows = db.execute('SELECT * FROM hits WHERE spacer = ? ORDER BY risk DESC', (spacer_name,)).fetchall()
+	db.close()
+	hits = []
+	for r in rows:
+		hit = dict(r)
+		hit['mismatch_positions'] = json.loads(hit['mismatch_positions'])
+		hit['gapped'] = bool(hit['gapped'])
+		hit['pam_supported'] = bool(hit['pam_supported'])
+		hit['perfect_match'] = bool(hit['perfect_match'])
+		hits.append(hit)
+	return hits
@@ -0,0 +1,71 @@
+import re
+
+import numpy as np
+
+from kmers import encode_seq
+
+# Off-target mismatch profiles and risk
+# All of a spacer's ungapped, full-length hits are compared with it position by position at once, giving each
+# hit's exact mismatch count and positions (bowtie2's XM counts the N of every flexible position too)
+# A hit's risk is the product of the weights of its mismatched positions (see position_weights), 1 for an
+# identical site. Each edit of a gapped hit is weighed as a mismatch outside the seed
+
+def mismatch_profiles(spacer_seq, protospacers, config):
+	# Boolean array (hits x spacer length), True where each protospacer differs from the spacer
+	# protospacers are ungapped and at least as long as the spacer. Flexible positions and ambiguous bases never mismatch
+	length = len(spacer_seq)
+	if not len(protospacers):
+		return np.zeros((0, length), dtype=bool)
+	spacer = encode_seq(str(spacer_seq))
+	targets = encode_seq(''.join([str(p)[:length] for p in protospacers])).reshape(len(protospacers), length)
+	profiles = (targets != spacer) & (targets != 4) & (spacer != 4)
+	profiles[:, [p for p in config.flex_positions() if p < length]] = False
+	return profiles
+
+# Complements of the bases a SAM read or its MD tag can hold
+READ_COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+def read_protospacer(read):
+	# [flexible spacer, protospacer] of an ungapped SAM read, both in the spacer's orientation. The protospacer is
+	# the read with the reference bases of its MD tag put in at the mismatches, so no genome sequence is needed
+	reference = list(read.seq)
+	position = 0
+	for (matches, base) in re.findall(r'(\d+)([A-Z]?)', read.tags['MD']):
+		position += int(matches)
+		if base:
+			reference[position] = base
+			position += 1
+	reference = ''.join(reference)
+	if read.reverse:
+		return [read.seq.translate(READ_COMPLEMENT)[::-1], reference.translate(READ_COMPLEMENT)[::-1]]
+	return [read.seq, reference]
+
+def read_mismatches(read, config):
+	# Exact mismatch count of an ungapped SAM read (see mismatch_profiles), None for a gapped one
+	if read.tags.get('XO', 0) > 0:
+		return None
+	[spacer, protospacer] = read_protospacer(read)
+	return int(mismatch_profiles(spacer, [protospacer], config).sum())
+
+def profile_positions(profiles):
+	# The mismatch positions of every profile, as lists
+	(rows, positions) = np.nonzero(profiles)
+	return [p.tolist() for p in np.split(positions, np.cumsum(np.bincount(rows, minlength=len(profiles)))[:-1])]
+
+def position_weights(length, config):
+	# What a mismatch at each spacer position multiplies a hit's risk by
+	weights = np.full(length, config.distal_mismatch_weight, dtype=float)
+	weights[:config.seed_length] = config.seed_mismatch_weight
+	return weights
+
+def hit_risks(profiles, config):
+	return np.where(profiles, position_weights(profiles.shape[1], config), 1.0).prod(axis=1)
+
+def gapped_hit_risk(edits, config):
+	return config.distal_mismatch_weight ** edits
+
+def spacer_risk(hits):
+	# Sum of the risks of a spacer's hits, without its target sites: as in remove_offtarget_matches, one
+	# identical hit per genome is the target site itself
+	targets = len(set([h['genome'] for h in hits if h['perfect_match']]))
+	return max(sum([h['risk'] for h in hits]) - targets, 0)
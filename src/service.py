@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from genbank import retrieve_annotation, load_genome_file, loaded_genome_paths
+from designer import Designer
+from main import spacer_gen, spacer_eval
+from instrument import in_context
+
+# Long-running design service: keeps genomes, bowtie2 indices and Designer sessions resident between jobs
+# Jobs take the argument dicts of main.spacer_gen and main.spacer_eval, are queued and run with bounded concurrency
+#	POST /jobs           {"command": "spacer_gen" or "spacer_eval", "args": {...}, "wait": true/false}
+#	GET  /jobs/<job_id>  status and, once finished, the result of a job
+#	GET  /status         queue and cache information
+# Ex. python service.py --port 8765 --preload_genbank_ids CP001509.3 --email me@example.com
+#     python service.py --unix_socket /tmp/integrate.sock
+
+COMMANDS = {'spacer_gen': spacer_gen, 'spacer_eval': spacer_eval}
+
+def region_result(region):
+	# JSON-friendly summary of a region returned by spacer_gen
+	return {
+		'name': region['name'],
+		'start': region.get('start'),
+		'end': region.get('end'),
+		'direction': region.get('direction'),
+		'spacers': [{'sequence': str(c['seqrec'].seq), 'location': c['location'], 'strand': c['name'].split('--')[1][:2]}
+					for c in region.get('candidates', [])]
+	}
+
+def job_result(command, result):
+	if result is None:
+		return None
+	if command == 'spacer_gen':
+		if len(result) and 'setting' in result[0]:
+			# a sweep, with the regions found for each setting
+			return [{'setting': r['setting'], 'regions': [region_result(region) for region in r['regions']]} for r in result]
+		return [region_result(r) for r in result]
+	return [{k: str(v) if k == 'sequence' else v for (k, v) in spacer.items()} for spacer in result]
+
+class DesignService():
+	def __init__(self, max_concurrent_jobs=2, max_queued_jobs=100, finished_job_seconds=3600, max_finished_jobs=1000, max_design_sessions=8):
+		self.executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs)
+		self.max_concurrent_jobs = max_concurrent_jobs
+		self.max_queued_jobs = max_queued_jobs
+		self.finished_job_seconds = finished_job_seconds
+		self.max_finished_jobs = max_finished_jobs
+		self.max_design_sessions = max_design_sessions
+		self.jobs = {}
+		# key: Future of the Designer, least recently used first
+		self.designers = OrderedDict()
+		self.lock = threading.Lock()
+
+	def preload(self, genbank_ids=[], genbank_files=[], fasta_files=[], email=''):
+		# Parse genomes (and build their bowtie2 indices) up front, so the first job is already warm
+		for genbank_id in genbank_ids:
+			retrieve_annotation(genbank_id, email)
+		for genbank_file in genbank_files:
+			load_genome_file(genbank_file, 'genbank')
+		for fasta_file in fasta_files:
+			load_genome_file(fasta_file, 'fasta')
+
+	def designer_for(self, command, args):
+		# Jobs against the same genomes share one design session
+		if command == 'spacer_gen':
+			genomes = (tuple(args.get('genbank_ids', [])), tuple(args.get('genbank_files', [])), tuple(args.get('genome_fasta_files', [])))
+		else:
+			genomes = (tuple(args.get('genbank_ids', [])), (), tuple(args.get('fasta_files', [])))
+		key = genomes + (args.get('email', ''),)
+		# the session is built (genomes fetched, indices built) outside the lock, jobs for the same genomes wait for it
+		with self.lock:
+			session = self.designers.get(key)
+			build = session is None
+			if build:
+				session = Future()
+				self.designers[key] = session
+				while len(self.designers) > self.max_design_sessions:
+					self.designers.popitem(last=False)
+			else:
+				self.designers.move_to_end(key)
+		if build:
+			try:
+				session.set_result(Designer(genomes[0], genomes[1], genomes[2], args.get('email', '')))
+			except Exception as e:
+				session.set_exception(e)
+				# so a later job tries again
+				with self.lock:
+					if self.designers.get(key) is session:
+						del self.designers[key]
+		return session.result()
+
+	def pending_jobs(self):
+		with self.lock:
+			return len([j for j in self.jobs.values() if j['status'] in ['queued', 'running']])
+
+	def evict_finished_jobs(self):
+		# Drops finished jobs older than finished_job_seconds, and the oldest beyond max_finished_jobs. Called with the lock held
+		finished = sorted([j for j in self.jobs.values() if 'finished' in j], key=lambda j: j['finished'])
+		expired = time.time() - self.finished_job_seconds
+		for (number, job) in enumerate(finished):
+			if job['finished'] < expired or number < len(finished) - self.max_finished_jobs:
+				del self.jobs[job['id']]
+
+	def submit(self, command, args):
+		if command not in COMMANDS:
+			raise ValueError(f"Unknown command '{command}', must be one of {list(COMMANDS.keys())}")
+		job_id = uuid.uuid4().hex
+		job = {'id': job_id, 'command': command, 'status': 'queued', 'submitted': time.time(), 'result': None, 'error': None}
+		# checked and added under one lock, so concurrent submits can't go over max_queued_jobs
+		with self.lock:
+			self.evict_finished_jobs()
+			if len([j for j in self.jobs.values() if j['status'] in ['queued', 'running']]) >= self.max_queued_jobs:
+				raise OverflowError(f"Too many jobs queued ({self.max_queued_jobs}), try again later")
+			self.jobs[job_id] = job
+		job['future'] = self.executor.submit(in_context(self.run_job), job, args)
+		return job
+
+	def get_job(self, job_id):
+		with self.lock:
+			self.evict_finished_jobs()
+			return self.jobs.get(job_id)
+
+	def run_job(self, job, args):
+		job['status'] = 'running'
+		job['started'] = time.time()
+		try:
+			designer = self.designer_for(job['command'], args)
+			# invalid input is raised rather than printed, so the job is reported as failed with its message
+			job['result'] = job_result(job['command'], COMMANDS[job['command']](args, designer, raise_input_errors=True))
+			status = 'done'
+		except Exception as e:
+			job['error'] = str(e)
+			status = 'failed'
+		job['finished'] = time.time()
+		job['status'] = status
+
+	def job_summary(self, job):
+		return {k: v for (k, v) in job.items() if k != 'future'}
+
+	def status(self):
+		with self.lock:
+			self.evict_finished_jobs()
+			counts = {}
+			for j in self.jobs.values():
+				counts[j['status']] = counts.get(j['status'], 0) + 1
+			sessions = len(self.designers)
+		return {'max_concurrent_jobs': self.max_concurrent_jobs, 'max_queued_jobs': self.max_queued_jobs,
+				'jobs': counts, 'loaded_genomes': loaded_genome_paths(), 'design_sessions': sessions}
+
+def make_handler(service):
+	class DesignRequestHandler(BaseHTTPRequestHandler):
+		def address_string(self):
+			# Unix socket clients have no address
+			return self.client_address[0] if self.client_address else 'unix-socket'
+
+		def send_json(self, code, body):
+			data = json.dumps(body, default=str).encode('utf-8')
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def do_GET(self):
+			if self.path == '/status':
+				return self.send_json(200, service.status())
+			if self.path.startswith('/jobs/'):
+				job = service.get_job(self.path[len('/jobs/'):])
+				if not job:
+					return self.send_json(404, {'error': 'Unknown job id'})
+				return self.send_json(200, service.job_summary(job))
+			self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+		def do_POST(self):
+			if self.path != '/jobs':
+				return self.send_json(404, {'error': f'Unknown path {self.path}'})
+			try:
+				body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+				job = service.submit(body.get('command'), body.get('args', {}))
+			except OverflowError as e:
+				return self.send_json(503, {'error': str(e)})
+			except (ValueError, KeyError) as e:
+				return self.send_json(400, {'error': str(e)})
+			if body.get('wait', False):
+				job['future'].result()
+				return self.send_json(200, service.job_summary(job))
+			self.send_json(202, service.job_summary(job))
+	return DesignRequestHandler
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def server_bind(self):
+		socketserver.UnixStreamServer.server_bind(self)
+		self.server_name = 'localhost'
+		self.server_port = 0
+
+def serve(service, host='127.0.0.1', port=8765, unix_socket=''):
+	if unix_socket:
+		if os.path.exists(unix_socket):
+			os.remove(unix_socket)
+		server = ThreadingUnixHTTPServer(unix_socket, make_handler(service))
+		print(f"Design service listening on {unix_socket}")
+	else:
+		server = ThreadingHTTPServer((host, port), make_handler(service))
+		print(f"Design service listening on http://{host}:{port}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.executor.shutdown(wait=False)
+	return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+	def __init__(self, unix_socket, timeout=None):
+		super().__init__('localhost', timeout=timeout)
+		self.unix_socket = unix_socket
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect(self.unix_socket)
+
+def submit_job(command, args, host='127.0.0.1', port=8765, unix_socket='', wait=True, timeout=None):
+	# Client helper: send a job to a running service and return its job summary (with the result if wait)
+	if unix_socket:
+		connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+	else:
+		connection = http.client.HTTPConnection(host, port, timeout=timeout)
+	body = json.dumps({'command': command, 'args': args, 'wait': wait})
+	connection.request('POST', '/jobs', body=body, headers={'Content-Type': 'application/json'})
+	response = connection.getresponse()
+	result = json.loads(response.read())
+	connection.close()
+	if response.status >= 400:
+		raise Exception(f"Design service error ({response.status}): {result.get('error')}")
+	return result
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Long-running guide RNA design service')
+	parser.add_argument('--host', type=str, default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--unix_socket', type=str, default='', help='listen on this Unix socket instead of a TCP port')
+	parser.add_argument('--max_concurrent_jobs', type=int, default=2)
+	parser.add_argument('--max_queued_jobs', type=int, default=100)
+	parser.add_argument('--preload_genbank_ids', type=str, nargs='*', default=[])
+	parser.add_argument('--preload_genbank_files', type=str, nargs='*', default=[])
+	parser.add_argument('--preload_fasta_files', type=str, nargs='*', default=[])
+	parser.add_argument('--email', type=str, default='', help='only used for NCBI API calls when preloading genbank ids')
+	args = parser.parse_args(argv)
+
+	service = DesignService(args.max_concurrent_jobs, args.max_queued_jobs)
+	service.preload(args.preload_genbank_ids, args.preload_genbank_files, args.preload_fasta_files, args.email)
+	serve(service, args.host, args.port, args.unix_socket)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from designer import Designer
+from outputs import make_spacer_gen_output
+from config import make_config
+from sharedmem import SharedGenomes
+from cores import available_cores, set_core_budget
+
+# Region sharding across machines with a file-based work queue
+# A coordinator (spacer_gen with queue_dir, or create_queue) writes the shards of a run to a shared directory:
+# job.json, pending/, claimed/ (the file's modification time is the worker's lease, renewed by a heartbeat),
+# done/ and results/. Every state change is an atomic rename, so a shard is claimed by one worker at a time
+# merge_results joins the finished shards into one spacer_gen_output.csv in region order
+# Ex. python shards.py worker ./queue
+#     python shards.py local ./queue --workers 4
+#     python shards.py merge ./queue ./outputs
+
+QUEUE_STATES = ['pending', 'claimed', 'done', 'results']
+
+def shard_path(queue_dir, state, shard):
+	return os.path.join(queue_dir, state, shard)
+
+def create_queue(queue_dir, job, regions, shard_size=20, lease_seconds=600):
+	# job holds the Designer and design parameters, see run_shard for the fields used
+	for state in QUEUE_STATES:
+		os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+	job = dict(job, lease_seconds=lease_seconds, shards=0)
+	for (index, start) in enumerate(range(0, len(regions), shard_size)):
+		shard = f'shard-{index:05d}.json'
+		write_atomic(shard_path(queue_dir, 'pending', shard), json.dumps({'index': index, 'regions': regions[start:start+shard_size]}))
+		job['shards'] += 1
+	write_atomic(os.path.join(queue_dir, 'job.json'), json.dumps(job, indent=1))
+	print(f"Queued {len(regions)} regions in {job['shards']} shards in {queue_dir}")
+	return job
+
+def write_atomic(path, text):
+	temp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+	with open(temp_path, 'w') as f:
+		f.write(text)
+	os.replace(temp_path, path)
+
+def read_job(queue_dir):
+	with open(os.path.join(queue_dir, 'job.json'), 'r') as f:
+		return json.load(f)
+
+def queue_status(queue_dir):
+	return {state: len([f for f in os.listdir(os.path.join(queue_dir, state)) if '.tmp-' not in f]) for state in QUEUE_STATES}
+
+def requeue_expired(queue_dir, lease_seconds):
+	# Moves shards whose lease was not renewed in time back to pending
+	requeued = []
+	now = time.time()
+	for shard in os.listdir(os.path.join(queue_dir, 'claimed')):
+		path = shard_path(queue_dir, 'claimed', shard)
+		try:
+			stat = os.stat(path)
+			# renaming updates ctime, so a shard claimed a moment ago is never taken as expired
+			if now - max(stat.st_mtime, stat.st_ctime) > lease_seconds:
+				os.rename(path, shard_path(queue_dir, 'pending', shard))
+				requeued.append(shard)
+		except FileNotFoundError:
+			pass  # finished or requeued by someone else meanwhile
+	return requeued
+
+def claim_shard(queue_dir):
+	for shard in sorted(os.listdir(os.path.join(queue_dir, 'pending'))):
+		if '.tmp-' in shard:
+			continue
+		try:
+			os.rename(shard_path(queue_dir, 'pending', shard), shard_path(queue_dir, 'claimed', shard))
+		except FileNotFoundError:
+			continue  # another worker claimed it first
+		os.utime(shard_path(queue_dir, 'claimed', shard))
+		return shard
+	return None
+
+def heartbeat(path, interval, stop):
+	# Renews a claimed shard's lease until stop is set
+	while not stop.wait(interval):
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return  # the lease was lost, the shard was requeued
+
+def run_shard(queue_dir, shard, job, designer):
+	with open(shard_path(queue_dir, 'claimed', shard), 'r') as f:
+		regions = json.load(f)['regions']
+	config = make_config(job['config'])
+	designer.design(regions, job['start_pct'], job['end_pct'], job['spacers_per_region'], job['GC_requirement'],
+					job['overlapping_spacers'], job['coding_spacer_direction'], config=config)
+
+	result = shard_path(queue_dir, 'results', shard[:-len('.json')] + '.csv')
+	temp_result = f'{result}.tmp-{os.getpid()}'
+	if os.path.exists(temp_result):
+		os.remove(temp_result)
+	for region in regions:
+		make_spacer_gen_output(region, os.path.abspath(temp_result), config)
+	if not len(regions) or not os.path.exists(temp_result):
+		open(temp_result, 'w').close()
+	os.replace(temp_result, result)
+	try:
+		os.rename(shard_path(queue_dir, 'claimed', shard), shard_path(queue_dir, 'done', shard))
+	except FileNotFoundError:
+		pass  # the lease expired and another worker has the shard now, its results are the same
+
+def run_worker(queue_dir, worker_id=None, poll_seconds=10, shared_descriptor=None, cores=None):
+	# Claims and designs shards until every shard is done. Returns the number of shards this worker designed
+	# shared_descriptor (from sharedmem.SharedGenomes) attaches to genomes loaded by a local parent process instead of loading them again
+	# cores is this worker's budget for bowtie2 threads (see cores.py), every core the process may use but one by default
+	worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+	if cores is not None:
+		set_core_budget(cores)
+	job = read_job(queue_dir)
+	lease_seconds = job['lease_seconds']
+	designer = None
+	completed = 0
+	while True:
+		requeue_expired(queue_dir, lease_seconds)
+		shard = claim_shard(queue_dir)
+		if shard is None:
+			if queue_status(queue_dir)['done'] >= job['shards']:
+				break
+			# the rest is claimed by other workers, wait in case one of them stops
+			time.sleep(poll_seconds)
+			continue
+
+		print(f"Worker {worker_id} claimed {shard}")
+		if designer is None and shared_descriptor is not None:
+			designer = Designer.attached(shared_descriptor)
+		elif designer is None:
+			designer = Designer(job['genbank_ids'], job['genbank_files'], job['genome_fasta_files'], job['email'], job['config'])
+		stop = threading.Event()
+		threading.Thread(target=heartbeat, args=(shard_path(queue_dir, 'claimed', shard), lease_seconds / 3, stop), daemon=True).start()
+		try:
+			run_shard(queue_dir, shard, job, designer)
+		finally:
+			stop.set()
+		completed += 1
+	print(f"Worker {worker_id} finished, designed {completed} shards")
+	return completed
+
+def merge_results(queue_dir, output_path):
+	# Appends every shard's spacers, in shard order, to spacer_gen_output.csv in output_path
+	job = read_job(queue_dir)
+	results = sorted([r for r in os.listdir(os.path.join(queue_dir, 'results')) if r.endswith('.csv')])
+	if len(results) < job['shards']:
+		raise Exception(f"Only {len(results)} of {job['shards']} shards are finished, run more workers before merging")
+
+	output_filename = os.path.join(output_path, 'spacer_gen_output.csv')
+	needs_header = not os.path.exists(output_filename)
+	with open(output_filename, 'a', newline='') as output:
+		for result in results:
+			with open(shard_path(queue_dir, 'results', result), 'r', newline='') as f:
+				lines = f.readlines()
+			if len(lines) and needs_header:
+				output.write(lines[0])
+				needs_header = False
+			output.writelines(lines[1:])
+	print(f"Merged {len(results)} shards into {output_filename}")
+	return output_filename
+
+def run_local(queue_dir, workers=2, output_path=None, poll_seconds=1):
+	# Runs workers as local processes until the queue is done, then merges into output_path (job's by default)
+	# The genomes are loaded once here and shared with the workers, so memory doesn't grow with the number of workers
+	job = read_job(queue_dir)
+	designer = Designer(job['genbank_ids'], job['genbank_files'], job['genome_fasta_files'], job['email'], job['config'])
+	with SharedGenomes() as shared:
+		shared.add_designer(designer)
+		# the workers split the cores between them, rather than each using all of them
+		cores = max(1, available_cores() // workers)
+		processes = [multiprocessing.Process(target=run_worker, args=(queue_dir, f'local-{i}', poll_seconds, shared.descriptor, cores)) for i in range(workers)]
+		for p in processes:
+			p.start()
+		for p in processes:
+			p.join()
+	return merge_results(queue_dir, output_path or job['output_path'])
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Work on a queue of spacer_gen region shards')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	worker_parser = subparsers.add_parser('worker', help='claim and design shards until the queue is done')
+	worker_parser.add_argument('queue_dir')
+	worker_parser.add_argument('--poll_seconds', type=float, default=10)
+	local_parser = subparsers.add_parser('local', help='run several local worker processes, then merge')
+	local_parser.add_argument('queue_dir')
+	local_parser.add_argument('--workers', type=int, default=2)
+	local_parser.add_argument('--output_path', type=str, default=None)
+	merge_parser = subparsers.add_parser('merge', help='merge finished shards into spacer_gen_output.csv')
+	merge_parser.add_argument('queue_dir')
+	merge_parser.add_argument('output_path', nargs='?', default=None)
+	status_parser = subparsers.add_parser('status', help='count the shards in each state')
+	status_parser.add_argument('queue_dir')
+	args = parser.parse_args(argv)
+
+	if args.command == 'worker':
+		run_worker(args.queue_dir, poll_seconds=args.poll_seconds)
+	elif args.command == 'local':
+		run_local(args.queue_dir, args.workers, args.output_path)
+	elif args.command == 'merge':
+		merge_results(args.queue_dir, args.output_path or read_job(args.queue_dir)['output_path'])
+	else:
+		print(json.dumps(queue_status(args.queue_dir)))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
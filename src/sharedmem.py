@@ -0,0 +1,150 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+from Bio.Seq import Seq, SequenceDataAbstractBaseClass
+
+from kmers import unique_kmer_table
+
+# Genomes shared between worker processes
+# The parent publishes each genome once, its uppercase sequence followed by the reverse complement, into a
+# multiprocessing.shared_memory block, and can add its table of unique spacers (see kmers.unique_kmer_table) and
+# other numpy tables. Workers attach to the blocks by name and read them in place, so a worker's memory doesn't
+# grow with the genomes. The publishing process must close() them once the workers are done
+# Ex. with SharedGenomes() as shared:
+#         shared.add_designer(designer)
+#         # start workers with shared.descriptor, each one calls Designer.attached(descriptor)
+
+class SharedSequenceData(SequenceDataAbstractBaseClass):
+	'''
+	Sequence data for Bio.Seq.Seq read in place from length bytes at start of a shared memory block.
+
+	Reads go through the block's mmap, whose find is as fast as bytes.find, and no memoryview is
+	kept, so the block can always be closed.
+	'''
+
+	__slots__ = ('_mmap', '_start', '_length')
+
+	def __init__(self, block, start, length):
+		self._mmap = block._mmap
+		self._start = start
+		self._length = length
+		super().__init__()
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			(start, end, step) = key.indices(self._length)
+			if step == 1:
+				return self._mmap[self._start + start:self._start + max(start, end)]
+			return self._mmap[self._start:self._start + self._length][key]
+		if key < 0:
+			key += self._length
+		if not 0 <= key < self._length:
+			raise IndexError('sequence index out of range')
+		return self._mmap[self._start + key]
+
+	def find(self, sub, start=None, end=None):
+		(start, end, _) = slice(start, end).indices(self._length)
+		found = self._mmap.find(bytes(sub), self._start + start, self._start + max(start, end))
+		return -1 if found == -1 else found - self._start
+
+	def count(self, sub, start=None, end=None):
+		# Non-overlapping occurrences, as bytes.count. bytes(self).count would copy the whole genome first
+		sub = bytes(sub)
+		if not len(sub):
+			return super().count(sub, start, end)
+		(start, end, _) = slice(start, end).indices(self._length)
+		count = 0
+		found = self.find(sub, start, end)
+		while found != -1:
+			count += 1
+			found = self.find(sub, found + len(sub), end)
+		return count
+
+class SharedGenomes():
+	'''
+	Shared memory blocks holding genomes and numpy tables, owned by the process that publishes them.
+
+	descriptor is a small picklable dict that workers pass to attach().
+	'''
+
+	def __init__(self):
+		self.blocks = []
+		self.descriptor = {'genomes': {}, 'arrays': {}, 'unique_spacers': [], 'designer': None}
+
+	def publish(self, data):
+		block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+		block.buf[:len(data)] = data
+		self.blocks.append(block)
+		return block.name
+
+	def add_genome(self, genome_id, seq, contigs=None):
+		# seq is a Bio.Seq or str, contigs its contig table (see genbank.contig_table)
+		genome = Seq(str(seq).upper())
+		self.descriptor['genomes'][genome_id] = {
+			'block': self.publish(bytes(genome + genome.reverse_complement())),
+			'length': len(genome),
+			'contigs': contigs
+		}
+
+	def add_array(self, name, array):
+		array = np.ascontiguousarray(array)
+		self.descriptor['arrays'][name] = {'block': self.publish(array.tobytes()), 'shape': array.shape, 'dtype': array.dtype.str}
+
+	def add_unique_spacers(self, genome_id, seq, spacer_length):
+		# The spacer_length k-mers found once in seq, which answer most spacer uniqueness checks without scanning it
+		name = f"unique_spacers_{len(self.descriptor['unique_spacers'])}"
+		self.add_array(name, unique_kmer_table(seq, spacer_length))
+		self.descriptor['unique_spacers'].append([genome_id, spacer_length, name])
+
+	def add_designer(self, designer):
+		# Every genome of a Designer session, and what Designer.attached needs to rebuild the session without parsing files
+		for genome_id in designer.genome_sources:
+			if genome_id not in self.descriptor['genomes']:
+				self.add_genome(genome_id, designer.genome_seq(genome_id), designer.contigs(genome_id))
+				if designer.config.SPACER_LENGTH <= 32:
+					self.add_unique_spacers(genome_id, designer.genome_seq(genome_id), designer.config.SPACER_LENGTH)
+		self.descriptor['designer'] = {field: getattr(designer, field) for field in
+									   ['email', 'config', 'genbank_ids', 'genome_fasta_files', 'fasta_index_names', 'genome_input_type',
+										'default_genome_id', 'genome_ids', 'genome_sources']}
+
+	def close(self):
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+# block name -> SharedMemory attached in this process, kept open for the sequences and arrays read from them
+_attached_blocks = {}
+
+def attach_block(name):
+	if name not in _attached_blocks:
+		_attached_blocks[name] = shared_memory.SharedMemory(name=name)
+	return _attached_blocks[name]
+
+def attach_genome(descriptor, genome_id):
+	# (genome, genome + reverse complement) as Seq objects backed by the shared block
+	genome = descriptor['genomes'][genome_id]
+	block = attach_block(genome['block'])
+	return (Seq(SharedSequenceData(block, 0, genome['length'])), Seq(SharedSequenceData(block, 0, 2 * genome['length'])))
+
+def attach_array(descriptor, name):
+	array = descriptor['arrays'][name]
+	block = attach_block(array['block'])
+	return np.ndarray(array['shape'], dtype=np.dtype(array['dtype']), buffer=block.buf)
+
+def attach_unique_spacers(descriptor):
+	# {(genome id, spacer length): unique spacer table} of every shared table
+	return {(genome_id, spacer_length): attach_array(descriptor, name) for (genome_id, spacer_length, name) in descriptor['unique_spacers']}
+
+def attach(descriptor):
+	# {genome id: (genome, genome + reverse complement)} for every shared genome
+	return {genome_id: attach_genome(descriptor, genome_id) for genome_id in descriptor['genomes']}
@@ -27,7 +27,39 @@ email = ''
 # Ex. spacers = {'Target1': 'AAAAATAAAAACAAAAAATAAAACAAAAAGTT', '2ndTarget': 'GGCGATAAAAACATTTAATAAAACAAAAAGTT'}
 spacers = {}
 
+# Format of the detailed off-target report, one of 'text', 'jsonl', 'sqlite'
+# 'text' writes a separate <spacer>_off_target.txt file for each spacer
+# 'jsonl' and 'sqlite' write every hit for every spacer into a single file in output_path
+# (spacer_eval_off_targets.jsonl or spacer_eval_off_targets.sqlite), indexed by spacer name.
+# This is much faster for large spacer libraries, and single spacers can be read back with
+# report.query_offtarget_report
+off_target_report = 'text'
+
+# Every hit is checked for a PAM (PAM_SEQ in 'advanced_parameters.py') next to it on its strand, and the
+# number of hits with and without one is written to spacer_eval_output.csv
+# Change to True to leave the hits without a PAM out of the off-target reports and the other columns
+pam_supported_only = False
+
+# Optional path of a file to write stage-level timings and counters for this run to
+# (wall and CPU time, candidates in/out, reads aligned, bytes written and bowtie2 calls per stage)
+# Paths ending in '.trace.json' are written in the Chrome trace format (open in chrome://tracing
+# or ui.perfetto.dev), any other path gets a plain JSON summary
+# Ex. trace_output = './spacer_eval_trace.json'
+trace_output = ''
+
+
+# Optional directory of genomes (fasta or genbank files, optionally gzipped) to screen the spacers against,
+# e.g. every genome of a genus. When set, genbank_ids and fasta_files are not used, and the number of hits of
+# every spacer in every genome is written to pangenome_hits.csv instead of the off-target reports
+# Indices are built once per directory (and only rebuilt for changed genomes), see 'pangenome.py'
+# Ex. pangenome_dir = './vibrio_genomes'
+pangenome_dir = ''
+
+# Optional overrides of the settings in 'advanced_parameters.py' for this run only
+# Any setting not listed keeps its value from 'advanced_parameters.py'
+# Ex. config = {'mismatch_threshold': 5, 'restriction_enzymes': ['BsaI']}
+config = {}
 
 # Do not modify, this calls the function when run with 'python spacer_eval.py'
 if __name__ == "__main__":
-	spacer_eval({"output_path": output_path, "genbank_ids": genbank_ids, "fasta_files": fasta_files, "email": email, "spacers": spacers})
+	spacer_eval({"output_path": output_path, "genbank_ids": genbank_ids, "fasta_files": fasta_files, "email": email, "spacers": spacers, "off_target_report": off_target_report, "pam_supported_only": pam_supported_only, "pangenome_dir": pangenome_dir, "trace_output": trace_output, "config": config})
@@ -45,18 +45,26 @@ email = ''
 # Genbank file is a path to a local genbank file
 # Must be a FULL genbank file for coding and noncoding modes, containing both the 
 # full genome sequence and the feature definitions
+# Files with several records (chromosomes, plasmids, contigs) and gzipped files (.gb.gz) work too
 # Ex. genbank_file = 'C:\Users\Me\Documents\experiments\integrate2010\genome.gb'
 genbank_files = []
 
 # genome_fasta_file is a path to a local fasta file containing the genome for 
-# spacer generation with custom boundaries
+# spacer generation with custom boundaries. It may hold several records and be gzipped (.fasta.gz)
 # Ex. genome_fasta_file = 'C:\Users\Me\Documents\experiments\integrate2010\genome.fasta'
 genome_fasta_files = []
 
 
-# -------------- REGION TYPES - CODING, NONCODING, OR CUSTOM --------------#
-# region_type must be 'coding', 'noncoding', or 'custom'
+# -------------- REGION TYPES - CODING, NONCODING, CUSTOM, CONSERVED OR GENOME -----#
+# region_type must be 'coding', 'noncoding', 'custom', 'conserved' or 'genome'
 # see the specific additional settings for each below
+# 'genome' designs spacers for every gene (between start_pct and end_pct, as for 'coding') and every
+# intergenic region (as for 'noncoding', nonessential_only applies) of the first genome in one pass,
+# much faster than listing every locus tag. Needs a genbank input
+# 'conserved' finds spacers (with their PAM) that occur exactly once in EVERY genome given above,
+# so one spacer targets the same locus in all strains. If target_locus_tags_csv is set, only spacers
+# within those genes of the first genome are kept. Results, with each genome's coordinate, are written
+# to conserved_spacers.csv. No off-target search is done in this mode, use spacer_eval for that
 region_type = 'custom'
 
 # -------------- CODING REGION SETTINGS -----------------------------------#
@@ -97,6 +105,7 @@ nonessential_only = True
 # The CSV should have 3 columns with headers "genome_id", start_ref" and "end_ref"
 # The "genome_id" should exactly match one of the ids, genbank files, or fasta files
 # used in the matching field above
+# An optional "contig" column gives the coordinates relative to that record of a multi-record genome
 # Ex. custom_regions_csv = './custom_regions.csv'
 custom_regions_csv = ''
 
@@ -107,6 +116,45 @@ custom_regions_csv = ''
 # Ex. custom_sequences = ['CTCTCTCCTACTCTCTCGTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTACTCTCTCTA']
 custom_sequences = []
 
+# Optional path of a file to write stage-level timings and counters for this run to
+# (wall and CPU time, candidates in/out, reads aligned, bytes written and bowtie2 calls per stage)
+# Paths ending in '.trace.json' are written in the Chrome trace format (open in chrome://tracing
+# or ui.perfetto.dev), any other path gets a plain JSON summary
+# Ex. trace_output = './spacer_gen_trace.json'
+trace_output = ''
+
+# Change pipelined = True to work on several regions at once: candidate generation for the next regions
+# runs in separate processes while bowtie2 checks the previous ones. Results and output order are the same
+# Recommended when designing for many regions, see 'pipeline.py'
+pipelined = False
+
+# Optional directory shared by several machines to split this run across them. When set, spacer_gen only
+# splits the regions into shards of shard_size regions and writes them there. Then run
+# 'python shards.py worker <queue_dir>' on each machine, and 'python shards.py merge <queue_dir>'
+# to write spacer_gen_output.csv once all shards are done (or 'python shards.py local <queue_dir>' on one machine)
+# Ex. queue_dir = '/shared/spacer_queue'
+queue_dir = ''
+shard_size = 20
+
+# Optional list of settings to compare in one run. The off-target search is run once at the largest
+# mismatch_threshold and the spacers for every setting are picked from its results, see 'sweep.py'
+# Each setting can set 'mismatch_threshold', 'GC_requirement' and 'homopolymer_length', anything not set
+# comes from 'advanced_parameters.py' (or GC_requirement above)
+# Results are written to spacer_sweep_output.csv instead of spacer_gen_output.csv
+# Ex. sweep_settings = [{'mismatch_threshold': 3}, {'mismatch_threshold': 4}, {'mismatch_threshold': 5, 'GC_requirement': [40, 60]}]
+sweep_settings = []
+
+# Optional spacer catalog to answer from instead of running bowtie2, built once per genome with
+# 'python catalog.py <genbank id or file> --email <email>'. True uses the catalog's default location,
+# or give the path of the catalog file. It must be built with the same advanced parameters as this run
+# Ex. catalog = True
+catalog = ''
+
+# Optional overrides of the settings in 'advanced_parameters.py' for this run only
+# Any setting not listed keeps its value from 'advanced_parameters.py'
+# Ex. config = {'mismatch_threshold': 5, 'restriction_enzymes': ['BsaI']}
+config = {}
+
 # Do not modify, this calls the function when run with 'python spacer_gen.py'
 if __name__ == "__main__":
-	spacer_gen({"output_path": output_path, "genbank_files": genbank_files, "genome_fasta_files": genome_fasta_files, "nonessential_only": nonessential_only, "spacers_per_region": spacers_per_region, "GC_requirement": GC_requirement, "genbank_ids": genbank_ids, "email": email, "region_type": region_type, "overlapping_spacers": overlapping_spacers, "coding_spacer_direction": coding_spacer_direction, "start_pct": start_pct, "end_pct": end_pct, "target_locus_tags_csv": target_locus_tags_csv, "noncoding_boundary": noncoding_boundary, "custom_regions_csv": custom_regions_csv, "custom_sequences": custom_sequences})
+	spacer_gen({"output_path": output_path, "genbank_files": genbank_files, "genome_fasta_files": genome_fasta_files, "nonessential_only": nonessential_only, "spacers_per_region": spacers_per_region, "GC_requirement": GC_requirement, "genbank_ids": genbank_ids, "email": email, "region_type": region_type, "overlapping_spacers": overlapping_spacers, "coding_spacer_direction": coding_spacer_direction, "start_pct": start_pct, "end_pct": end_pct, "target_locus_tags_csv": target_locus_tags_csv, "noncoding_boundary": noncoding_boundary, "custom_regions_csv": custom_regions_csv, "custom_sequences": custom_sequences, "trace_output": trace_output, "pipelined": pipelined, "queue_dir": queue_dir, "shard_size": shard_size, "sweep_settings": sweep_settings, "catalog": catalog, "config": config})
@@ -0,0 +1,160 @@
+import os
+import csv
+import tempfile
+from pathlib import Path
+
+from Bio import SeqIO, SeqUtils
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from simplesam import Reader as samReader
+
+from bowtie import find_offtargets
+from finder import choose_next_offtarget_batch
+from filters import filter_homopolymers
+from instrument import stage
+from pool import CandidatePool
+from risk import read_mismatches
+
+# Parameter sweeps from a single off-target search
+# Candidates are generated with the loosest setting and searched once per genome at the largest mismatch
+# threshold, keeping every hit's exact mismatch count and alignment penalty, then each setting's spacers are
+# picked from those hits. A setting is a dict of any of 'mismatch_threshold', 'GC_requirement' and
+# 'homopolymer_length', the rest comes from the run
+# Ex. results = sweep(designer, regions, sweep_settings(mismatch_thresholds=[3, 4, 5], GC_requirements=[[35, 65]]))
+
+SWEEP_OUTPUT = 'spacer_sweep_output.csv'
+
+def sweep_settings(mismatch_thresholds=[3, 4, 5, 6], GC_requirements=[[35, 65]], homopolymer_lengths=[5]):
+	# Every combination of the given values
+	return [{'mismatch_threshold': m, 'GC_requirement': list(gc), 'homopolymer_length': h}
+			for m in mismatch_thresholds for gc in GC_requirements for h in homopolymer_lengths]
+
+def complete_settings(settings, GC_requirement, config):
+	settings = [dict(s) for s in settings]
+	for s in settings:
+		s.setdefault('mismatch_threshold', config.mismatch_threshold)
+		s.setdefault('GC_requirement', GC_requirement)
+		s.setdefault('homopolymer_length', config.homopolymer_length)
+		s['GC_requirement'] = list(s['GC_requirement'])
+	return settings
+
+def offtarget_hits(genome_id, candidates, config):
+	# One bowtie2 search of every candidate at config.mismatch_threshold
+	# Returns {candidate name: [hit, ...]}, where each hit has its true mismatch count (flexible bases excluded,
+	# None for gapped alignments) and its alignment penalty
+	flex_positions = config.flex_positions()
+	records = []
+	for c in candidates:
+		flexible_seq = str(c['seqrec'].seq.upper())
+		for i in flex_positions:
+			flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
+		records.append(SeqRecord(Seq(flexible_seq), id=c['name'], description=c['name']))
+
+	root_dir = Path(__file__).parent.parent
+	bowtie_genome_dir = os.path.join(root_dir, 'assets', 'bowtie', genome_id)
+	os.makedirs(bowtie_genome_dir, exist_ok=True)
+	(fasta_handle, fasta_name) = tempfile.mkstemp(prefix='sweep_candidates_', suffix='.fasta', dir=bowtie_genome_dir)
+	with os.fdopen(fasta_handle, 'w') as targets_file:
+		SeqIO.write(records, targets_file, 'fasta')
+	output_location = find_offtargets(genome_id, fasta_name, config)
+
+	hits = {}
+	with stage('sam_parsing', genome=genome_id) as counters, open(output_location, 'r') as sam_file:
+		for r in samReader(sam_file):
+			mismatches = read_mismatches(r, config)
+			hits.setdefault(r.safename, []).append({
+				'genome': genome_id,
+				'coordinate': r.coords[0],
+				'mismatches': mismatches,
+				'penalty': -r.tags['AS'],
+				'gapped': mismatches is None
+			})
+		counters['reads_aligned'] = sum([len(h) for h in hits.values()])
+	os.remove(fasta_name)
+	os.remove(output_location)
+	return hits
+
+def hits_within(hits, mismatch_threshold):
+	# The hits a search at mismatch_threshold would have reported: bowtie's minimum score for it is
+	# -(6*mismatch_threshold+1), a mismatch costs 6 and a flexible (N) base nothing, so for ungapped
+	# hits this is the same as mismatches <= mismatch_threshold
+	return [h for h in hits if h['penalty'] <= 6*mismatch_threshold + 1]
+
+def passes_setting(candidate, setting, hits_by_genome):
+	GC_content = SeqUtils.GC(candidate['seqrec'].seq)
+	if GC_content < setting['GC_requirement'][0] or GC_content > setting['GC_requirement'][1]:
+		return False
+	# as in remove_offtarget_matches, the one allowed hit per genome is the target site itself
+	return all([len(hits_within(hits.get(candidate['name'], []), setting['mismatch_threshold'])) <= 1 for hits in hits_by_genome.values()])
+
+def sweep(designer, regions, settings, start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+		  overlapping_spacers='avoid', coding_spacer_direction=None, output_path=None, config=None):
+	# Returns [{'setting': setting, 'regions': [region with its 'candidates' for that setting, ...]}, ...]
+	# If output_path is given, every setting's spacers are also written to spacer_sweep_output.csv there
+	config = designer.config_for(config)
+	settings = complete_settings(settings, GC_requirement, config)
+	loosest_GC = [min([s['GC_requirement'][0] for s in settings]), max([s['GC_requirement'][1] for s in settings])]
+	search_config = config.replace(mismatch_threshold=max([s['mismatch_threshold'] for s in settings]),
+								   homopolymer_length=max([s['homopolymer_length'] for s in settings]))
+
+	with stage('sweep', settings=len(settings), regions=len(regions)) as counters:
+		screened = {}
+		pool = CandidatePool()
+		for region in regions:
+			print(f"Finding gRNA candidates for \"{region['name']}\"")
+			screened[region['name']] = designer.screen_region(region, start_pct, end_pct, loosest_GC, coding_spacer_direction, search_config, pool)
+		all_candidates = [c for candidates in screened.values() for c in candidates]
+		counters['candidates_in'] = len(all_candidates)
+
+		print(f"Searching {len(all_candidates)} candidates for off-targets at up to {search_config.mismatch_threshold} mismatches")
+		hits_by_genome = {genome_id: offtarget_hits(genome_id, all_candidates, search_config) for genome_id in designer.genome_ids}
+
+		results = []
+		for setting in settings:
+			setting_config = config.replace(mismatch_threshold=setting['mismatch_threshold'], homopolymer_length=setting['homopolymer_length'])
+			setting_regions = []
+			for region in regions:
+				candidates = filter_homopolymers(screened[region['name']], config=setting_config)
+				candidates = [c for c in candidates if passes_setting(c, setting, hits_by_genome)]
+				# Same preference for non-overlapping spacers as a normal run
+				chosen = choose_next_offtarget_batch(candidates, [], overlapping_spacers, spacers_per_region, setting_config)
+				setting_regions.append(dict(region, candidates=chosen))
+			print(f"{setting}: {sum([len(r['candidates']) for r in setting_regions])} spacers across {len(regions)} regions")
+			results.append({'setting': setting, 'regions': setting_regions})
+		counters['alignments'] = sum([len(h) for hits in hits_by_genome.values() for h in hits.values()])
+
+	if output_path is not None:
+		make_sweep_output(results, hits_by_genome, os.path.join(output_path, SWEEP_OUTPUT), config)
+	return results
+
+def make_sweep_output(results, hits_by_genome, output_filename, config):
+	fieldnames = ['setting', 'mismatch_threshold', 'GC_min', 'GC_max', 'homopolymer_length', 'spacer_id', 'region',
+				  'sequence', 'genomic_coordinate', 'GC_content', 'PAM', 'strand', 'contig', 'contig_coordinate', 'genome_hits']
+	with stage('output_writing', output='spacer_sweep') as counters, open(output_filename, 'w', newline='') as csv_file:
+		writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+		writer.writeheader()
+		for (setting_index, result) in enumerate(results):
+			setting = result['setting']
+			for region in result['regions']:
+				for (spacer_num, c) in enumerate(region['candidates']):
+					# alignments within this setting's threshold in all genomes, including the target site itself
+					genome_hits = sum([len(hits_within(hits.get(c['name'], []), setting['mismatch_threshold'])) for hits in hits_by_genome.values()])
+					row = {
+						'setting': setting_index,
+						'mismatch_threshold': setting['mismatch_threshold'],
+						'GC_min': setting['GC_requirement'][0],
+						'GC_max': setting['GC_requirement'][1],
+						'homopolymer_length': setting['homopolymer_length'],
+						'spacer_id': spacer_num,
+						'region': region['name'],
+						'sequence': c['seqrec'].seq,
+						'genomic_coordinate': c['location'],
+						'GC_content': SeqUtils.GC(c['seqrec'].seq),
+						'PAM': c.get('pam', '/'.join(config.pams())),
+						'strand': c['name'].split('--')[1][:2],
+						'contig': c.get('contig', ''),
+						'contig_coordinate': c.get('contig_location', c['location']),
+						'genome_hits': genome_hits
+					}
+					counters['bytes_written'] = counters.get('bytes_written', 0) + writer.writerow(row)
+	print(f"Wrote sweep results to {output_filename}")
@@ -0,0 +1,172 @@
+import os
+from bisect import bisect_left, bisect_right
+
+from finder import candidates_for_both_strands, add_fingerprints, get_target_region_for_gene, order_candidates_for_region, choose_next_offtarget_batch
+from filters import filter_re_sites, filter_homopolymers, filter_non_unique_fingerprints
+from kmers import unique_kmer_table, kmers_in_table
+from sweep import offtarget_hits
+from outputs import make_spacer_gen_output
+from instrument import stage
+
+# Whole-genome tiling: spacers for every gene and intergenic region at once, for knockout libraries
+# The genome is scanned and filtered once, candidates are assigned to each region's search window with a sorted
+# index of their locations, fingerprints are checked in one bowtie2 run per genome, and off-targets in rounds that
+# align the next batch of every unfinished region together. Regions get the same candidates, in the same order,
+# as with Designer.design, except within a window of the genome ends
+
+OFFTARGET_BATCH_SIZE = 10
+
+def unique_spacer_filter(candidates, genome, config):
+	# Candidates whose spacer occurs exactly once on both strands of genome
+	if config.SPACER_LENGTH > 32:
+		genome_both_ways = genome + genome.reverse_complement()
+		return [c for c in candidates if genome_both_ways.count(c['seqrec'].seq) == 1]
+	once = unique_kmer_table(genome, config.SPACER_LENGTH)
+	unique = kmers_in_table(once, [c['seqrec'].seq for c in candidates], config.SPACER_LENGTH)
+	return [c for (c, keep) in zip(candidates, unique) if keep]
+
+def window_ranges(start_mark, end_mark, genome_length, pam_length, config):
+	# {'fw': [lowest, highest], 'rv': [lowest, highest]}, the locations of candidates with a PAM of pam_length
+	# that get_candidates_for_region finds for a region's start and end marks
+	spacer_length = config.SPACER_LENGTH
+	search_offset = config.pam_length() + spacer_length + (config.INTEGRATION_SITE_DISTANCE if config.offset else 0)
+	# forward: the PAM and spacer lie within genome[fw_start:fw_end]
+	fw_start = max(0, start_mark - search_offset)
+	fw_end = end_mark - search_offset + config.pam_length() + spacer_length
+	# reverse: the PAM and spacer lie within the reverse complement of genome[rv_start:rv_end]
+	rv_start = start_mark + config.INTEGRATION_SITE_DISTANCE
+	rv_end = min(end_mark + search_offset, genome_length)
+	return {'fw': [fw_start + pam_length + 1, fw_end - spacer_length + 1], 'rv': [rv_start + spacer_length + 1, rv_end + 1 - pam_length]}
+
+def region_window(candidates_in_range, start_mark, end_mark, genome_length, config):
+	# The candidates (of either strand, within the shortest PAM's ranges) that are in a region's windows
+	# with their own PAM, in get_candidates_for_region's order
+	ranges = {}
+	window = {'fw': [], 'rv': []}
+	for c in candidates_in_range:
+		pam_length = len(c['pam'])
+		if pam_length not in ranges:
+			ranges[pam_length] = window_ranges(start_mark, end_mark, genome_length, pam_length, config)
+		strand = c['name'].split('--')[1][:2]
+		if ranges[pam_length][strand][0] <= c['location'] <= ranges[pam_length][strand][1]:
+			window[strand].append(c)
+	return sorted(window['fw'], key=lambda c: c['location']) + sorted(window['rv'], key=lambda c: -c['location'])
+
+class CandidateIndex():
+	'''
+	Genome-wide candidates indexed by location, per strand.
+
+	window() returns the candidates get_candidates_for_region would find for a region, in the
+	same order: forward candidates by increasing location, then reverse ones by decreasing location.
+	'''
+
+	def __init__(self, candidates, genome_length, config):
+		self.config = config
+		self.genome_length = genome_length
+		self.shortest_pam = min([len(p) for p in config.pams()])
+		self.fw = sorted([c for c in candidates if '--fw' in c['name']], key=lambda c: c['location'])
+		self.rv = sorted([c for c in candidates if '--rv' in c['name']], key=lambda c: c['location'])
+		self.fw_locations = [c['location'] for c in self.fw]
+		self.rv_locations = [c['location'] for c in self.rv]
+
+	def strand_range(self, strand, locations, lowest, highest):
+		return strand[bisect_left(locations, lowest):bisect_right(locations, highest)]
+
+	def window(self, start_mark, end_mark):
+		ranges = window_ranges(start_mark, end_mark, self.genome_length, self.shortest_pam, self.config)
+		in_range = self.strand_range(self.fw, self.fw_locations, *ranges['fw']) + self.strand_range(self.rv, self.rv_locations, *ranges['rv'])
+		return region_window(in_range, start_mark, end_mark, self.genome_length, self.config)
+
+def tile_genome(designer, coding_regions=[], noncoding_regions=[], start_pct=10, end_pct=50, spacers_per_region=10, GC_requirement=[35,65],
+				overlapping_spacers='avoid', coding_spacer_direction=None, output_path=None, config=None):
+	# Designs spacers for every region of the designer's default genome in one pass, and returns the regions with their 'candidates'
+	# coding_regions are searched between start_pct and end_pct of the gene, noncoding_regions over their whole length
+	config = designer.config_for(config)
+	regions = list(coding_regions) + list(noncoding_regions)
+	genome_id = designer.default_genome_id
+	genome = designer.genome_seq(genome_id)
+
+	with stage('tiling', regions=len(regions)) as counters:
+		print(f"Scanning the whole genome for candidates for {len(regions)} regions")
+		with stage('candidate_generation', region='genome') as generation_counters:
+			candidates = candidates_for_both_strands(genome, 'genome', GC_requirement, config)
+			generation_counters['candidates_out'] = len(candidates)
+		with stage('filter_unique_spacers', candidates_in=len(candidates)) as unique_counters:
+			candidates = unique_spacer_filter(candidates, genome, config)
+			unique_counters['candidates_out'] = len(candidates)
+		candidates = filter_re_sites(candidates, config)
+		candidates = filter_homopolymers(candidates, config=config)
+		index = CandidateIndex(candidates, len(genome), config)
+
+		region_candidates = []
+		for (number, region) in enumerate(regions):
+			if number < len(coding_regions):
+				[start_mark, end_mark] = get_target_region_for_gene(region, start_pct, end_pct)
+			else:
+				[start_mark, end_mark] = get_target_region_for_gene(region, 0, 100)
+			window = index.window(start_mark, end_mark)
+			if coding_spacer_direction and number < len(coding_regions):
+				window = order_candidates_for_region(window, region, coding_spacer_direction, config)
+			region_candidates.append(window)
+
+		# fingerprints only for the candidates some region uses
+		in_regions = list({c['name']: c for window in region_candidates for c in window}.values())
+		add_fingerprints(in_regions, genome, config)
+		for fingerprint_genome in designer.genome_ids:
+			in_regions = filter_non_unique_fingerprints(in_regions, fingerprint_genome)
+		fingerprint_unique = set([c['name'] for c in in_regions])
+		region_candidates = [[c for c in window if c['name'] in fingerprint_unique] for window in region_candidates]
+		print(f"{len(in_regions)} candidates in {len(regions)} regions remain after filtering for re_sites, homopolymers, and non unique fingerprints")
+
+		chosen = search_offtargets(designer, region_candidates, spacers_per_region, overlapping_spacers, config)
+		for (region, spacers) in zip(regions, chosen):
+			region['genome_id'] = region.get('genome_id', genome_id)
+			region['candidates'] = designer.locate_candidates(region, spacers[:spacers_per_region])
+		counters['regions_done'] = len(regions)
+
+	if output_path is not None:
+		for region in regions:
+			make_spacer_gen_output(region, os.path.join(output_path, 'spacer_gen_output.csv'), config)
+	print(f"Identified {sum([len(r['candidates']) for r in regions])} spacers for {len(regions)} regions")
+	return regions
+
+def search_offtargets(designer, region_candidates, spacers_per_region, overlapping_spacers, config):
+	# Off-target searches for every region at once, in rounds. Returns the spacers without off-targets of each region
+	def align(candidates):
+		hits_by_genome = [offtarget_hits(genome_id, candidates, config) for genome_id in designer.genome_ids]
+		# as in remove_offtarget_matches, the one allowed hit per genome is the target site itself
+		return {c['name']: all([len(hits.get(c['name'], [])) <= 1 for hits in hits_by_genome]) for c in candidates}
+	return pick_spacers(region_candidates, spacers_per_region, overlapping_spacers, align, config)
+
+def pick_spacers(region_candidates, spacers_per_region, overlapping_spacers, verdicts_for, config):
+	# Picks each region's spacers in the order remove_offtarget_matches tests them, in rounds over all regions
+	# verdicts_for(candidates) returns {candidate name: True if it has no off-targets}, once per round
+	untested = [list(candidates) for candidates in region_candidates]
+	passed = [[] for _ in region_candidates]
+	verdicts = {}
+	rounds = 0
+	with stage('remove_offtarget_matches', genome='all', candidates_in=sum([len(c) for c in region_candidates])) as counters:
+		while True:
+			batches = {}
+			for (number, remaining) in enumerate(untested):
+				if len(passed[number]) < spacers_per_region and len(remaining):
+					batches[number] = choose_next_offtarget_batch(remaining, passed[number], overlapping_spacers, OFFTARGET_BATCH_SIZE, config)
+			if not len(batches):
+				break
+
+			# a candidate's verdict is reused by every region it is in
+			unknown = list({c['name']: c for batch in batches.values() for c in batch if c['name'] not in verdicts}.values())
+			if len(unknown):
+				rounds += 1
+				print(f"Off-target round {rounds}: {len(unknown)} candidates for {len(batches)} regions")
+				verdicts.update(verdicts_for(unknown))
+
+			for (number, batch) in batches.items():
+				for c in batch:
+					if verdicts[c['name']]:
+						passed[number].append(c)
+					untested[number].remove(c)
+		counters['alignments'] = len(verdicts)
+		counters['rounds'] = rounds
+		counters['candidates_out'] = sum([len(p) for p in passed])
+	return passed
@@ -2,7 +2,9 @@ import random
 import time
 import csv
 import os
+import tempfile
 from pathlib import Path
+import numpy as np
 from simplesam import Reader as samReader
 from Bio import SeqIO
 from Bio.Seq import Seq
@@ -11,7 +13,8 @@ from Bio.SeqRecord import SeqRecord
 from filters import filter_homopolymers, filter_re_sites
 from bowtie import find_offtargets
 from genbank import retrieve_annotation
-from advanced_parameters import SPACER_LENGTH, flex_spacing
+from kmers import build_kmer_index, pack_kmers, in_kmer_index, decode_codes
+from config import DEFAULT_CONFIG
 
 barcode_length = 12
 min_hamming_distance = 4
@@ -20,90 +23,291 @@ def hamming_dist(s1, s2):
     assert len(s1) == len(s2)
     return sum(ch1 != ch2 for ch1, ch2 in zip(s1, s2))
 
-def remove_offtargets(spacers, genbank_id):
+def remove_offtargets(spacers, genbank_id, config=DEFAULT_CONFIG):
 	flex_seqs = []
 	for (index, spacer) in enumerate(spacers):
 		flexible_seq = spacer["seqrec"].seq[:]
-		for i in range(flex_spacing-1, SPACER_LENGTH, flex_spacing):
+		for i in config.flex_positions():
 			flexible_seq = flexible_seq[:i] + 'N' + flexible_seq[i+1:]
 		spacer_record = SeqRecord(flexible_seq, id=f'spacer_{index+1}', description=genbank_id)  # use 'description' to store ref_genome info
 		flex_seqs.append(spacer_record)
 
-	fasta_name = 'offtarget-check.fasta'
 	root_dir = Path(__file__).parent.parent
-	fasta_name = os.path.join(root_dir, 'assets', fasta_name)
-	with open(fasta_name, 'w') as targets_file:
+	bowtie_genome_dir = os.path.join(root_dir, 'assets', 'bowtie', genbank_id)
+	os.makedirs(bowtie_genome_dir, exist_ok=True)
+	# unique file names, so screens against several genomes or in several processes don't collide
+	(fasta_handle, fasta_name) = tempfile.mkstemp(prefix='offtarget_check_', suffix='.fasta', dir=bowtie_genome_dir)
+	with os.fdopen(fasta_handle, 'w') as targets_file:
 		SeqIO.write(flex_seqs, targets_file, 'fasta')
 
-	output_location = find_offtargets(genbank_id, fasta_name)
+	output_location = find_offtargets(genbank_id, fasta_name, config)
 
-	filtered_spacers = []
-	sam_reads = []
 	with open(output_location, 'r') as sam_file:
 		reader = samReader(sam_file)
-		sam_reads = [r for r in reader]
+		mapped_names = set([r.safename for r in reader if r.mapped])
 
-	for i, s in enumerate(spacers):
-		reads = [r for r in sam_reads if r.safename == f'spacer_{i+1}']
-		reads = [r for r in reads if r.mapped]
-		if len(reads) == 0:
-			filtered_spacers.append(s)
+	filtered_spacers = [s for (i, s) in enumerate(spacers) if f'spacer_{i+1}' not in mapped_names]
 	os.remove(fasta_name)
 	os.remove(output_location)
 	return filtered_spacers
 
-def make_barcodes():
-	barcodes = []
-	start = time.perf_counter()
-	i = 0
-	while len(barcodes) < 35000:
-		if i % 5000 == 0:
-			print(f"{len(barcodes)} barcodes created out of {i} potential sequences. {round(time.perf_counter() - start, 2)} seconds")
-		i+=1
-		potential = ''.join(random.choices('ATGC', k=barcode_length))
-		can_obj = {' seq': SeqRecord(Seq(potential))}
-		if len(filter_homopolymers([can_obj], G_only=False)) != 1:
-			continue
-		if len(filter_re_sites([can_obj])) != 1:
+BASE_BITS = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+BITS_BASE = 'ACGT'
+# popcount of every byte value, for numpy versions without np.bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def pack_barcode(seq):
+	# Pack a sequence into an int, 2 bits per base with the first base in the highest bits
+	packed = 0
+	for base in seq:
+		packed = (packed << 2) | BASE_BITS[base]
+	return packed
+
+def unpack_barcode(packed, length):
+	packed = int(packed)
+	return ''.join(BITS_BASE[(packed >> (2*(length-1-i))) & 3] for i in range(length))
+
+def popcount(x):
+	if hasattr(np, 'bitwise_count'):
+		return np.bitwise_count(x)
+	x = np.ascontiguousarray(x, dtype=np.uint64)
+	return POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+def packed_hamming_dists(a, b, low_bits):
+	# Bit-parallel Hamming distances between packed sequences (numpy uint64 arrays).
+	# A base differs if either of its 2 bits differ, so fold the high bit of each base onto
+	# the low bit and count the low bits that are set. low_bits is 0b0101...01, one bit per base
+	x = a ^ b
+	return popcount((x | (x >> np.uint64(1))) & low_bits)
+
+def packed_has_homopolymer(packed, length, run_length):
+	# True for packed sequences that contain run_length identical consecutive bases.
+	# Compare every base with its neighbour, then look for run_length-1 neighbouring matches in a row
+	pair_bits = np.uint64(int('01'*(length-1), 2))
+	x = packed ^ (packed >> np.uint64(2))
+	same = ~(x | (x >> np.uint64(1))) & pair_bits
+	run = same
+	for k in range(1, run_length-1):
+		run = run & (same >> np.uint64(2*k))
+	return run != 0
+
+def barcode_segments(length, min_distance):
+	# Split the barcode into min_distance segments of (nearly) equal size, as [shift, mask] pairs.
+	# Two barcodes closer than min_distance differ in at most min_distance-1 segments, so by the
+	# pigeonhole principle they must share at least one segment exactly
+	segments = []
+	end = length
+	for i in range(min_distance):
+		size = length // min_distance + (1 if i < length % min_distance else 0)
+		segments.append([np.uint64(2*(length-end)), np.uint64((1 << (2*size)) - 1)])
+		end -= size
+	return segments
+
+def too_close_to_existing(potentials, existing, segments, min_distance, low_bits):
+	# Marks potentials within min_distance of any existing barcode. Only pairs that share
+	# a segment are compared, found by a sorted join on each segment's value
+	too_close = np.zeros(len(potentials), dtype=bool)
+	if not len(existing) or not len(potentials):
+		return too_close
+	for [shift, mask] in segments:
+		existing_keys = (existing >> shift) & mask
+		order = np.argsort(existing_keys, kind='stable')
+		existing_keys = existing_keys[order]
+		keys = (potentials >> shift) & mask
+		lo = np.searchsorted(existing_keys, keys, side='left')
+		hi = np.searchsorted(existing_keys, keys, side='right')
+		counts = hi - lo
+		if not counts.sum():
 			continue
-		if potential in barcodes:
+		# expand to every (potential, existing barcode) pair sharing this segment
+		potential_index = np.repeat(np.arange(len(potentials)), counts)
+		pair_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		existing_index = order[np.repeat(lo, counts) + pair_offsets]
+		dists = packed_hamming_dists(potentials[potential_index], existing[existing_index], low_bits)
+		too_close[potential_index[dists < min_distance]] = True
+	return too_close
+
+# GF(4) arithmetic, with the bases as its elements (A=0, C=1, G=2, T=3): addition is XOR, GF4_MUL[a, b] is a*b
+GF4_MUL = np.array([[0, 0, 0, 0], [0, 1, 2, 3], [0, 2, 3, 1], [0, 3, 1, 2]], dtype=np.uint8)
+GF4_INV = np.array([0, 1, 3, 2], dtype=np.uint8)
+
+def ovoid_points():
+	# The 17 points of the elliptic quadric x0^2 + x0*x1 + 2*x1^2 + x2*x3 = 0 in PG(3, 4). No 3 of them lie on a line,
+	# so as the columns of a parity check matrix any 3 columns are independent and the code has minimum distance 4
+	points = []
+	for x in np.ndindex(4, 4, 4, 4):
+		if [v for v in x if v][:1] != [1]:
+			continue  # one representative per projective point, the one whose first nonzero coordinate is 1
+		if GF4_MUL[x[0], x[0]] ^ GF4_MUL[x[0], x[1]] ^ GF4_MUL[2, GF4_MUL[x[1], x[1]]] ^ GF4_MUL[x[2], x[3]] == 0:
+			points.append(x)
+	return np.array(points, dtype=np.uint8)
+
+def reduce_parity_checks(H):
+	# Row reduces H over GF(4). Returns [pivot columns, free columns, R], where every codeword x has
+	# x[pivots[i]] = sum over f of R[i, f] * x[free[f]]
+	H = H.copy()
+	pivots = []
+	for column in range(H.shape[1]):
+		rows = [r for r in range(len(pivots), H.shape[0]) if H[r, column]]
+		if not len(rows):
 			continue
-		for crosscheck in barcodes:
-			if hamming_dist(potential, crosscheck) < min_hamming_distance:
+		row = len(pivots)
+		H[[row, rows[0]]] = H[[rows[0], row]]
+		H[row] = GF4_MUL[GF4_INV[H[row, column]], H[row]]
+		for other in range(H.shape[0]):
+			if other != row and H[other, column]:
+				H[other] ^= GF4_MUL[H[other, column], H[row]]
+		pivots.append(column)
+	free = [c for c in range(H.shape[1]) if c not in pivots]
+	return [pivots, free, H[:len(pivots)][:, free]]
+
+def code_barcodes(number, length, rng, batch_size=20000, config=DEFAULT_CONFIG):
+	# Up to number packed barcodes, every two at least 4 bases apart: the codewords of the linear code over GF(4) whose
+	# parity checks are length points of an ovoid, 4^(length-4) of them (more below length 6), shifted by a random word (which keeps the distances)
+	# and taken in random order. Codewords with homopolymers or restriction sites are left out
+	[pivots, free, R] = reduce_parity_checks(ovoid_points()[:length].T)
+	total = 4**len(free)
+	# every codeword, or as many distinct random ones as will be needed where there are too many to list
+	messages = np.arange(total, dtype=np.uint64) if total <= 2**22 else np.unique(rng.integers(0, total, size=2*number, dtype=np.uint64))
+	messages = rng.permutation(messages)
+	codes = np.zeros((len(messages), length), dtype=np.uint8)
+	for (i, column) in enumerate(free):
+		codes[:, column] = (messages >> np.uint64(2*i)) & np.uint64(3)
+	for (i, column) in enumerate(pivots):
+		for (f, free_column) in enumerate(free):
+			codes[:, column] ^= GF4_MUL[R[i, f], codes[:, free_column]]
+	codes ^= rng.integers(0, 4, size=length, dtype=np.uint8)
+
+	packed = np.zeros(len(codes), dtype=np.uint64)
+	for i in range(length):
+		packed = (packed << np.uint64(2)) | codes[:, i].astype(np.uint64)
+	packed = packed[~packed_has_homopolymer(packed, length, config.homopolymer_length)]
+	if len(config.restriction_enzymes):
+		kept = []
+		for start in range(0, len(packed), batch_size):
+			can_objs = [{'seqrec': SeqRecord(Seq(unpack_barcode(p, length))), 'packed': p} for p in packed[start:start+batch_size]]
+			kept += [c['packed'] for c in filter_re_sites(can_objs, config)]
+			if len(kept) >= number:
+				break
+		packed = np.array(kept, dtype=np.uint64)
+	return packed[:number]
+
+def random_barcodes(number, length, min_distance, rng, batch_size=20000, config=DEFAULT_CONFIG):
+	# Up to number packed barcodes, every two at least min_distance bases apart, by accepting random sequences that are
+	# far enough from every barcode so far. Stops early once the barcode space is nearly exhausted
+	low_bits = np.uint64(int('01'*length, 2))
+	segments = barcode_segments(length, min_distance)
+
+	barcodes = np.zeros(0, dtype=np.uint64)
+	start = time.perf_counter()
+	attempts = 0
+	while len(barcodes) < number:
+		attempts += batch_size
+		potentials = rng.permutation(np.unique(rng.integers(0, 4**length, size=batch_size, dtype=np.uint64)))
+		potentials = potentials[~packed_has_homopolymer(potentials, length, config.homopolymer_length)]
+		potentials = potentials[~np.isin(potentials, barcodes)]
+		potentials = potentials[~too_close_to_existing(potentials, barcodes, segments, min_distance, low_bits)]
+		if len(config.restriction_enzymes):
+			can_objs = [{'seqrec': SeqRecord(Seq(unpack_barcode(p, length))), 'packed': p} for p in potentials]
+			potentials = np.array([c['packed'] for c in filter_re_sites(can_objs, config)], dtype=np.uint64)
+
+		# The remaining potentials are far enough from earlier barcodes, but not yet from each other
+		accepted = []
+		for p in potentials:
+			if len(accepted) and (packed_hamming_dists(p, np.array(accepted, dtype=np.uint64), low_bits) < min_distance).any():
 				continue
+			accepted.append(p)
+			if len(barcodes) + len(accepted) >= number:
+				break
+		barcodes = np.concatenate([barcodes, np.array(accepted, dtype=np.uint64)])
+
+		elapsed = time.perf_counter() - start
+		print(f"{len(barcodes)} barcodes created out of {attempts} potential sequences. {round(elapsed, 2)} seconds ({round(len(barcodes)/max(elapsed, 1e-9))} barcodes/second)")
+		# Random barcodes get rarer as the space fills up, stop once almost nothing new is found
+		if len(barcodes) < number and len(accepted) < max(1, batch_size // 1000):
+			break
+	return barcodes
+
+def make_barcodes(number=35000, length=barcode_length, min_distance=min_hamming_distance, output_file='barcodes_output.csv', batch_size=20000, config=DEFAULT_CONFIG):
+	# number barcodes of length bases, every two at least min_distance bases apart, without homopolymers or restriction sites
+	# At distance 4 (and lengths 5 to 17) they are drawn from a code with 4^(length-4) barcodes, 65536 at length 12, see
+	# code_barcodes. Other distances accept random sequences, which finds far fewer before the space is exhausted
+	# Raises an Exception if number barcodes can't be made
+	if length > 31 or min_distance > length:
+		print("Barcodes must be at most 31bp, and min_distance cannot be larger than the barcode length")
+		return []
+	rng = np.random.default_rng()
+	start = time.perf_counter()
+	if min_distance == 4 and 4 < length <= 17:
+		barcodes = code_barcodes(number, length, rng, batch_size, config)
+		print(f"{len(barcodes)} barcodes created from a distance 4 code. {round(time.perf_counter() - start, 2)} seconds")
+	else:
+		barcodes = random_barcodes(number, length, min_distance, rng, batch_size, config)
+	if len(barcodes) < number:
+		raise Exception(f"Only {len(barcodes)} barcodes of length {length} at least {min_distance} apart could be made, {number} were asked for. "
+						"Use longer barcodes, a smaller min_distance or ask for fewer")
 
-		barcodes.append(potential)
+	barcodes = [unpack_barcode(b, length) for b in barcodes]
 	print("done generating, writing to csv")
-	with open('barcodes_output.csv', 'w', newline='') as csvf:
+	with open(output_file, 'w', newline='') as csvf:
 		writer = csv.writer(csvf)
 		writer.writerow(['id', 'barcode_sequence'])
 		for (index, bc) in enumerate(barcodes):
 			writer.writerow([index+1, bc])
 	print("DONE")
+	return barcodes
 
 
-def make_nontargeting(genbank_id, number=100):
-	genome = retrieve_annotation(genbank_id, 'acreechristopher@gmail.com')
+def random_spacer_batch(rng, batch_size, GC_requirement, config=DEFAULT_CONFIG):
+	# Random spacers as a (batch_size, SPACER_LENGTH) array of base codes, pre-screened in bulk
+	# for GC content and homopolymers of any base
+	codes = rng.integers(0, 4, size=(batch_size, config.SPACER_LENGTH), dtype=np.uint8)
+	gc_pct = 100 * ((codes == 1) | (codes == 2)).sum(axis=1) / config.SPACER_LENGTH
+	keep = (gc_pct >= GC_requirement[0]) & (gc_pct <= GC_requirement[1])
+	# a homopolymer is homopolymer_length-1 neighbouring bases in a row that are equal
+	same = codes[:, 1:] == codes[:, :-1]
+	run = same[:, :same.shape[1]-config.homopolymer_length+2].copy()
+	for k in range(1, config.homopolymer_length-1):
+		run &= same[:, k:k+run.shape[1]]
+	keep &= ~run.any(axis=1)
+	return codes[keep]
 
+def make_nontargeting(genbank_ids, number=100, email='', GC_requirement=[0,100], prescreen_k=16, batch_size=5000, output_file='NT_spacers.csv', config=DEFAULT_CONFIG):
+	# Screens against every genome in genbank_ids, a single id is also accepted
+	if type(genbank_ids) is str:
+		genbank_ids = [genbank_ids]
+	genomes = [retrieve_annotation(genbank_id, email) for genbank_id in genbank_ids]
+
+	# Any spacer sharing a prescreen_k-mer with a genome (either strand) has a close genomic match,
+	# so reject those before spending a bowtie search on them
+	print(f"Building {prescreen_k}-mer index for {len(genbank_ids)} genome(s)")
+	genome_index = build_kmer_index([g.seq for g in genomes], prescreen_k)
+
+	rng = np.random.default_rng()
+	start = time.perf_counter()
+	generated = 0
 	nt_spacers = []
 	while len(nt_spacers) < number:
-		needed = number - len(nt_spacers)
-		potentials = []
-		while len(potentials) < needed:
-			seq = ''.join(random.choices('ATGC', k=SPACER_LENGTH))
-			potential = {'seqrec': SeqRecord(Seq(seq), id=seq)}
-			if len(filter_homopolymers([potential], G_only=False)) != 1:
-				continue
-			if len(filter_re_sites([potential])) != 1:
-				continue
-			potentials.append(potential)
+		codes = random_spacer_batch(rng, batch_size, GC_requirement, config)
+		generated += batch_size
+		[kmers, valid] = pack_kmers(codes, prescreen_k)
+		codes = codes[~in_kmer_index(genome_index, kmers).any(axis=1)]
+		potentials = [{'seqrec': SeqRecord(Seq(decode_codes(c)), id=decode_codes(c))} for c in codes]
+		potentials = filter_re_sites(potentials, config)
+		# only screen as many as are likely needed, bowtie is the slow step
+		potentials = potentials[:max(2*(number - len(nt_spacers)), 10)]
+
 		print(f"Screening {len(potentials)} potentials")
-		potentials = remove_offtargets(potentials, genbank_id)
-		nt_spacers += potentials
-		print(f"{len(potentials)} potentials passed a screening round, now have {len(nt_spacers)} total")
+		for genbank_id in genbank_ids:
+			potentials = remove_offtargets(potentials, genbank_id, config)
+		nt_spacers += potentials[:number - len(nt_spacers)]
+		elapsed = time.perf_counter() - start
+		print(f"{len(potentials)} potentials passed a screening round, now have {len(nt_spacers)} total. "
+			  f"{generated} random spacers generated in {round(elapsed, 2)} seconds ({round(len(nt_spacers)/max(elapsed, 1e-9), 1)} spacers/second)")
 
-	with open('NT_spacers.csv', 'w', newline='') as csvf:
+	with open(output_file, 'w', newline='') as csvf:
 		writer = csv.writer(csvf)
-		writer.writerow('spacer_seq')
+		writer.writerow(['spacer_seq'])
 		for nt in nt_spacers:
 			writer.writerow([nt['seqrec'].seq.upper()])
+	return [str(nt['seqrec'].seq) for nt in nt_spacers]
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules in src are imported by name, as the scripts in src and test do
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
@@ -0,0 +1,85 @@
+import csv
+
+import numpy as np
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from utils import (make_barcodes, code_barcodes, random_barcodes, ovoid_points, reduce_parity_checks, pack_barcode, unpack_barcode,
+				   packed_hamming_dists, too_close_to_existing, barcode_segments, hamming_dist, GF4_MUL)
+from filters import filter_re_sites
+from config import Config
+
+def assert_min_distance(packed, length, min_distance):
+	# Every pair of packed barcodes is at least min_distance apart: small sets pair by pair, larger ones by halves,
+	# with the pairs across the halves found by too_close_to_existing
+	low_bits = np.uint64(int('01'*length, 2))
+	if len(packed) <= 1000:
+		dists = packed_hamming_dists(packed[:, None], packed[None, :], low_bits)
+		np.fill_diagonal(dists, min_distance)
+		assert dists.min() >= min_distance
+		return
+	half = len(packed) // 2
+	assert not too_close_to_existing(packed[:half], packed[half:], barcode_segments(length, min_distance), min_distance, low_bits).any()
+	assert_min_distance(packed[:half], length, min_distance)
+	assert_min_distance(packed[half:], length, min_distance)
+
+def test_packing_round_trip_and_distances():
+	rng = np.random.default_rng(1)
+	seqs = [''.join(rng.choice(list('ACGT'), 12)) for _ in range(200)]
+	packed = np.array([pack_barcode(s) for s in seqs], dtype=np.uint64)
+	assert [unpack_barcode(p, 12) for p in packed] == seqs
+	dists = packed_hamming_dists(packed[:, None], packed[None, :], np.uint64(int('01'*12, 2)))
+	assert dists.tolist() == [[hamming_dist(a, b) for b in seqs] for a in seqs]
+
+def test_no_three_ovoid_points_are_dependent():
+	# any 3 columns of the parity checks independent is what makes the code's minimum distance 4
+	points = ovoid_points()
+	assert len(points) == 17
+	for i in range(17):
+		for j in range(i + 1, 17):
+			for (a, b) in np.ndindex(4, 4):
+				combination = GF4_MUL[a, points[i]] ^ GF4_MUL[b, points[j]]
+				assert not any([(combination == point).all() for (k, point) in enumerate(points) if k not in (i, j)])
+
+def test_reduced_parity_checks_give_codewords():
+	H = ovoid_points()[:12].T
+	[pivots, free, R] = reduce_parity_checks(H)
+	assert len(pivots) == 4 and len(free) == 8
+	codes = np.array([[int(c) for c in np.base_repr(n, 4).zfill(12)] for n in range(0, 4**12, 4**12 // 50)], dtype=np.uint8)
+	for x in codes:
+		for (i, column) in enumerate(pivots):
+			x[column] = np.bitwise_xor.reduce(GF4_MUL[R[i], x[free]])
+		assert not np.bitwise_xor.reduce(GF4_MUL[H, x], axis=1).any()
+
+def test_the_default_request_is_met(tmp_path):
+	output_file = str(tmp_path / 'barcodes.csv')
+	barcodes = make_barcodes(output_file=output_file)
+	assert len(barcodes) == 35000 and len(set(barcodes)) == 35000
+	assert all([len(b) == 12 and 'AAAAA' not in b and 'CCCCC' not in b and 'GGGGG' not in b and 'TTTTT' not in b for b in barcodes])
+	assert_min_distance(np.array([pack_barcode(b) for b in barcodes], dtype=np.uint64), 12, 4)
+	with open(output_file, 'r') as f:
+		assert [row['barcode_sequence'] for row in csv.DictReader(f)] == barcodes
+
+def test_every_codeword_of_a_short_code():
+	packed = code_barcodes(10**6, 8, np.random.default_rng(2), config=Config(homopolymer_length=9))
+	assert len(packed) == 4**4
+	assert_min_distance(packed, 8, 4)
+
+def test_restriction_sites_are_left_out(tmp_path):
+	config = Config(restriction_enzymes=('BsaI', 'EcoRI'))
+	barcodes = make_barcodes(3000, output_file=str(tmp_path / 'barcodes.csv'), config=config)
+	assert len(barcodes) == 3000
+	assert len(filter_re_sites([{'seqrec': SeqRecord(Seq(b))} for b in barcodes], config)) == 3000
+	assert not any(['GAATTC' in b for b in barcodes])
+
+def test_random_barcodes_for_other_distances():
+	packed = random_barcodes(150, 10, 5, np.random.default_rng(3))
+	assert len(packed) == 150
+	assert_min_distance(packed, 10, 5)
+
+def test_an_unreachable_request_raises(tmp_path):
+	with pytest.raises(Exception, match='could be made'):
+		make_barcodes(5000, length=8, min_distance=5, output_file=str(tmp_path / 'barcodes.csv'))
+	with pytest.raises(Exception, match='could be made'):
+		make_barcodes(70000, output_file=str(tmp_path / 'barcodes.csv'))
@@ -0,0 +1,28 @@
+import tracemalloc
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio import SeqIO
+
+from benchmark import measure
+from genbank import load_genome_file, loaded_genome_paths, unload_genome_file
+
+def test_stages_are_timed_without_tracemalloc():
+	tracing = []
+	def stage_func():
+		tracing.append(tracemalloc.is_tracing())
+		return bytearray(1000000)
+	[result, value] = measure('allocate', 1000, stage_func, repeat=3)
+	# 3 timed runs, then one to measure memory in
+	assert tracing == [False, False, False, True]
+	assert not tracemalloc.is_tracing()
+	assert result['peak_memory'] >= 1000000
+	assert len(value) == 1000000
+
+def test_unload_genome_file(tmp_path):
+	path = tmp_path / 'genome.fasta'
+	SeqIO.write([SeqRecord(Seq('ACGT' * 10), id='genome', description='')], path, 'fasta')
+	load_genome_file(path, 'fasta')
+	assert str(path.absolute()) in loaded_genome_paths()
+	unload_genome_file(path)
+	assert str(path.absolute()) not in loaded_genome_paths()
@@ -0,0 +1,68 @@
+import json
+import random
+import sqlite3
+
+from Bio.Seq import Seq
+
+from catalog import SpacerCatalog, catalog_settings
+from finder import candidates_for_both_strands, get_candidates_for_region
+from config import Config
+
+def random_genome(length, seed):
+	rng = random.Random(seed)
+	return Seq(''.join([rng.choice('ACGT') for _ in range(length)]))
+
+def write_catalog(path, genome, config):
+	# A catalog as build_catalog writes it, of every candidate of genome, without the off-target search
+	db = sqlite3.connect(path)
+	db.execute('CREATE TABLE settings (key TEXT, value TEXT)')
+	db.execute('CREATE TABLE spacers (name TEXT, strand TEXT, location INTEGER, sequence TEXT, pam TEXT, GC_content REAL, offtarget_hits INTEGER)')
+	settings = {'genome_id': 'genome', 'genome_ids': ['genome'], 'genome_length': len(genome), 'config': catalog_settings(config)}
+	db.executemany('INSERT INTO settings VALUES (?,?)', [(key, json.dumps(value)) for (key, value) in settings.items()])
+	rows = []
+	for c in candidates_for_both_strands(genome, 'genome', [0, 100], config):
+		seq = str(c['seqrec'].seq)
+		rows.append((c['name'], c['name'].split('--')[1][:2], c['location'], seq, c['pam'], 100 * (seq.count('G') + seq.count('C')) / len(seq), 1))
+	db.executemany('INSERT INTO spacers VALUES (?,?,?,?,?,?,?)', rows)
+	db.execute('CREATE INDEX spacers_by_location ON spacers (strand, location)')
+	db.commit()
+	db.close()
+	return path
+
+def summary(candidates):
+	return [(c['name'].split('--')[1][:2], c['location'], str(c['seqrec'].seq), c['pam']) for c in candidates]
+
+def genome_spacer(genome, strand, location, length):
+	# The spacer a catalogued candidate's location stands for
+	if strand == 'fw':
+		return str(genome[location - 1:location - 1 + length])
+	return str(genome[location - 1 - length:location - 1].reverse_complement())
+
+def test_windows_match_get_candidates_for_region(tmp_path):
+	genome = random_genome(20000, 2)
+	for (index, config) in enumerate([Config(), Config(PAM_SEQ=('CC', 'CNG')), Config(PAM_SEQ='CN', INTEGRATION_SITE_DISTANCE=60)]):
+		catalog = SpacerCatalog(write_catalog(str(tmp_path / f'catalog_{index}.sqlite'), genome, config))
+		for (start_mark, end_mark) in [(1000, 1500), (4000, 4700), (9000, 9010), (15000, 15040)]:
+			for GC_requirement in [[0, 100], [35, 65]]:
+				expected = get_candidates_for_region(genome, start_mark, end_mark, 'region', GC_requirement, config=config)
+				assert summary(catalog.window(start_mark, end_mark, GC_requirement, config)) == summary(expected)
+		catalog.close()
+
+def test_windows_at_the_genome_ends(tmp_path):
+	genome = random_genome(5000, 3)
+	config = Config(PAM_SEQ=('CC', 'CNG'))
+	catalog = SpacerCatalog(write_catalog(str(tmp_path / 'catalog.sqlite'), genome, config))
+	for (start_mark, end_mark) in [(0, 300), (10, 40), (4700, 5000), (4990, 5000)]:
+		window = catalog.window(start_mark, end_mark, [0, 100], config)
+		assert len(window)
+		for (strand, location, seq, pam) in summary(window):
+			assert genome_spacer(genome, strand, location, config.SPACER_LENGTH) == seq
+	catalog.close()
+
+def test_missing_catalog(tmp_path):
+	try:
+		SpacerCatalog(str(tmp_path / 'missing.sqlite'))
+	except Exception as e:
+		assert 'No spacer catalog' in str(e)
+		return
+	raise AssertionError('a missing catalog was opened')
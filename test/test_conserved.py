@@ -0,0 +1,57 @@
+import random
+from collections import Counter
+
+from Bio.Seq import Seq
+
+from conserved import find_conserved_spacers
+from pams import matching_pam
+from config import Config
+
+def strain_genomes(rng):
+	# Three strains sharing four 600bp blocks, in another order and orientation in the second strain, which also
+	# repeats part of one block, and with a point mutation in one block of the third
+	random_seq = lambda length: ''.join([rng.choice('ACGT') for _ in range(length)])
+	rc = lambda seq: str(Seq(seq).reverse_complement())
+	[a, b, c, d] = [random_seq(600) for _ in range(4)]
+	mutated_d = d[:300] + {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}[d[300]] + d[301:]
+	return {
+		'strain_1': a + random_seq(300) + b + random_seq(300) + c + random_seq(300) + d,
+		'strain_2': random_seq(300) + b + random_seq(300) + rc(a) + random_seq(300) + c + random_seq(100) + c[:200] + random_seq(300) + d,
+		'strain_3': a + random_seq(300) + b + random_seq(300) + c + random_seq(300) + mutated_d
+	}
+
+def unique_pam_spacers(genome, config):
+	# The spacers after a PAM on either strand of genome that occur once on both strands, by brute force
+	length = config.SPACER_LENGTH
+	strands = [genome, str(Seq(genome).reverse_complement())]
+	counts = Counter([s[i:i + length] for s in strands for i in range(len(s) - length + 1)])
+	return set([s[i:i + length] for s in strands for i in range(len(s) - length + 1)
+				if counts[s[i:i + length]] == 1 and matching_pam(s[:i], config.pams())])
+
+def test_conserved_spacers_occur_once_in_every_genome():
+	config = Config()
+	genomes = strain_genomes(random.Random(12))
+	conserved = find_conserved_spacers(genomes, [0, 100], config=config)
+	expected = set.intersection(*[unique_pam_spacers(g, config) for g in genomes.values()])
+	found = [str(c['seqrec'].seq) for c in conserved]
+	assert len(found) and len(found) == len(set(found))
+	# the restriction site and homopolymer filters are the only ones left out of the brute force
+	assert set(found) <= expected and len(found) >= 0.9 * len(expected)
+	for c in conserved:
+		for (name, genome) in genomes.items():
+			coordinate = c['coordinates'][name]
+			if c['strands'][name] == 'fw':
+				site = genome[coordinate - 1:coordinate - 1 + config.SPACER_LENGTH]
+			else:
+				site = str(Seq(genome[coordinate - config.SPACER_LENGTH:coordinate]).reverse_complement())
+			assert site == str(c['seqrec'].seq)
+	# the second strain has the first block reversed
+	assert any([c['strands']['strain_1'] != c['strands']['strain_2'] for c in conserved])
+
+def test_regions_limit_the_results_to_the_first_genome():
+	config = Config()
+	genomes = strain_genomes(random.Random(13))
+	conserved = find_conserved_spacers(genomes, [0, 100], [{'name': 'block_b', 'start': 900, 'end': 1500}], config)
+	assert len(conserved)
+	assert all([c['region'] == 'block_b' and 900 <= c['location'] <= 1500 for c in conserved])
+	assert [c['location'] for c in conserved] == sorted([c['location'] for c in conserved])
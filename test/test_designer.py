@@ -0,0 +1,64 @@
+import json
+import random
+
+import designer as designer_module
+from designer import Designer, fasta_index_name
+
+def write_fasta(path, record_id, length=3000, seed=4):
+	rng = random.Random(seed)
+	with open(path, 'w') as f:
+		f.write(f">{record_id} a test genome\n{''.join([rng.choice('ACGT') for _ in range(length)])}\n")
+	return str(path)
+
+def test_fasta_index_name():
+	assert fasta_index_name('/genomes/my_genome.fasta') == 'my_genome'
+	assert fasta_index_name('/genomes/my_genome.fna.gz') == 'my_genome'
+	assert fasta_index_name('strain.v2.fa') == 'strain.v2'
+
+def test_fasta_genomes_are_searched_under_the_index_they_were_built_as(tmp_path, monkeypatch):
+	# the record id (NC_000001.1) differs from the file stem (my_genome), every bowtie2 search must use the stem
+	fasta = write_fasta(tmp_path / 'my_genome.fasta', 'NC_000001.1')
+	built = []
+	searched = set()
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: built.append(name))
+	monkeypatch.setattr(designer_module, 'load_prefilter', lambda genome_id, contigs, config: searched.add(genome_id))
+	def filter_fingerprints(candidates, genome_id, pool=None):
+		searched.add(genome_id)
+		return candidates
+	def remove_offtargets(genome_id, name, candidates, *args, **kwargs):
+		searched.add(genome_id)
+		return candidates
+	def offtarget_verdicts(genome_id, name, candidates, config, prefilter=None):
+		searched.add(genome_id)
+		return {c['name']: True for c in candidates}
+	monkeypatch.setattr(designer_module, 'filter_non_unique_fingerprints', filter_fingerprints)
+	monkeypatch.setattr(designer_module, 'remove_offtarget_matches', remove_offtargets)
+	monkeypatch.setattr(designer_module, 'offtarget_verdicts', offtarget_verdicts)
+
+	designer = Designer(genome_fasta_files=[fasta])
+	assert designer.genome_ids == ['my_genome'] and built == ['my_genome']
+	regions = designer.custom_regions([{'genome_id': fasta, 'start_ref': 1000, 'end_ref': 1400}])
+	designer.design(regions, start_pct=0, end_pct=100, GC_requirement=[0, 100])
+	assert searched == {'my_genome'}
+	assert len(regions[0]['candidates'])
+
+def test_fasta_genomes_are_evaluated_against_their_own_record(tmp_path, monkeypatch):
+	# a '-' in the file stem used to break recovering the genome id from the SAM file name
+	fasta = write_fasta(tmp_path / 'strain-A.fasta', 'contig_1')
+	genome = open(fasta).read().split('\n')[1]
+	spacer = genome[1000:1032]
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: None)
+	def find_offtargets(genome_id, fasta_name, config):
+		flexible = ''.join(['N' if p in config.flex_positions() else b for (p, b) in enumerate(spacer)])
+		output_sam = str(tmp_path / f'{genome_id}.sam')
+		with open(output_sam, 'w') as f:
+			f.write(f"spacer_1\t0\tcontig_1\t1001\t255\t32M\t*\t0\t0\t{flexible}\t*\tAS:i:0\tXM:i:5\tXO:i:0\n")
+		return output_sam
+	monkeypatch.setattr(designer_module, 'find_offtargets', find_offtargets)
+
+	designer = Designer(genome_fasta_files=[fasta])
+	[summary] = designer.evaluate([spacer], str(tmp_path), report_format='jsonl')
+	assert summary['match_found'] == 'Perfect match(es) found'
+	with open(tmp_path / 'spacer_eval_off_targets.jsonl') as f:
+		[hit] = [json.loads(line) for line in f]
+	assert hit['genome'] == 'strain-A' and hit['coordinate'] == 1001 and hit['protospacer'] == spacer
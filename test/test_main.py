@@ -0,0 +1,22 @@
+import json
+
+import designer as designer_module
+from main import spacer_gen
+from test_designer import write_fasta
+
+def gen_args(tmp_path, **args):
+	defaults = {'email': '', 'nonessential_only': False, 'output_path': str(tmp_path), 'genbank_ids': [], 'genbank_files': [],
+				'genome_fasta_files': [], 'start_pct': 0, 'end_pct': 100, 'spacers_per_region': 10, 'GC_requirement': [0, 100],
+				'overlapping_spacers': 'avoid', 'target_locus_tags_csv': '', 'coding_spacer_direction': 'N_to_C', 'region_type': 'coding',
+				'noncoding_boundary': [0, 0], 'custom_regions_csv': '', 'custom_sequences': []}
+	return dict(defaults, **args)
+
+def test_conserved_runs_export_their_trace(tmp_path, monkeypatch):
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: None)
+	fastas = [write_fasta(tmp_path / f'genome_{i}.fasta', f'genome_{i}', seed=7) for i in range(2)]
+	trace_output = str(tmp_path / 'run.json')
+	conserved = spacer_gen(gen_args(tmp_path, genome_fasta_files=fastas, region_type='conserved', trace_output=trace_output))
+	assert len(conserved)
+	with open(trace_output) as f:
+		trace = json.load(f)
+	assert trace['run']['command'] == 'spacer_gen' and trace['run']['region_type'] == 'conserved'
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+from Bio.Seq import Seq
+
+from pams import pam_patterns, pam_supported, matching_pam
+from outputs import annotate_hits
+from kmers import encode_seq
+from config import Config
+
+class Read(dict):
+	# The parts of a simplesam read annotate_hits uses
+	def __init__(self, start, length, reverse, rname='contig'):
+		super().__init__()
+		self.coords = list(range(start, start + length))
+		self.reverse = reverse
+		self.rname = rname
+
+def test_pam_supported_matches_matching_pam():
+	rng = random.Random(5)
+	for setting in ['CC', ['CC', 'CNG'], ['TTTV', 'CN']]:
+		patterns = pam_patterns(setting)
+		width = len(patterns[0])
+		upstreams = [''.join([rng.choice('ACGTN') for _ in range(width)]) for _ in range(500)]
+		supported = pam_supported(np.array([encode_seq(u) for u in upstreams]), patterns)
+		assert supported.tolist() == [matching_pam(u, patterns) is not None for u in upstreams]
+
+def test_annotate_hits_reads_the_pam_on_the_hit_strand():
+	config = Config(PAM_SEQ=('CC', 'CNG'))
+	rng = random.Random(8)
+	genome_text = ''.join([rng.choice('ACGT') for _ in range(5000)])
+	genome_bytes = np.frombuffer(genome_text.encode('ascii'), dtype=np.uint8)
+	length = config.SPACER_LENGTH
+	pam_length = config.pam_length()
+	reads = [Read(start, length, reverse) for start in range(1, len(genome_text) - length + 2, 7) for reverse in [False, True]]
+	annotate_hits(reads, 'genome', genome_text, genome_bytes, {}, config)
+	for r in reads:
+		(start, end) = (r.coords[0], r.coords[-1])
+		if r.reverse:
+			pam = str(Seq(genome_text[end:end + pam_length]).reverse_complement())
+			protospacer = str(Seq(genome_text[start - 1:end]).reverse_complement())
+		else:
+			pam = genome_text[max(start - 1 - pam_length, 0):start - 1]
+			protospacer = genome_text[start - 1:end]
+		assert r['genbankId'] == 'genome'
+		assert r['pam'] == pam
+		assert r['protospacer'] == protospacer
+		assert r['pam_supported'] == (matching_pam(pam, config.pams()) is not None)
+	assert any([r['pam_supported'] for r in reads]) and not all([r['pam_supported'] for r in reads])
+
+def test_annotate_hits_uses_contig_offsets():
+	config = Config(PAM_SEQ='CC')
+	contig_a = 'A' * 50
+	contig_b = 'TT' + 'CC' + 'G' * config.SPACER_LENGTH + 'TT'
+	genome_text = contig_a + contig_b
+	genome_bytes = np.frombuffer(genome_text.encode('ascii'), dtype=np.uint8)
+	# the hit is at position 5 of contig b, after its CC
+	read = Read(5, config.SPACER_LENGTH, False, 'b')
+	annotate_hits([read], 'genome', genome_text, genome_bytes, {'a': 0, 'b': len(contig_a)}, config)
+	assert read['pam'] == 'CC' and read['pam_supported']
+	assert read['protospacer'] == 'G' * config.SPACER_LENGTH
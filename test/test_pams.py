@@ -0,0 +1,79 @@
+import re
+import random
+
+import numpy as np
+from Bio.Seq import Seq
+
+from pams import pam_patterns, pattern_regex, find_pams, matching_pam, pam_adjacent
+from finder import candidates_for_seq
+from kmers import encode_seq
+from config import Config
+
+def naive_pams(seq, patterns):
+	# Every (position, PAM) of every pattern, one position and pattern at a time
+	return [(i, seq[i:i+len(p)]) for i in range(len(seq)) for p in patterns
+			if re.fullmatch(pattern_regex(p), seq[i:i+len(p)])]
+
+def random_seq(length, seed):
+	rng = random.Random(seed)
+	return ''.join([rng.choice('ACGT') for _ in range(length)])
+
+def test_pam_patterns_longest_first():
+	assert pam_patterns(['cc', 'CNG', 'CT', 'CC']) == ('CNG', 'CC', 'CT')
+	assert pam_patterns('CN') == ('CN',)
+
+def test_pam_patterns_rejects_non_iupac():
+	for setting in ['CX', '', [], ['CC', 'C-']]:
+		try:
+			pam_patterns(setting)
+		except ValueError:
+			continue
+		raise AssertionError(f"{setting} was accepted")
+
+def test_every_pattern_is_reported_at_a_position():
+	# CCG is a PAM of both CNG and CC, each is followed by a different spacer
+	assert find_pams('ACCGTTT', pam_patterns(['CC', 'CNG'])) == [(1, 'CCG'), (1, 'CC')]
+
+def test_overlapping_pams():
+	assert find_pams('CCCC', pam_patterns('CC')) == [(0, 'CC'), (1, 'CC'), (2, 'CC')]
+	assert find_pams('acct', pam_patterns(['CN'])) == [(1, 'CC'), (2, 'CT')]
+
+def test_find_pams_matches_a_naive_scan():
+	for (seed, setting) in enumerate(['CC', ['CC', 'CT'], ['CC', 'CNG'], ['CN', 'NNG', 'YRN'], ['TTTV', 'TTN']]):
+		patterns = pam_patterns(setting)
+		seq = random_seq(2000, seed)
+		found = find_pams(seq, patterns)
+		assert sorted(found) == sorted(naive_pams(seq, patterns))
+		assert [position for (position, _) in found] == sorted([position for (position, _) in found])
+
+def test_matching_pam_and_pam_adjacent_agree_with_find_pams():
+	config = Config(PAM_SEQ=('CC', 'CNG', 'TTN'))
+	seq = random_seq(3000, 7)
+	spacer_starts = {position + len(pam) for (position, pam) in find_pams(seq, config.pams())}
+	adjacent = pam_adjacent(encode_seq(seq), config.pams(), config.SPACER_LENGTH)
+	for start in range(len(adjacent)):
+		assert adjacent[start] == (start in spacer_starts)
+		upstream = seq[max(start - config.pam_length(), 0):start]
+		assert (matching_pam(upstream, config.pams()) is not None) == (start in spacer_starts)
+
+def test_candidates_for_seq_follow_every_pam():
+	config = Config(PAM_SEQ=('CC', 'CNG'))
+	seq = 'ACCG' + random_seq(40, 3).replace('C', 'A')
+	candidates = candidates_for_seq(Seq(seq), 'x--fw', config=config)
+	assert [(c['location'], c['pam']) for c in candidates] == [(3, 'CC'), (4, 'CCG')]
+	for c in candidates:
+		assert str(c['seqrec'].seq) == seq[c['location']:c['location'] + config.SPACER_LENGTH]
+		assert c['name'] == f"x--fw{c['location']}"
+
+def test_candidates_for_seq_skip_short_and_ambiguous_spacers():
+	config = Config(PAM_SEQ='CC')
+	seq = 'CC' + 'A' * 31
+	assert candidates_for_seq(Seq(seq), 'x--fw', config=config) == []
+	assert candidates_for_seq(Seq('CC' + 'A' * 15 + 'N' + 'A' * 16), 'x--fw', config=config) == []
+	assert len(candidates_for_seq(Seq(seq + 'A'), 'x--fw', config=config)) == 1
+
+def test_candidates_for_seq_gc_requirement():
+	config = Config(PAM_SEQ='CC')
+	seq = Seq('CC' + 'GA' * 16)
+	assert len(candidates_for_seq(seq, 'x--fw', [40, 60], config)) == 1
+	assert candidates_for_seq(seq, 'x--fw', [55, 65], config) == []
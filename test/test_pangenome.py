@@ -0,0 +1,49 @@
+import os
+import json
+
+import pytest
+
+import pangenome
+from pangenome import list_genomes, plan_shards, shard_id, prepare_pangenome
+
+def write_genome(path, length=100):
+	with open(path, 'w') as f:
+		f.write(f">{os.path.basename(path)}\n{'ACGT' * (length // 4)}\n")
+
+def fake_build_shard(shard_dir, shard_genomes, threads):
+	# what build_shard leaves behind, without running bowtie2-build
+	os.makedirs(shard_dir, exist_ok=True)
+	with open(os.path.join(shard_dir, 'contigs.json'), 'w') as f:
+		json.dump({f'c{i}': g['name'] for (i, g) in enumerate(shard_genomes)}, f)
+
+def test_genomes_are_listed_by_name(tmp_path):
+	for name in ['b.fna', 'a.fasta', 'notes.txt']:
+		write_genome(tmp_path / name)
+	assert [(g['name'], g['format']) for g in list_genomes(tmp_path)] == [('a', 'fasta'), ('b', 'fasta')]
+	write_genome(tmp_path / 'b.fasta')
+	with pytest.raises(Exception, match="same name 'b'"):
+		list_genomes(tmp_path)
+
+def test_shards_are_planned_by_size(tmp_path):
+	genomes = [{'name': str(i), 'path': str(i), 'size': size, 'mtime': 0} for (i, size) in enumerate([40, 40, 30, 90, 10])]
+	assert [[g['name'] for g in s] for s in plan_shards(genomes, 100)] == [['0', '1'], ['2'], ['3', '4']]
+	assert shard_id(genomes[:2]) != shard_id(genomes[1:3])
+
+def test_only_stale_shards_are_removed_from_the_index_dir(tmp_path, monkeypatch):
+	monkeypatch.setattr(pangenome, 'build_shard', fake_build_shard)
+	genome_dir = tmp_path / 'genomes'
+	index_dir = tmp_path / 'index'
+	os.makedirs(genome_dir)
+	write_genome(genome_dir / 'a.fasta')
+	[_, first_shards] = prepare_pangenome(str(genome_dir), str(index_dir), cores=1)
+	# unrelated data in index_dir, and a shard-like directory this code didn't finish
+	os.makedirs(index_dir / 'results')
+	write_genome(index_dir / 'results' / 'keep.fasta')
+	write_genome(index_dir / 'keep.fasta')
+	os.makedirs(index_dir / 'shard_0123456789ab')
+
+	write_genome(genome_dir / 'b.fasta', 200)
+	[names, shards] = prepare_pangenome(str(genome_dir), str(index_dir), cores=1)
+	assert names == ['a', 'b'] and shards != first_shards
+	assert not os.path.exists(first_shards[0])
+	assert sorted(os.listdir(index_dir)) == sorted(['results', 'keep.fasta', 'shard_0123456789ab'] + [os.path.basename(s) for s in shards])
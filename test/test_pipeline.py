@@ -0,0 +1,62 @@
+import time
+import random
+
+import pytest
+
+import designer as designer_module
+import pipeline
+from designer import Designer
+from pipeline import design_pipelined
+from test_designer import write_fasta
+
+@pytest.fixture
+def fasta_designer(tmp_path, monkeypatch):
+	# A Designer over one fasta genome, with the bowtie2 steps replaced by pass-throughs
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: None)
+	monkeypatch.setattr(designer_module, 'load_prefilter', lambda genome_id, contigs, config: None)
+	for module in [designer_module, pipeline]:
+		monkeypatch.setattr(module, 'filter_non_unique_fingerprints', lambda candidates, genome_id, pool=None: candidates)
+		monkeypatch.setattr(module, 'remove_offtarget_matches', lambda genome_id, name, candidates, *args, **kwargs: candidates)
+	monkeypatch.setattr(designer_module, 'offtarget_verdicts', lambda genome_id, name, candidates, config, prefilter=None: {c['name']: True for c in candidates})
+	fasta = write_fasta(tmp_path / 'genome.fasta', 'genome', length=20000)
+	designer = Designer(genome_fasta_files=[fasta])
+	regions = designer.custom_regions([{'genome_id': fasta, 'start_ref': 1000*i, 'end_ref': 1000*i + 600} for i in range(1, 13)])
+	return [designer, regions]
+
+def test_regions_are_written_in_order(fasta_designer, monkeypatch, tmp_path):
+	[designer, regions] = fasta_designer
+	rng = random.Random(2)
+	def remove_offtargets(genome_id, name, candidates, *args, **kwargs):
+		# alignments finish out of order
+		time.sleep(rng.random() / 50)
+		return candidates
+	written = []
+	monkeypatch.setattr(pipeline, 'remove_offtarget_matches', remove_offtargets)
+	monkeypatch.setattr(pipeline, 'make_spacer_gen_output', lambda region, output_filename, config: written.append(region['name']))
+	expected = [dict(r) for r in regions]
+	designer.design(expected, start_pct=0, end_pct=100, GC_requirement=[0, 100])
+
+	result = design_pipelined(designer, regions, start_pct=0, end_pct=100, GC_requirement=[0, 100], output_path=str(tmp_path),
+							  generation_processes=0, alignment_threads=4, queue_size=2)
+	assert written == [r['name'] for r in regions]
+	assert all([len(r['candidates']) for r in result])
+	assert [[c['name'] for c in r['candidates']] for r in result] == [[c['name'] for c in r['candidates']] for r in expected]
+	# the in-process path keeps no genomes around once it's done
+	assert pipeline._worker_genomes == {}
+
+def test_stage_errors_are_raised(fasta_designer, monkeypatch):
+	[designer, regions] = fasta_designer
+	def remove_offtargets(genome_id, name, candidates, *args, **kwargs):
+		if name == regions[5]['name']:
+			raise Exception('bowtie2 failed')
+		return candidates
+	monkeypatch.setattr(pipeline, 'remove_offtarget_matches', remove_offtargets)
+	with pytest.raises(Exception, match='bowtie2 failed'):
+		design_pipelined(designer, regions, start_pct=0, end_pct=100, GC_requirement=[0, 100], generation_processes=0, queue_size=2)
+
+def test_generation_processes_read_the_shared_tables(fasta_designer):
+	[designer, regions] = fasta_designer
+	expected = [dict(r) for r in regions]
+	designer.design(expected, start_pct=0, end_pct=100, GC_requirement=[0, 100])
+	result = design_pipelined(designer, regions, start_pct=0, end_pct=100, GC_requirement=[0, 100], generation_processes=2)
+	assert [[c['name'] for c in r['candidates']] for r in result] == [[c['name'] for c in r['candidates']] for r in expected]
@@ -0,0 +1,75 @@
+import time
+import threading
+from collections import Counter
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from pool import CandidatePool, spacer_key
+
+def candidate(name, seq):
+	return {'name': name, 'seqrec': SeqRecord(Seq(seq), id=name)}
+
+def counting_check(calls, delay=0):
+	# A check that passes sequences without a G, counting how often each sequence is checked
+	def compute(candidates):
+		time.sleep(delay)
+		for c in candidates:
+			calls[spacer_key(c)] += 1
+		return {c['name']: 'G' not in spacer_key(c) for c in candidates}
+	return compute
+
+def test_verdicts_are_reused_across_regions():
+	calls = Counter()
+	pool = CandidatePool()
+	first = [candidate('a--fw1', 'AAAA'), candidate('a--fw2', 'AAGA')]
+	# the same sites found by another region, under other names, and one identical sequence elsewhere
+	second = [candidate('b--fw1', 'AAAA'), candidate('b--fw2', 'AAGA'), candidate('b--rv9', 'AAAA'), candidate('b--fw3', 'CCCC')]
+	assert pool.verdicts('offtarget', first, counting_check(calls)) == {'a--fw1': True, 'a--fw2': False}
+	assert pool.keep('offtarget', second, counting_check(calls)) == [second[0], second[2], second[3]]
+	assert set(calls.values()) == {1}
+	assert (pool.computed, pool.reused) == (3, 3)
+	# other checks of the same sequences are separate
+	pool.verdicts('fingerprint', first, counting_check(calls))
+	assert calls['AAAA'] == 2
+
+def test_concurrent_regions_check_each_candidate_once():
+	calls = Counter()
+	pool = CandidatePool()
+	sequences = [''.join(['ACGT'[(i >> (2 * j)) & 3] for j in range(6)]) for i in range(200)]
+	# overlapping windows of candidates, as neighbouring regions have
+	regions = [[candidate(f'r{r}--fw{i}', sequences[i]) for i in range(start, start + 60)] for (r, start) in enumerate(range(0, 150, 10))]
+	results = {}
+	def run(r, region):
+		results[r] = pool.verdicts('offtarget', region, counting_check(calls, delay=0.01))
+	threads = [threading.Thread(target=run, args=(r, region)) for (r, region) in enumerate(regions)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	assert set(calls.values()) == {1} and len(calls) == 200
+	assert pool.computed == 200 and pool.computed + pool.reused == sum([len(region) for region in regions])
+	for (r, region) in enumerate(regions):
+		assert results[r] == {c['name']: 'G' not in spacer_key(c) for c in region}
+
+def test_a_failed_check_is_retried_by_a_waiting_thread():
+	pool = CandidatePool()
+	region = [candidate('a--fw1', 'AAAA'), candidate('a--fw2', 'CCCC')]
+	started = threading.Event()
+	def failing(candidates):
+		started.set()
+		time.sleep(0.05)
+		raise Exception('bowtie2 failed')
+	errors = []
+	def run_failing():
+		try:
+			pool.verdicts('offtarget', region, failing)
+		except Exception as e:
+			errors.append(str(e))
+	thread = threading.Thread(target=run_failing)
+	thread.start()
+	started.wait()
+	calls = Counter()
+	assert pool.verdicts('offtarget', region, counting_check(calls)) == {'a--fw1': True, 'a--fw2': True}
+	thread.join()
+	assert errors == ['bowtie2 failed'] and calls == Counter({'AAAA': 1, 'CCCC': 1})
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from prefilter import OfftargetPrefilter, seed_positions, prefilter_applies
+from kmers import encode_seq, reverse_complement_codes
+from config import Config
+
+def near_sites(genome, spacer, config):
+	# Every window of genome, on both strands, within mismatch_threshold mismatches of spacer at its non-flexible
+	# positions: the alignments bowtie2 reports for the spacer, found by brute force
+	positions = seed_positions(config)
+	spacer_codes = encode_seq(spacer)[positions]
+	codes = encode_seq(genome)
+	sites = 0
+	for strand in [codes, reverse_complement_codes(codes)]:
+		windows = np.lib.stride_tricks.sliding_window_view(strand, config.SPACER_LENGTH)[:, positions]
+		sites += int(((windows != spacer_codes).sum(axis=1) <= config.mismatch_threshold).sum())
+	return sites
+
+def planted_genome(config, rng):
+	# A random genome and 40 spacers from it, 20 of which have a second site within mismatch_threshold mismatches
+	# (and changed flexible bases, which don't count) elsewhere, on either strand
+	bases = [rng.choice('ACGT') for _ in range(20000)]
+	spacers = [''.join(bases[1000 + 200*i:1000 + 200*i + config.SPACER_LENGTH]) for i in range(40)]
+	for (i, spacer) in enumerate(spacers[:20]):
+		site = list(spacer)
+		for p in rng.sample(seed_positions(config), i % (config.mismatch_threshold + 1)) + config.flex_positions():
+			site[p] = rng.choice([b for b in 'ACGT' if b != site[p]])
+		site = ''.join(site)
+		if i % 2:
+			site = str(Seq(site).reverse_complement())
+		bases[10000 + 200*i:10000 + 200*i + config.SPACER_LENGTH] = site
+	return [''.join(bases), spacers]
+
+def test_clean_candidates_have_no_other_site():
+	config = Config().replace(mismatch_threshold=2)
+	assert prefilter_applies(config)
+	[genome, spacers] = planted_genome(config, random.Random(8))
+	prefilter = OfftargetPrefilter.build('genome', [genome], config)
+	candidates = [{'name': f'spacer_{i}', 'seqrec': SeqRecord(Seq(s))} for (i, s) in enumerate(spacers)]
+	[clean, possibly_dirty] = prefilter.split(candidates, config)
+
+	sites = {c['name']: near_sites(genome, c['seqrec'].seq, config) for c in candidates}
+	# bowtie2 would pass every clean candidate, and every one with an off-target site is aligned
+	assert all([sites[c['name']] == 1 for c in clean])
+	assert set([c['name'] for c in candidates if sites[c['name']] > 1]) == set([c['name'] for c in candidates[:20]])
+	assert set([c['name'] for c in possibly_dirty]) >= set([c['name'] for c in candidates[:20]])
+	# and the ones without are rarely false positives
+	assert len(clean) >= 18
+
+def test_saved_prefilter_gives_the_same_verdicts(tmp_path):
+	config = Config().replace(mismatch_threshold=1)
+	[genome, spacers] = planted_genome(config, random.Random(9))
+	candidates = [{'name': f'spacer_{i}', 'seqrec': SeqRecord(Seq(s))} for (i, s) in enumerate(spacers)]
+	prefilter = OfftargetPrefilter.build('genome', [genome], config)
+	prefilter.save(str(tmp_path / 'prefilter.npz'))
+	loaded = OfftargetPrefilter.load('genome', str(tmp_path / 'prefilter.npz'))
+	[clean, _] = prefilter.split(candidates, config)
+	[loaded_clean, _] = loaded.split(candidates, config)
+	assert [c['name'] for c in loaded_clean] == [c['name'] for c in clean]
@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+from simplesam import Sam
+
+from risk import read_mismatches, read_protospacer, mismatch_profiles, profile_positions, position_weights, hit_risks, gapped_hit_risk, spacer_risk
+from config import Config
+
+def mutate(seq, positions, rng):
+	seq = list(seq)
+	for p in positions:
+		seq[p] = rng.choice([b for b in 'ACGT' if b != seq[p]])
+	return ''.join(seq)
+
+def test_profiles_give_exact_mismatch_positions():
+	config = Config()
+	rng = random.Random(1)
+	spacer = ''.join([rng.choice('ACGT') for _ in range(config.SPACER_LENGTH)])
+	free = [p for p in range(config.SPACER_LENGTH) if p not in config.flex_positions()]
+	expected = [sorted(rng.sample(free, k)) for k in [0, 1, 3, 6]]
+	# protospacers may run past the spacer, the extra bases are ignored
+	protospacers = [mutate(spacer, positions, rng) + 'ACGT' for positions in expected]
+	profiles = mismatch_profiles(spacer, protospacers, config)
+	assert profiles.shape == (4, config.SPACER_LENGTH)
+	assert profile_positions(profiles) == expected
+
+def test_flexible_positions_and_ambiguous_bases_never_mismatch():
+	config = Config()
+	spacer = 'A' * config.SPACER_LENGTH
+	protospacer = ''.join(['C' if p in config.flex_positions() else 'A' for p in range(config.SPACER_LENGTH)])
+	assert not mismatch_profiles(spacer, [protospacer], config).any()
+	assert not mismatch_profiles(spacer, ['N' * config.SPACER_LENGTH], config).any()
+	assert not mismatch_profiles('N' * config.SPACER_LENGTH, ['C' * config.SPACER_LENGTH], config).any()
+	assert mismatch_profiles(spacer, [], config).shape == (0, config.SPACER_LENGTH)
+
+def test_hit_risks_weigh_seed_and_distal_mismatches():
+	config = Config(seed_length=8, seed_mismatch_weight=0.1, distal_mismatch_weight=0.5)
+	weights = position_weights(config.SPACER_LENGTH, config)
+	assert (weights[:8] == 0.1).all() and (weights[8:] == 0.5).all()
+	profiles = np.zeros((4, config.SPACER_LENGTH), dtype=bool)
+	profiles[1, 0] = True
+	profiles[2, [9, 20]] = True
+	profiles[3, [2, 3, 30]] = True
+	assert np.allclose(hit_risks(profiles, config), [1, 0.1, 0.25, 0.005])
+	assert gapped_hit_risk(2, config) == 0.25
+
+def test_spacer_risk_discounts_one_target_site_per_genome():
+	hits = [{'genome': 'a', 'perfect_match': True, 'risk': 1.0},
+			{'genome': 'b', 'perfect_match': True, 'risk': 1.0},
+			{'genome': 'b', 'perfect_match': False, 'risk': 0.25}]
+	assert spacer_risk(hits) == 0.25
+	# a second identical site in a genome is an off-target
+	assert spacer_risk(hits + [{'genome': 'a', 'perfect_match': True, 'risk': 1.0}]) == 1.25
+	assert spacer_risk([{'genome': 'a', 'perfect_match': False, 'risk': 0.5}]) == 0.5
+	assert spacer_risk([]) == 0
+
+def aligned_read(read_seq, reference, reverse, gaps=0):
+	# The SAM record bowtie2 writes for read_seq aligned ungapped to reference (both on the forward strand)
+	md = []
+	run = 0
+	for (r, g) in zip(read_seq, reference):
+		if r == g:
+			run += 1
+		else:
+			md += [str(run), g]
+			run = 0
+	md.append(str(run))
+	return Sam(flag=16 if reverse else 0, seq=read_seq, tags=[f'MD:Z:{"".join(md)}', f'XO:i:{gaps}', 'XM:i:0'])
+
+def test_read_mismatches_are_exact_on_both_strands():
+	config = Config()
+	rng = random.Random(3)
+	complement = str.maketrans('ACGTN', 'TGCAN')
+	spacer = ''.join([rng.choice('ACGT') for _ in range(config.SPACER_LENGTH)])
+	flexible = ''.join(['N' if p in config.flex_positions() else b for (p, b) in enumerate(spacer)])
+	free = [p for p in range(config.SPACER_LENGTH) if p not in config.flex_positions()]
+	for k in [0, 2, 5]:
+		positions = rng.sample(free, k + 1)
+		# an ambiguous genome base is not a mismatch, and neither are the flexible positions
+		protospacer = mutate(spacer, positions[1:], rng)
+		protospacer = protospacer[:positions[0]] + 'N' + protospacer[positions[0]+1:]
+		forward = aligned_read(flexible, protospacer, False)
+		reverse = aligned_read(flexible.translate(complement)[::-1], protospacer.translate(complement)[::-1], True)
+		for read in [forward, reverse]:
+			assert read_protospacer(read) == [flexible, protospacer]
+			assert read_mismatches(read, config) == k
+
+def test_gapped_reads_have_no_mismatch_count():
+	config = Config()
+	read = aligned_read('A' * config.SPACER_LENGTH, 'A' * config.SPACER_LENGTH, False, gaps=1)
+	assert read_mismatches(read, config) is None
@@ -0,0 +1,62 @@
+import time
+import random
+import threading
+
+import pytest
+
+from service import DesignService
+
+def gen_args(output_path, **changes):
+	# spacer_gen arguments for custom sequences, which need no genome (and so no bowtie2)
+	rng = random.Random(6)
+	sequence = ''.join([rng.choice('ACGT') for _ in range(400)])
+	args = {'output_path': str(output_path), 'genbank_ids': [], 'genbank_files': [], 'genome_fasta_files': [], 'email': '',
+			'nonessential_only': False, 'spacers_per_region': 3, 'GC_requirement': [0, 100], 'region_type': 'custom',
+			'overlapping_spacers': 'allowed', 'coding_spacer_direction': None, 'start_pct': 0, 'end_pct': 100,
+			'target_locus_tags_csv': '', 'noncoding_boundary': [], 'custom_regions_csv': '', 'custom_sequences': [sequence]}
+	return dict(args, **changes)
+
+def finished(service, job):
+	job['future'].result(timeout=30)
+	return service.get_job(job['id'])
+
+def test_a_job_runs_to_done(tmp_path):
+	service = DesignService()
+	job = finished(service, service.submit('spacer_gen', gen_args(tmp_path)))
+	assert job['status'] == 'done' and job['error'] is None
+	assert [r['name'] for r in job['result']] == ['custom-0'] and len(job['result'][0]['spacers']) == 3
+	assert job['finished'] >= job['started'] >= job['submitted']
+
+def test_invalid_input_fails_the_job_with_its_message(tmp_path):
+	service = DesignService()
+	job = finished(service, service.submit('spacer_gen', gen_args(tmp_path, region_type='exons')))
+	assert job['status'] == 'failed' and job['result'] is None
+	assert 'region_type must be' in job['error']
+	job = finished(service, service.submit('spacer_gen', gen_args(tmp_path, custom_regions_csv=str(tmp_path / 'missing.csv'))))
+	assert job['status'] == 'failed' and 'custom regions csv' in job['error']
+	eval_args = {'genbank_ids': [], 'fasta_files': [], 'output_path': str(tmp_path), 'email': 'me@example.com', 'spacers': [], 'off_target_report': 'pdf'}
+	job = finished(service, service.submit('spacer_eval', eval_args))
+	assert job['status'] == 'failed' and 'off_target_report must be' in job['error']
+
+def test_unknown_commands_are_rejected():
+	with pytest.raises(ValueError):
+		DesignService().submit('spacer_design', {})
+
+def test_the_queue_is_bounded(tmp_path):
+	service = DesignService(max_concurrent_jobs=1, max_queued_jobs=2)
+	release = threading.Event()
+	service.run_job = lambda job, args: release.wait()
+	service.submit('spacer_gen', {})
+	service.submit('spacer_gen', {})
+	with pytest.raises(OverflowError):
+		service.submit('spacer_gen', {})
+	release.set()
+
+def test_finished_jobs_expire(tmp_path):
+	service = DesignService(finished_job_seconds=0.2, max_finished_jobs=2)
+	jobs = [finished(service, service.submit('spacer_gen', gen_args(tmp_path, region_type='exons'))) for _ in range(3)]
+	# only the newest max_finished_jobs are kept
+	assert [service.get_job(j['id']) is not None for j in jobs] == [False, True, True]
+	time.sleep(0.3)
+	assert service.get_job(jobs[-1]['id']) is None
+	assert service.status()['jobs'] == {}
@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import threading
+
+from shards import create_queue, claim_shard, requeue_expired, queue_status, read_job, shard_path
+
+def make_queue(queue_dir, regions=45, shard_size=10):
+	return create_queue(str(queue_dir), {'start_pct': 10}, [{'name': f'region_{i}'} for i in range(regions)], shard_size)
+
+def test_create_queue_splits_regions_into_shards(tmp_path):
+	job = make_queue(tmp_path)
+	assert job['shards'] == 5 and read_job(str(tmp_path))['start_pct'] == 10
+	assert queue_status(str(tmp_path)) == {'pending': 5, 'claimed': 0, 'done': 0, 'results': 0}
+	regions = []
+	for shard in sorted(os.listdir(tmp_path / 'pending')):
+		with open(shard_path(str(tmp_path), 'pending', shard), 'r') as f:
+			regions += [r['name'] for r in json.load(f)['regions']]
+	assert regions == [f'region_{i}' for i in range(45)]
+
+def test_claims_take_shards_in_order_until_none_are_left(tmp_path):
+	make_queue(tmp_path)
+	claimed = [claim_shard(str(tmp_path)) for _ in range(5)]
+	assert claimed == [f'shard-{i:05d}.json' for i in range(5)]
+	assert claim_shard(str(tmp_path)) is None
+	assert queue_status(str(tmp_path))['claimed'] == 5
+
+def test_concurrent_workers_never_claim_a_shard_twice(tmp_path):
+	make_queue(tmp_path, regions=200, shard_size=1)
+	claims = [[] for _ in range(8)]
+	def worker(claimed):
+		while True:
+			shard = claim_shard(str(tmp_path))
+			if shard is None:
+				return
+			claimed.append(shard)
+	threads = [threading.Thread(target=worker, args=(c,)) for c in claims]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	every_claim = [shard for c in claims for shard in c]
+	assert len(every_claim) == 200 and len(set(every_claim)) == 200
+
+def test_expired_leases_are_requeued(tmp_path):
+	make_queue(tmp_path, regions=20)
+	first = claim_shard(str(tmp_path))
+	second = claim_shard(str(tmp_path))
+	# a lease still being renewed is kept
+	assert requeue_expired(str(tmp_path), 600) == []
+	time.sleep(0.5)
+	os.utime(shard_path(str(tmp_path), 'claimed', second))
+	assert requeue_expired(str(tmp_path), 0.3) == [first]
+	assert queue_status(str(tmp_path))['pending'] == 1
+	assert claim_shard(str(tmp_path)) == first
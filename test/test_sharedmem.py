@@ -0,0 +1,45 @@
+import random
+
+from Bio.Seq import Seq
+
+import designer as designer_module
+from designer import Designer
+from finder import get_candidates_for_region
+from sharedmem import SharedGenomes, attach, attach_unique_spacers
+from config import Config
+from test_designer import write_fasta
+
+def repetitive_genome(length=6000, seed=5):
+	# random sequence with a few copies of one 300bp element, so some spacers are not unique
+	rng = random.Random(seed)
+	bases = [rng.choice('ACGT') for _ in range(length)]
+	element = bases[1000:1300]
+	for start in [2500, 4000]:
+		bases[start:start+300] = element
+	return Seq(''.join(bases))
+
+def test_unique_spacer_table_matches_genome_scan():
+	config = Config()
+	genome = repetitive_genome()
+	with SharedGenomes() as shared:
+		shared.add_genome('genome', genome)
+		shared.add_unique_spacers('genome', genome, config.SPACER_LENGTH)
+		(shared_genome, genome_both_ways) = attach(shared.descriptor)['genome']
+		table = attach_unique_spacers(shared.descriptor)[('genome', config.SPACER_LENGTH)]
+		scanned = get_candidates_for_region(genome, 500, 5500, 'region', [0, 100], config=config)
+		looked_up = get_candidates_for_region(shared_genome, 500, 5500, 'region', [0, 100], genome_both_ways, config, unique_spacers=table)
+		assert len(scanned) and [c['name'] for c in looked_up] == [c['name'] for c in scanned]
+		# spacers in the repeated element are not unique
+		element = genome[1000:1300]
+		assert not any([c['seqrec'].seq in element or c['seqrec'].seq.reverse_complement() in element for c in scanned])
+		del shared_genome, genome_both_ways, table
+
+def test_attached_sessions_get_the_unique_spacer_tables(tmp_path, monkeypatch):
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: None)
+	fasta = write_fasta(tmp_path / 'genome.fasta', 'genome')
+	designer = Designer(genome_fasta_files=[fasta])
+	with SharedGenomes() as shared:
+		shared.add_designer(designer)
+		attached = Designer.attached(shared.descriptor)
+		assert list(attached.unique_spacer_tables.keys()) == [(fasta, designer.config.SPACER_LENGTH)]
+		del attached
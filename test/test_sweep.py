@@ -0,0 +1,45 @@
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from sweep import sweep_settings, complete_settings, hits_within, passes_setting
+from config import Config
+
+def hit(mismatches, gapped=False, penalty=None):
+	# bowtie2's penalty for an ungapped hit: 6 per mismatch, flexible (N) bases free
+	return {'mismatches': None if gapped else mismatches, 'penalty': 6 * mismatches if penalty is None else penalty, 'gapped': gapped}
+
+def candidate(name, seq):
+	return {'name': name, 'seqrec': SeqRecord(Seq(seq), id=name)}
+
+def test_sweep_settings_are_every_combination():
+	settings = sweep_settings([3, 5], [[35, 65], (40, 60)], [4, 5])
+	assert len(settings) == 8
+	assert {'mismatch_threshold': 5, 'GC_requirement': [40, 60], 'homopolymer_length': 4} in settings
+
+def test_complete_settings_fill_in_the_run_defaults():
+	config = Config(mismatch_threshold=4, homopolymer_length=6)
+	settings = complete_settings([{'mismatch_threshold': 2}, {'GC_requirement': (40, 60)}], [35, 65], config)
+	assert settings == [{'mismatch_threshold': 2, 'GC_requirement': [35, 65], 'homopolymer_length': 6},
+						{'mismatch_threshold': 4, 'GC_requirement': [40, 60], 'homopolymer_length': 6}]
+
+def test_hits_within_a_threshold_are_those_its_search_reports():
+	hits = [hit(m) for m in range(7)]
+	for threshold in range(7):
+		assert [h['mismatches'] for h in hits_within(hits, threshold)] == list(range(threshold + 1))
+	# a gap open and extension (5 + 3) is within bowtie's -13 minimum score at 2 mismatches, not 1
+	gapped = [hit(0, gapped=True, penalty=8)]
+	assert hits_within(gapped, 1) == [] and hits_within(gapped, 2) == gapped
+
+def test_one_hit_per_genome_is_the_target_site():
+	c = candidate('x--fw10', 'GC' * 8 + 'AT' * 8)
+	setting = {'mismatch_threshold': 3, 'GC_requirement': [35, 65]}
+	assert passes_setting(c, setting, {'a': {'x--fw10': [hit(0)]}, 'b': {'x--fw10': [hit(0), hit(5)]}})
+	assert passes_setting(c, setting, {'a': {}})
+	# a second hit within the threshold in any one genome fails the candidate
+	assert not passes_setting(c, setting, {'a': {'x--fw10': [hit(0)]}, 'b': {'x--fw10': [hit(0), hit(3)]}})
+	assert passes_setting(c, dict(setting, mismatch_threshold=2), {'b': {'x--fw10': [hit(0), hit(3)]}})
+
+def test_gc_requirement_of_a_setting():
+	c = candidate('x--fw10', 'GC' * 4 + 'AT' * 12)
+	assert passes_setting(c, {'mismatch_threshold': 3, 'GC_requirement': [20, 30]}, {})
+	assert not passes_setting(c, {'mismatch_threshold': 3, 'GC_requirement': [35, 65]}, {})
@@ -0,0 +1,51 @@
+import pytest
+
+import designer as designer_module
+import finder
+import tiling
+from designer import Designer
+from finder import get_candidates_for_region, candidates_for_both_strands
+from tiling import CandidateIndex, tile_genome, unique_spacer_filter
+from test_designer import write_fasta
+
+def dirty(candidate):
+	# a fixed, sequence-based stand-in for the bowtie2 off-target search
+	return sum([ord(b) for b in str(candidate['seqrec'].seq)]) % 3 == 0
+
+@pytest.fixture
+def fasta_designer(tmp_path, monkeypatch):
+	monkeypatch.setattr(designer_module, 'bowtie_build', lambda name, fasta_file=None: None)
+	monkeypatch.setattr(designer_module, 'load_prefilter', lambda genome_id, contigs, config: None)
+	for module in [designer_module, tiling]:
+		monkeypatch.setattr(module, 'filter_non_unique_fingerprints', lambda candidates, genome_id, pool=None: candidates)
+	verdicts = lambda genome_id, name, candidates, config=None, prefilter=None: {c['name']: not dirty(c) for c in candidates}
+	monkeypatch.setattr(designer_module, 'offtarget_verdicts', verdicts)
+	monkeypatch.setattr(finder, 'offtarget_verdicts', verdicts)
+	monkeypatch.setattr(tiling, 'offtarget_hits', lambda genome_id, candidates, config: {c['name']: [{}, {}] if dirty(c) else [{}] for c in candidates})
+	fasta = write_fasta(tmp_path / 'genome.fasta', 'genome', length=20000, seed=11)
+	return [Designer(genome_fasta_files=[fasta]), fasta]
+
+def test_windows_match_region_searches(fasta_designer):
+	[designer, fasta] = fasta_designer
+	config = designer.config
+	genome = designer.genome_seq(fasta)
+	candidates = unique_spacer_filter(candidates_for_both_strands(genome, 'genome', [0, 100], config), genome, config)
+	index = CandidateIndex(candidates, len(genome), config)
+	for (start_mark, end_mark) in [(500, 900), (5000, 5040), (12000, 14000)]:
+		expected = get_candidates_for_region(genome, start_mark, end_mark, 'region', [0, 100], config=config)
+		window = index.window(start_mark, end_mark)
+		assert len(window)
+		assert [(c['location'], str(c['seqrec'].seq)) for c in window] == [(c['location'], str(c['seqrec'].seq)) for c in expected]
+
+def test_tiling_picks_the_spacers_of_region_by_region_design(fasta_designer):
+	[designer, fasta] = fasta_designer
+	# overlapping regions share candidates, and so off-target verdicts
+	bounds = [(1000, 1800), (1500, 2300), (6000, 6600), (15000, 16000)]
+	regions = designer.custom_regions([{'genome_id': fasta, 'start_ref': start, 'end_ref': end} for (start, end) in bounds])
+	expected = [dict(r) for r in regions]
+	designer.design(expected, start_pct=0, end_pct=100, spacers_per_region=5, GC_requirement=[30, 70])
+	tiled = tile_genome(designer, noncoding_regions=regions, spacers_per_region=5, GC_requirement=[30, 70])
+	spacers = lambda region: [(c['location'], str(c['seqrec'].seq)) for c in region['candidates']]
+	assert all([len(spacers(r)) == 5 for r in tiled])
+	assert not any([dirty(c) for r in tiled for c in r['candidates']])
+	assert [spacers(r) for r in tiled] == [spacers(r) for r in expected]